@@ -0,0 +1,121 @@
+#!/usr/bin/python
+"""Reconnect storm benchmark.
+500 peers connect to a node at the same moment, as after a network
+outage, and send their CER. Reports how long it takes until all of them
+have got their CEA, with the old accept behaviour (a backlog of 10 and
+one connection accepted per poll), with a large backlog and batched
+accepts, and with an accept thread. Connection attempts dropped because
+the backlog is full are only retried by the kernel after a second or
+more, with exponential backoff, so peers that do not make it before the
+deadline are counted as not ready.
+"""
+
+from diameter import *
+from diameter.node import *
+import socket
+import select
+import errno
+import struct
+import logging
+import time
+import sys
+
+
+class Sink:
+    def handle_connection(self,connkey,peer,updown):
+        pass
+    def handle_message(self,msg,connkey,peer):
+        return True
+
+
+def make_cer(i):
+    cer = Message()
+    cer.hdr.setRequest(True)
+    cer.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CAPABILITIES_EXCHANGE
+    cer.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_COMMON
+    cer.hdr.hop_by_hop_identifier = i
+    cer.hdr.end_to_end_identifier = i
+    cer.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"peer%d.example.net"%i))
+    cer.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,"example.net"))
+    cer.append(AVP_Address(ProtocolConstants.DI_HOST_IP_ADDRESS,"127.0.0.1"))
+    cer.append(AVP_Unsigned32(ProtocolConstants.DI_VENDOR_ID,9999))
+    cer.append(AVP_UTF8String(ProtocolConstants.DI_PRODUCT_NAME,"bench"))
+    cer.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    return str(cer.encodeToBuffer())
+
+
+def storm(port,peers,deadline):
+    """Connects the peers and sends their CERs. Returns the number of peers
+    that got a CEA before the deadline, and when the last of them got it"""
+    cers = [make_cer(i) for i in range(peers)]
+    start = time.time()
+    socks = {}
+    for i in range(peers):
+        s = socket.socket()
+        s.setblocking(False)
+        s.connect_ex(("127.0.0.1",port))
+        socks[s] = [i,False,""] #peer, CER sent, received
+    pending = set(socks.keys())
+    done = 0
+    last = 0
+    while pending:
+        timeout = start+deadline-time.time()
+        if timeout<=0:
+            break
+        w = [s for s in pending if not socks[s][1]]
+        r = [s for s in pending if socks[s][1]]
+        readable,writable,ignore = select.select(r,w,[],timeout)
+        for s in writable:
+            try:
+                s.send(cers[socks[s][0]])
+                socks[s][1] = True
+            except socket.error:
+                pending.discard(s)
+        for s in readable:
+            try:
+                data = s.recv(4096)
+            except socket.error:
+                data = ""
+            if not data:
+                pending.discard(s)
+                continue
+            socks[s][2] += data
+            got = socks[s][2]
+            if len(got)>=4 and len(got)>=struct.unpack("!I",got[0:4])[0]&0xFFFFFF:
+                pending.discard(s)
+                done += 1
+                last = time.time()-start
+    for s in socks:
+        s.close()
+    return done,last
+
+
+def run(name,port,peers,deadline,backlog,accept_budget,accept_thread):
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+    settings = NodeSettings("server.example.net","example.net",9999,cap,port,"bench",1)
+    settings.setListenBacklog(backlog)
+    settings.setAcceptThread(accept_thread)
+    Node.accept_budget = accept_budget
+    server = Node(Sink(),Sink(),settings)
+    server.start()
+    done,last = storm(port,peers,deadline)
+    server.stop(0.05)
+    print "%-40s %4d peers ready, the last after %6.2f s"%(name,done,last)
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    peers = 500
+    if len(sys.argv)>1:
+        peers = int(sys.argv[1])
+    #below the 30 second watchdog timeout, after which the node would
+    #disconnect the peers since they do not answer DWRs
+    deadline = 25
+    print "%d peers connecting at once, %d s deadline:"%(peers,deadline)
+    run("backlog 10, 1 accept per poll",13940,peers,deadline,10,1,False)
+    run("backlog 1024, up to 64 accepts per poll",13941,peers,deadline,1024,64,False)
+    run("backlog 1024, accept thread",13942,peers,deadline,1024,64,True)
+
+if __name__=="__main__":
+    main()
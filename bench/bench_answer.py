@@ -0,0 +1,103 @@
+#!/usr/bin/python
+"""Answer construction benchmark.
+Builds a credit-control answer from a lazily decoded request, either by
+finding the request AVPs and appending them (deep-copying the
+Requested-Service-Unit) as examples/cc_test_server.py used to do, or by
+copying them as byte ranges with Message.copyAVP().
+"""
+
+from diameter import *
+import copy
+import time
+import sys
+
+
+def build_ccr():
+    msg = Message()
+    msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    msg.hdr.setRequest(True)
+    msg.hdr.setProxiable(True)
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,"client.example.net;1234567890;42"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"client.example.net"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,"example.net"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_DESTINATION_REALM,"example.net"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SERVICE_CONTEXT_ID,"32251@3gpp.org"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_TYPE,ProtocolConstants.DI_CC_REQUEST_TYPE_UPDATE_REQUEST))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_NUMBER,1))
+    msg.append(AVP_Grouped(ProtocolConstants.DI_REQUESTED_SERVICE_UNIT,[
+        AVP_Unsigned64(ProtocolConstants.DI_CC_TOTAL_OCTETS,1000000)]))
+    msg.append(AVP_Grouped(ProtocolConstants.DI_PROXY_INFO,[
+        AVP_UTF8String(ProtocolConstants.DI_PROXY_HOST,"proxy.example.net"),
+        AVP_OctetString(ProtocolConstants.DI_PROXY_STATE,"state")]))
+    Utils.setMandatory_RFC3588(msg)
+    return str(msg.encodeToBuffer())
+
+
+def find_and_append(request):
+    "How examples/cc_test_server.py built its answers before copyAVP()"
+    answer = Message()
+    answer.prepareResponse(request)
+    a = request.find(ProtocolConstants.DI_SESSION_ID)
+    if a:
+        answer.append(a)
+    answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+    for code in (ProtocolConstants.DI_AUTH_APPLICATION_ID,
+                 ProtocolConstants.DI_CC_REQUEST_TYPE,
+                 ProtocolConstants.DI_CC_REQUEST_NUMBER):
+        a = request.find(code)
+        if a:
+            answer.append(a)
+    a = request.find(ProtocolConstants.DI_REQUESTED_SERVICE_UNIT)
+    if a:
+        a = copy.deepcopy(a)
+        a.code = ProtocolConstants.DI_GRANTED_SERVICE_UNIT
+        answer.append(a)
+    for a in request.subset(ProtocolConstants.DI_PROXY_INFO):
+        answer.append(AVP(a.code,a.payload,a.vendor_id))
+    Utils.setMandatory_RFC3588(answer)
+    return answer.encodeToBuffer()
+
+
+def copy_avps(request):
+    answer = Message()
+    answer.prepareResponse(request)
+    answer.copyAVP(request,ProtocolConstants.DI_SESSION_ID)
+    answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+    answer.copyAVP(request,ProtocolConstants.DI_AUTH_APPLICATION_ID)
+    answer.copyAVP(request,ProtocolConstants.DI_CC_REQUEST_TYPE)
+    answer.copyAVP(request,ProtocolConstants.DI_CC_REQUEST_NUMBER)
+    answer.copyAVP(request,ProtocolConstants.DI_REQUESTED_SERVICE_UNIT,
+                   new_code=ProtocolConstants.DI_GRANTED_SERVICE_UNIT)
+    Utils.copyProxyInfo(request,answer)
+    Utils.setMandatory_RFC3588(answer)
+    return answer.encodeToBuffer()
+
+
+def run(name,builder,raw,iterations):
+    t0 = time.time()
+    for i in xrange(iterations):
+        request = Message()
+        request.decodeFrom(raw,0,len(raw),lazy=True)
+        builder(request)
+    elapsed = time.time()-t0
+    print "%-20s %8.1f us/message %8.0f messages/s"%(name,elapsed*1e6/iterations,iterations/elapsed)
+    return elapsed
+
+
+def main():
+    iterations = 10000
+    if len(sys.argv)>1:
+        iterations = int(sys.argv[1])
+    raw = build_ccr()
+    request = Message()
+    request.decodeFrom(raw,0,len(raw),lazy=True)
+    assert find_and_append(request)==copy_avps(request)
+    print "CCR: %d bytes, %d iterations (decode+answer+encode)"%(len(raw),iterations)
+    t_f = run("find+append",find_and_append,raw,iterations)
+    t_c = run("copyAVP",copy_avps,raw,iterations)
+    print "  speedup: %.2fx"%(t_f/t_c)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+"""Concurrent request benchmark.
+Keeps a number of credit-control requests outstanding against a server
+node over loopback, with one thread per outstanding request blocked in
+SimpleSyncClient.sendRequest() and with AsyncNodeManager futures issued
+from one thread. Reports the request rate and the CPU time per request
+of the whole process.
+"""
+
+from diameter import *
+from diameter.node import *
+import threading
+import time
+import os
+import sys
+
+
+class Server(AsyncNodeManager):
+    def handleRequest(self,request,connkey,peer):
+        answer = Message()
+        answer.prepareResponse(request)
+        answer.copyAVP(request,ProtocolConstants.DI_SESSION_ID)
+        answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+        self.node.addOurHostAndRealm(answer)
+        return answer
+
+
+def make_request(node,i):
+    req = Message()
+    req.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    req.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    req.hdr.setRequest(True)
+    req.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,node.makeNewSessionId()))
+    node.addOurHostAndRealm(req)
+    req.append(AVP_UTF8String(ProtocolConstants.DI_DESTINATION_REALM,"example.net"))
+    req.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    req.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_NUMBER,i))
+    return req
+
+
+def sync_threads(client,peer,outstanding,requests):
+    def worker(count):
+        for i in xrange(count):
+            assert client.sendRequest(make_request(client.node,i)) is not None
+    threads = [threading.Thread(target=worker,args=(requests/outstanding,)) for i in xrange(outstanding)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def async_futures(client,peer,outstanding,requests):
+    slots = threading.Semaphore(outstanding)
+    done = threading.Event()
+    answered = [0]
+    total = requests/outstanding*outstanding
+    def answer(future):
+        assert future.getResult() is not None
+        answered[0] += 1 #only the networking thread calls this
+        slots.release()
+        if answered[0]==total:
+            done.set()
+    for i in xrange(total):
+        slots.acquire()
+        client.sendRequest(make_request(client.node,i),[peer]).addCallback(answer)
+    done.wait()
+
+
+def run(name,port,client_class,issue,outstanding,requests):
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+    server = Server(NodeSettings("127.0.0.1","example.net",9999,cap,port,"bench",1))
+    server.start()
+    peer = Peer("127.0.0.1",port)
+    settings = NodeSettings("client.example.net","example.net",9999,cap,0,"bench",1)
+    if client_class is SimpleSyncClient:
+        client = SimpleSyncClient(settings,[peer])
+        client.start()
+    else:
+        client = AsyncNodeManager(settings)
+        client.start()
+        client.node.initiateConnection(peer,True)
+    client.waitForConnection(5)
+    
+    t0 = time.time()
+    c0 = sum(os.times()[:2])
+    issue(client,peer,outstanding,requests)
+    cpu = sum(os.times()[:2])-c0
+    elapsed = time.time()-t0
+    client.stop(0.05)
+    server.stop(0.05)
+    done = requests/outstanding*outstanding
+    print "%-24s %4d outstanding %8.0f req/s %8.1f us CPU/request"%(name,outstanding,done/elapsed,cpu*1e6/done)
+
+
+def main():
+    requests = 20000
+    if len(sys.argv)>1:
+        requests = int(sys.argv[1])
+    port = 13920
+    for outstanding in (1,20,200):
+        run("SimpleSyncClient threads",port,SimpleSyncClient,sync_threads,outstanding,requests)
+        run("AsyncNodeManager",port+1,AsyncNodeManager,async_futures,outstanding,requests)
+        port += 2
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+"""Connection buffer benchmark.
+Queues messages in a buffer and drains it in TCP-sized sends, as a
+connection to a slow peer does, with the bytearray (append and delete
+from the front) and string (concatenate and re-slice) buffers used
+before ByteBuffer and with ByteBuffer. The cost per byte of the old
+buffers grows with the amount queued while ByteBuffer stays constant.
+"""
+
+from diameter import *
+import time
+import sys
+
+
+message = "m"*200
+send_size = 1460
+
+
+def bytearray_buffer(queued):
+    "How NormalConnectionBuffers buffered output before ByteBuffer"
+    buf = bytearray()
+    for i in xrange(queued/len(message)):
+        buf += message
+    while len(buf):
+        raw = buf[:send_size]
+        del buf[:len(raw)]
+
+
+def string_buffer(queued):
+    "How NormalConnectionBuffers buffered input before FrameDecoder"
+    buf = ""
+    for i in xrange(queued/len(message)):
+        buf += message
+    while len(buf):
+        raw = buf[:send_size]
+        buf = buf[len(raw):]
+
+
+def byte_buffer(queued):
+    buf = ByteBuffer()
+    for i in xrange(queued/len(message)):
+        buf.append(message)
+    while len(buf):
+        raw = buf.readable()[:send_size]
+        buf.consume(len(raw))
+
+
+def run(name,f,queued):
+    t0 = time.time()
+    f(queued)
+    elapsed = time.time()-t0
+    print "%-12s %6.1f MB queued %10.1f ns/byte"%(name,queued/1e6,elapsed*1e9/queued)
+
+
+def main():
+    max_queued = 4*1024*1024
+    if len(sys.argv)>1:
+        max_queued = int(sys.argv[1])
+    queued = max_queued/8
+    while queued<=max_queued:
+        run("bytearray",bytearray_buffer,queued)
+        run("string",string_buffer,queued)
+        run("ByteBuffer",byte_buffer,queued)
+        queued *= 2
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+"""Output coalescing benchmark.
+A client node sends credit-control requests over loopback from several
+threads, keeping a number of them outstanding, and a server node answers
+them from its node thread. Reports the request rate and the messages per
+send() call of both nodes without coalescing and with coalescing
+(NodeSettings.setCorkWindow()) for a few windows.
+"""
+
+from diameter import *
+from diameter.node import *
+import threading
+import time
+import sys
+
+
+class Server(NodeManager):
+    def handleRequest(self,request,connkey,peer):
+        answer = Message()
+        answer.prepareResponse(request)
+        answer.copyAVP(request,ProtocolConstants.DI_SESSION_ID)
+        answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+        self.node.addOurHostAndRealm(answer)
+        answer.copyAVP(request,ProtocolConstants.DI_CC_REQUEST_NUMBER)
+        self.answer(answer,connkey)
+
+
+class Client(NodeManager):
+    def __init__(self,settings,outstanding):
+        NodeManager.__init__(self,settings)
+        self.slots = threading.Semaphore(outstanding)
+        self.answers = 0
+        self.answers_lock = threading.Lock()
+    def handleAnswer(self,answer,answer_connkey,state):
+        self.answers_lock.acquire()
+        self.answers += 1
+        self.answers_lock.release()
+        self.slots.release()
+
+
+def send_requests(client,peer,count):
+    for i in xrange(count):
+        req = Message()
+        req.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+        req.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+        req.hdr.setRequest(True)
+        req.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,client.node.makeNewSessionId()))
+        client.node.addOurHostAndRealm(req)
+        req.append(AVP_UTF8String(ProtocolConstants.DI_DESTINATION_REALM,"example.net"))
+        req.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+        req.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_NUMBER,i))
+        client.slots.acquire()
+        client.sendRequest_any(req,[peer],i+1)
+
+
+def run(name,port,cork_window,threads,requests):
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+    ss = NodeSettings("127.0.0.1","example.net",9999,cap,port,"bench",1)
+    ss.setCorkWindow(cork_window)
+    server = Server(ss)
+    server.start()
+    cs = NodeSettings("client.example.net","example.net",9999,cap,0,"bench",1)
+    cs.setCorkWindow(cork_window)
+    client = Client(cs,200)
+    peer = Peer("127.0.0.1",port)
+    client.start()
+    client.node.initiateConnection(peer,True)
+    client.waitForConnection(5)
+    #skip the capability exchange
+    server_base = server.node.getOutputStatistics()
+    client_base = client.node.getOutputStatistics()
+    
+    per_thread = requests/threads
+    senders = [threading.Thread(target=send_requests,args=(client,peer,per_thread)) for i in xrange(threads)]
+    t0 = time.time()
+    for t in senders:
+        t.start()
+    for t in senders:
+        t.join()
+    while client.answers<per_thread*threads:
+        time.sleep(0.001)
+    elapsed = time.time()-t0
+    
+    s = server.node.getOutputStatistics()
+    c = client.node.getOutputStatistics()
+    client.stop(0.05)
+    server.stop(0.05)
+    print "%-16s %8.0f req/s  client %5.1f msgs/send  server %5.1f msgs/send"%(
+        name,per_thread*threads/elapsed,
+        float(c[0]-client_base[0])/max(c[1]-client_base[1],1),
+        float(s[0]-server_base[0])/max(s[1]-server_base[1],1))
+
+
+def main():
+    requests = 20000
+    if len(sys.argv)>1:
+        requests = int(sys.argv[1])
+    port = 13900
+    for name,cork_window in (("no corking",None),("window 0us",0),("window 200us",200),("window 1000us",1000)):
+        run(name,port,cork_window,4,requests)
+        port += 1
+
+if __name__=="__main__":
+    main()
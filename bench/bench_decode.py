@@ -0,0 +1,140 @@
+#!/usr/bin/python
+"""Message decoding benchmark.
+Compares the struct-based Message.decodeFrom() with the xdrlib.Unpacker
+based decoding loop it replaced, using a credit-control request of a
+realistic size. Also compares full and lazy decoding for the lookups a
+relay does.
+"""
+
+from diameter import *
+import xdrlib
+import time
+import sys
+
+
+def build_ccr(extra_avps=40):
+    msg = Message()
+    msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    msg.hdr.setRequest(True)
+    msg.hdr.setProxiable(True)
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,"client.example.net;1234567890;42"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"client.example.net"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,"example.net"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_DESTINATION_REALM,"example.net"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SERVICE_CONTEXT_ID,"32251@3gpp.org"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_TYPE,ProtocolConstants.DI_CC_REQUEST_TYPE_UPDATE_REQUEST))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_NUMBER,1))
+    for i in range(extra_avps):
+        msg.append(AVP_Grouped(ProtocolConstants.DI_MULTIPLE_SERVICES_CREDIT_CONTROL,[
+            AVP_Unsigned32(ProtocolConstants.DI_RATING_GROUP,i),
+            AVP_Grouped(ProtocolConstants.DI_USED_SERVICE_UNIT,[
+                AVP_Unsigned64(ProtocolConstants.DI_CC_INPUT_OCTETS,1000*i),
+                AVP_Unsigned64(ProtocolConstants.DI_CC_OUTPUT_OCTETS,2000*i)])]))
+        msg.append(AVP_UTF8String(10415+i,"some vendor-specific value",10415))
+    Utils.setMandatory_RFC3588(msg)
+    p = xdrlib.Packer()
+    msg.encode(p)
+    return p.get_buffer()
+
+
+def xdrlib_decode(raw):
+    "The xdrlib.Unpacker based decoding loop used before Message.decodeFrom()"
+    u = xdrlib.Unpacker(raw)
+    hdr = MessageHeader()
+    v_ml = u.unpack_uint()
+    hdr.version = v_ml>>24
+    f_code = u.unpack_uint()
+    hdr.command_flags = f_code>>24
+    hdr.command_code = f_code&0x00FFFFFF
+    hdr.application_id = u.unpack_uint()
+    hdr.hop_by_hop_identifier = u.unpack_uint()
+    hdr.end_to_end_identifier = u.unpack_uint()
+    avps = []
+    bytes_left = len(raw)-20
+    while bytes_left>0:
+        start = u.get_position()
+        u.set_position(start+4)
+        length = u.unpack_uint()&0x00FFFFFF
+        u.set_position(start)
+        avp_sz = (length+3)&~3
+        a = AVP(0,[])
+        a.code = u.unpack_uint()
+        flags_and_length = u.unpack_uint()
+        a.flags = flags_and_length>>24
+        length = (flags_and_length&0x00FFFFFF)-8
+        if (a.flags&AVP.avp_flag_vendor)!=0:
+            a.vendor_id = u.unpack_uint()
+            length -= 4
+        a.payload = u.unpack_fopaque(length)
+        avps.append(a)
+        bytes_left -= avp_sz
+    return avps
+
+
+def struct_decode(raw):
+    msg = Message()
+    msg.decodeFrom(raw,0,len(raw))
+    return msg.avp
+
+
+def lazy_decode(raw):
+    msg = Message()
+    msg.decodeFrom(raw,0,len(raw),lazy=True)
+    return msg
+
+
+def relay_lookups(msg):
+    "What a relay typically looks at"
+    msg.find(ProtocolConstants.DI_DESTINATION_REALM).payload
+    msg.find(ProtocolConstants.DI_AUTH_APPLICATION_ID).payload
+    for a in msg.subset(ProtocolConstants.DI_ROUTE_RECORD):
+        a.payload
+
+
+def full_relay_lookups(avps):
+    m = Message()
+    m.avp = avps
+    relay_lookups(m)
+
+
+def touch_some(avps):
+    for a in avps[:4]:
+        a.payload
+
+
+def touch_all(avps):
+    for a in avps:
+        a.payload
+
+
+def run(name,decoder,toucher,raw,iterations):
+    t0 = time.time()
+    for i in xrange(iterations):
+        toucher(decoder(raw))
+    elapsed = time.time()-t0
+    print "%-32s %8.1f us/message %8.0f messages/s"%(name,elapsed*1e6/iterations,iterations/elapsed)
+    return elapsed
+
+
+def main():
+    iterations = 5000
+    if len(sys.argv)>1:
+        iterations = int(sys.argv[1])
+    raw = build_ccr()
+    m = Message()
+    m.decodeFrom(raw,0,len(raw))
+    print "CCR: %d bytes, %d top-level AVPs, %d iterations"%(len(raw),len(m),iterations)
+    t_x = run("xdrlib, header+4 payloads",xdrlib_decode,touch_some,raw,iterations)
+    t_s = run("struct, header+4 payloads",struct_decode,touch_some,raw,iterations)
+    print "  speedup: %.2fx"%(t_x/t_s)
+    t_x = run("xdrlib, all payloads",xdrlib_decode,touch_all,raw,iterations)
+    t_s = run("struct, all payloads",struct_decode,touch_all,raw,iterations)
+    print "  speedup: %.2fx"%(t_x/t_s)
+    t_s = run("struct, relay lookups",struct_decode,full_relay_lookups,raw,iterations)
+    t_l = run("lazy, relay lookups",lazy_decode,relay_lookups,raw,iterations)
+    print "  speedup: %.2fx"%(t_s/t_l)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""Message encoding benchmark.
+Compares the single-pass Message.encodeToBuffer() with the
+xdrlib.Packer based encoding it replaced, and building+encoding a DWA
+from fresh AVPs with building it from pre-encoded AVPs.
+"""
+
+from diameter import *
+from diameter.node.NodeSettings import NodeSettings
+from diameter.node.Capability import Capability
+from diameter.node.NodeState import NodeState
+from diameter.node.EncodedAVPCache import EncodedAVPCache
+import xdrlib
+import time
+import sys
+
+
+def build_cca():
+    msg = Message()
+    msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    msg.hdr.setProxiable(True)
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,"client.example.net;1234567890;42"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"server.example.net"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,"example.net"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_TYPE,ProtocolConstants.DI_CC_REQUEST_TYPE_UPDATE_REQUEST))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_NUMBER,1))
+    for i in range(20):
+        msg.append(AVP_Grouped(ProtocolConstants.DI_MULTIPLE_SERVICES_CREDIT_CONTROL,[
+            AVP_Unsigned32(ProtocolConstants.DI_RATING_GROUP,i),
+            AVP_Grouped(ProtocolConstants.DI_GRANTED_SERVICE_UNIT,[
+                AVP_Unsigned64(ProtocolConstants.DI_CC_TOTAL_OCTETS,1000000)]),
+            AVP_Unsigned32(ProtocolConstants.DI_VALIDITY_TIME,3600)]))
+    Utils.setMandatory_RFC3588(msg)
+    return msg
+
+
+def xdrlib_encode(msg):
+    "The xdrlib.Packer based encoding used before Message.encodeToBuffer()"
+    p = xdrlib.Packer()
+    sz = msg.hdr.encodeSize()
+    for a in msg.avp:
+        sz += a.encodeSize()
+    msg.hdr.encode(p,sz)
+    for a in msg.avp:
+        a.encode(p)
+    return p.get_buffer()
+
+
+def buffer_encode(msg):
+    return msg.encodeToBuffer()
+
+
+class BenchNode:
+    "The parts of a Node that EncodedAVPCache uses"
+    def __init__(self):
+        cap = Capability()
+        cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+        self.settings = NodeSettings("server.example.net","example.net",99999,cap,3868,"bench",1)
+        self.node_state = NodeState()
+
+
+def dwa_fresh(node):
+    "A DWA built the way Node did before EncodedAVPCache"
+    dwa = Message()
+    dwa.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+    dwa.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,node.settings.host_id))
+    dwa.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,node.settings.realm))
+    dwa.append(AVP_Unsigned32(ProtocolConstants.DI_ORIGIN_STATE_ID, node.node_state.state_id))
+    Utils.setMandatory_RFC3588(dwa)
+    return dwa.encodeToBuffer()
+
+
+def dwa_cached(cache):
+    dwa = Message()
+    for a in cache.watchdogAnswer():
+        dwa.append(a)
+    return dwa.encodeToBuffer()
+
+
+def run(name,encoder,msg,iterations):
+    t0 = time.time()
+    for i in xrange(iterations):
+        encoder(msg)
+    elapsed = time.time()-t0
+    print "%-20s %8.1f us/message %8.0f messages/s"%(name,elapsed*1e6/iterations,iterations/elapsed)
+    return elapsed
+
+
+def main():
+    iterations = 10000
+    if len(sys.argv)>1:
+        iterations = int(sys.argv[1])
+    msg = build_cca()
+    assert xdrlib_encode(msg)==str(buffer_encode(msg))
+    print "CCA: %d bytes, %d top-level AVPs, %d iterations"%(msg.encodeSize(),len(msg),iterations)
+    t_x = run("xdrlib.Packer",xdrlib_encode,msg,iterations)
+    t_b = run("encodeToBuffer",buffer_encode,msg,iterations)
+    print "  speedup: %.2fx"%(t_x/t_b)
+    
+    node = BenchNode()
+    cache = EncodedAVPCache(node)
+    assert dwa_fresh(node)==dwa_cached(cache)
+    t_f = run("DWA, fresh AVPs",dwa_fresh,node,iterations)
+    t_c = run("DWA, pre-encoded",dwa_cached,cache,iterations)
+    print "  speedup: %.2fx"%(t_f/t_c)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+"""Executor benchmark.
+One peer sends requests that take 5ms to handle (eg. a database lookup)
+while another peer sends requests that are answered right away. Reports
+the latency of the fast requests with the handlers called by the
+networking thread and by an Executor, and the executor's queue wait
+statistics.
+"""
+
+from diameter import *
+from diameter.node import *
+import threading
+import logging
+import time
+import sys
+
+
+class Server(AsyncNodeManager):
+    def handleRequest(self,request,connkey,peer):
+        if request.find(ProtocolConstants.DI_USER_NAME):
+            time.sleep(0.005) #slow request
+        answer = Message()
+        answer.prepareResponse(request)
+        answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+        self.node.addOurHostAndRealm(answer)
+        return answer
+
+
+def make_request(node,slow):
+    req = Message()
+    req.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    req.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    req.hdr.setRequest(True)
+    req.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,node.makeNewSessionId()))
+    node.addOurHostAndRealm(req)
+    req.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    if slow:
+        req.append(AVP_UTF8String(ProtocolConstants.DI_USER_NAME,"slow"))
+    return req
+
+
+def connect(name,cap,peer):
+    client = AsyncNodeManager(NodeSettings(name,"example.net",9999,cap,0,"bench",1))
+    client.start()
+    client.node.initiateConnection(peer,True)
+    client.waitForConnection(5)
+    return client
+
+
+def run(name,port,executor,requests):
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+    server = Server(NodeSettings("127.0.0.1","example.net",9999,cap,port,"bench",1))
+    if executor:
+        server.setExecutor(executor)
+    server.start()
+    peer = Peer("127.0.0.1",port)
+    slow = connect("slow.example.net",cap,peer)
+    fast = connect("fast.example.net",cap,peer)
+    
+    stop = threading.Event()
+    def load():
+        window = threading.Semaphore(8)
+        while not stop.isSet():
+            window.acquire()
+            slow.sendRequest(make_request(slow.node,True),[peer]).addCallback(lambda future: window.release())
+    t = threading.Thread(target=load)
+    t.start()
+    time.sleep(0.2)
+    latencies = []
+    for i in xrange(requests):
+        start = time.time()
+        assert fast.sendRequest(make_request(fast.node,False),[peer]).getResult(10) is not None
+        latencies.append(time.time()-start)
+    stop.set()
+    t.join()
+    stats = server.getStatistics()
+    fast.stop(0.05)
+    slow.stop(0.05)
+    server.stop(0.05)
+    latencies.sort()
+    s = "%-20s fast p50 %7.2f ms p99 %7.2f ms"%(name,latencies[len(latencies)/2]*1000,latencies[len(latencies)*99/100]*1000)
+    if stats:
+        s += ", queue wait avg %.2f ms max %.2f ms"%(stats["wait_time"]*1000/max(stats["submitted"],1),stats["max_wait_time"]*1000)
+    print s
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    requests = 300
+    if len(sys.argv)>1:
+        requests = int(sys.argv[1])
+    run("networking thread",13980,None,requests)
+    run("Executor(8 threads)",13981,Executor(8,1000),requests)
+
+if __name__=="__main__":
+    main()
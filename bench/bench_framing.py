@@ -0,0 +1,91 @@
+#!/usr/bin/python
+"""Message framing benchmark.
+Splits a stream into messages the way Node used to (appending every
+received piece to one string and re-parsing the pending message each
+time) and with FrameDecoder, for a large message received in TCP-sized
+pieces and for many small messages received in 32KB reads.
+"""
+
+from diameter import *
+import time
+import sys
+
+
+def old_framing(pieces):
+    "How Node.__processInBuffer split the input before FrameDecoder"
+    in_buffer = ""
+    frames = 0
+    for piece in pieces:
+        in_buffer += piece
+        raw = in_buffer
+        raw_bytes = len(raw)
+        msg_start = 0
+        while msg_start<raw_bytes:
+            bytes_left = raw_bytes-msg_start
+            if bytes_left<4:
+                break
+            msg_size = Message.decodeSizeFrom(raw,msg_start)
+            if bytes_left<msg_size:
+                break
+            msg = Message()
+            msg.decodeFrom(raw,msg_start,msg_size,lazy=True)
+            msg_start += msg_size
+            frames += 1
+        in_buffer = in_buffer[msg_start:]
+    return frames
+
+
+def decoder_framing(pieces):
+    decoder = FrameDecoder()
+    frames = 0
+    for piece in pieces:
+        decoder.feed(piece)
+        for msg in decoder.messages():
+            frames += 1
+    return frames
+
+
+def split(raw,size):
+    return [raw[i:i+size] for i in xrange(0,len(raw),size)]
+
+
+def run(name,framer,pieces,frames,total_bytes):
+    t0 = time.time()
+    assert framer(pieces)==frames
+    elapsed = time.time()-t0
+    print "%-28s %8.1f ms %8.1f MB/s"%(name,elapsed*1e3,total_bytes/elapsed/1e6)
+    return elapsed
+
+
+def main():
+    size = 4*1024*1024
+    if len(sys.argv)>1:
+        size = int(sys.argv[1])
+    
+    msg = Message()
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_ACCOUNTING
+    msg.append(AVP_OctetString(ProtocolConstants.DI_CLASS,"x"*size))
+    raw = str(msg.encodeToBuffer())
+    pieces = split(raw,1460)
+    print "one %d byte message in %d pieces"%(len(raw),len(pieces))
+    t_o = run("old",old_framing,pieces,1,len(raw))
+    t_d = run("FrameDecoder",decoder_framing,pieces,1,len(raw))
+    print "  speedup: %.2fx"%(t_o/t_d)
+    
+    msg = Message()
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,"client.example.net;1234567890;42"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"server.example.net"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,"example.net"))
+    one = str(msg.encodeToBuffer())
+    count = size/len(one)
+    raw = one*count
+    pieces = split(raw,32768)
+    print "%d messages of %d bytes in %d pieces"%(count,len(one),len(pieces))
+    t_o = run("old",old_framing,pieces,count,len(raw))
+    t_d = run("FrameDecoder",decoder_framing,pieces,count,len(raw))
+    print "  speedup: %.2fx"%(t_o/t_d)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+"""Memory footprint benchmark.
+Reports the number of bytes used by a decoded credit-control request
+(header, AVP list, AVPs, payloads and the embedded AVPs of the grouped
+AVPs) and by an idle connection (Connection, its key, timers and
+buffers). The sizes are the sum of sys.getsizeof() over all objects
+reachable from the instance, not counting classes, None, booleans and
+small integers, which are shared.
+"""
+
+from diameter import *
+from diameter.node.Connection import Connection
+import types
+import sys
+
+
+_shared_types = (type,types.ClassType,types.ModuleType,types.FunctionType,
+                 types.BuiltinFunctionType,types.NoneType,bool)
+
+def _slots(obj):
+    names = []
+    for c in getattr(obj.__class__,"__mro__",()):
+        slots = c.__dict__.get("__slots__",())
+        if isinstance(slots,str):
+            slots = (slots,)
+        names.extend(slots)
+    return names
+
+def deep_sizeof(obj,seen=None):
+    "The size of obj and all objects reachable from it"
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj,_shared_types):
+        return 0
+    if isinstance(obj,int) and -5<=obj<=256:
+        return 0
+    seen.add(id(obj))
+    sz = sys.getsizeof(obj)
+    if isinstance(obj,dict):
+        for k,v in obj.iteritems():
+            sz += deep_sizeof(k,seen) + deep_sizeof(v,seen)
+    elif isinstance(obj,(list,tuple,set,frozenset)):
+        for x in obj:
+            sz += deep_sizeof(x,seen)
+    d = getattr(obj,"__dict__",None)
+    if isinstance(d,dict):
+        sz += deep_sizeof(d,seen)
+    for name in _slots(obj):
+        if name=="__dict__":
+            continue
+        try:
+            sz += deep_sizeof(object.__getattribute__(obj,name),seen)
+        except AttributeError:
+            pass
+    return sz
+
+
+def build_ccr():
+    "A CCR with 10 Multiple-Services-Credit-Control AVPs, 100 AVPs in total"
+    msg = Message()
+    msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    msg.hdr.setRequest(True)
+    msg.hdr.setProxiable(True)
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,"client.example.net;1234567890;42"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"client.example.net"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,"example.net"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_DESTINATION_REALM,"example.net"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SERVICE_CONTEXT_ID,"32251@3gpp.org"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_TYPE,ProtocolConstants.DI_CC_REQUEST_TYPE_UPDATE_REQUEST))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_CC_REQUEST_NUMBER,1))
+    msg.append(AVP_Grouped(ProtocolConstants.DI_SUBSCRIPTION_ID,[
+        AVP_Unsigned32(ProtocolConstants.DI_SUBSCRIPTION_ID_TYPE,0),
+        AVP_UTF8String(ProtocolConstants.DI_SUBSCRIPTION_ID_DATA,"4790000000")]))
+    for i in range(10):
+        msg.append(AVP_Grouped(ProtocolConstants.DI_MULTIPLE_SERVICES_CREDIT_CONTROL,[
+            AVP_Unsigned32(ProtocolConstants.DI_RATING_GROUP,i),
+            AVP_Unsigned32(ProtocolConstants.DI_SERVICE_IDENTIFIER,i),
+            AVP_Grouped(ProtocolConstants.DI_REQUESTED_SERVICE_UNIT,[
+                AVP_Unsigned64(ProtocolConstants.DI_CC_TOTAL_OCTETS,1000000)]),
+            AVP_Grouped(ProtocolConstants.DI_USED_SERVICE_UNIT,[
+                AVP_Unsigned64(ProtocolConstants.DI_CC_INPUT_OCTETS,1000),
+                AVP_Unsigned64(ProtocolConstants.DI_CC_OUTPUT_OCTETS,2000)])]))
+    Utils.setMandatory_RFC3588(msg)
+    return str(msg.encodeToBuffer())
+
+
+def decode_all(raw):
+    "Decode the message and all payloads and grouped AVPs in it"
+    msg = Message()
+    msg.decodeFrom(raw,0,len(raw))
+    count = [0]
+    def walk(avps):
+        for i in xrange(len(avps)):
+            a = avps[i]
+            count[0] += 1
+            a.payload
+            if a.code in (ProtocolConstants.DI_SUBSCRIPTION_ID,
+                          ProtocolConstants.DI_MULTIPLE_SERVICES_CREDIT_CONTROL,
+                          ProtocolConstants.DI_REQUESTED_SERVICE_UNIT,
+                          ProtocolConstants.DI_USED_SERVICE_UNIT):
+                g = AVP_Grouped.narrow(a)
+                avps[i] = g
+                walk(g.getAVPs())
+    walk(msg.avp)
+    return msg,count[0]
+
+
+def main():
+    raw = build_ccr()
+    msg,avps = decode_all(raw)
+    sz = deep_sizeof(msg)
+    print "CCR: %d bytes on the wire, %d AVPs"%(len(raw),avps)
+    print "decoded message   %8d bytes  %6.1f bytes/AVP"%(sz,float(sz)/avps)
+    sz = deep_sizeof(Connection())
+    print "idle connection   %8d bytes"%sz
+
+if __name__=="__main__":
+    main()
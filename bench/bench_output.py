@@ -0,0 +1,118 @@
+#!/usr/bin/python
+"""Output queue benchmark.
+Queues a burst of encoded messages for a connection and flushes them
+through a loopback TCP connection that another thread drains. Compares appending
+every message to one bytearray and deleting what was sent from its
+front (as NormalConnectionBuffers used to do) with ByteBuffer and with
+NormalConnectionBuffers, which copies small messages into a tail buffer
+and queues large ones by reference.
+"""
+
+from diameter import *
+from diameter.node.ConnectionBuffers import NormalConnectionBuffers
+import threading
+import socket
+import select
+import errno
+import time
+import sys
+
+
+class BytearrayOutput:
+    "The output buffer of NormalConnectionBuffers before ByteBuffer"
+    def __init__(self):
+        self.out_buffer = bytearray()
+    def appendAppOutputBuffer(self,stuff):
+        self.out_buffer += stuff
+    def hasNetOutput(self):
+        return len(self.out_buffer)!=0
+    def getNetOutBuffer(self):
+        return self.out_buffer
+    def consumeNetOutBuffer(self,bytes):
+        del self.out_buffer[:bytes]
+
+
+class ByteBufferOutput:
+    def __init__(self):
+        self.out_buffer = ByteBuffer()
+    def appendAppOutputBuffer(self,stuff):
+        self.out_buffer.append(stuff)
+    def hasNetOutput(self):
+        return len(self.out_buffer)!=0
+    def getNetOutBuffer(self):
+        return self.out_buffer.readable()
+    def consumeNetOutBuffer(self,bytes):
+        self.out_buffer.consume(bytes)
+
+
+def drain(sock,total,done):
+    left = total
+    while left>0:
+        left -= len(sock.recv(262144))
+    done.set()
+
+
+def tcp_pair():
+    l = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    l.bind(("127.0.0.1",0))
+    l.listen(1)
+    a = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    #a fixed send buffer, so bursts take several sends
+    a.setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,65536)
+    a.connect(l.getsockname())
+    b = l.accept()[0]
+    l.close()
+    a.setblocking(False)
+    return a,b
+
+
+def run(name,buffers_class,messages,bursts):
+    a,b = tcp_pair()
+    total = sum([len(m) for m in messages])*bursts
+    done = threading.Event()
+    t = threading.Thread(target=drain,args=(b,total,done))
+    t.start()
+    sends = 0
+    t0 = time.time()
+    for i in xrange(bursts):
+        buffers = buffers_class()
+        for m in messages:
+            buffers.appendAppOutputBuffer(m)
+        while buffers.hasNetOutput():
+            select.select([],[a],[])
+            try:
+                buffers.consumeNetOutBuffer(a.send(buffers.getNetOutBuffer()))
+            except socket.error, (err,errstr):
+                if err!=errno.EAGAIN:
+                    raise
+            sends += 1
+    done.wait()
+    elapsed = time.time()-t0
+    t.join()
+    a.close()
+    b.close()
+    print "%-24s %8.2f us/message %6.1f messages/send"%(name,elapsed*1e6/(len(messages)*bursts),float(len(messages)*bursts)/sends)
+
+
+def encoded_answer(size):
+    msg = Message()
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,"client.example.net;1234567890;42"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+    msg.append(AVP_OctetString(ProtocolConstants.DI_CLASS,"c"*size))
+    return msg.encodeToBuffer()
+
+
+def main():
+    bursts = 200
+    if len(sys.argv)>1:
+        bursts = int(sys.argv[1])
+    for count,size in ((500,100),(20,256*1024)):
+        messages = [encoded_answer(size) for i in xrange(count)]
+        print "%d messages of %d bytes per burst, %d bursts"%(count,len(messages[0]),bursts)
+        run("bytearray",BytearrayOutput,messages,bursts)
+        run("ByteBuffer",ByteBufferOutput,messages,bursts)
+        run("NormalConnectionBuffers",NormalConnectionBuffers,messages,bursts)
+
+if __name__=="__main__":
+    main()
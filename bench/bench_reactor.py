@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""Reactor wakeup benchmark.
+Measures the cost of one wakeup with one active connection and many idle
+ones, the way Node used to poll (rebuilding the fd lists from all the
+connections and calling select.select()) and with the persistent
+registrations of the pollers. select() cannot go beyond FD_SETSIZE
+(1024) file descriptors, so it is only measured up to that.
+"""
+
+from diameter.node.Connection import Connection
+from diameter.node.Poller import *
+import resource
+import socket
+import select
+import time
+import sys
+
+
+def old_wakeup(conns,active):
+    "How Node.run_select polled before the pollers"
+    iwtd = []
+    owtd = []
+    for conn in conns.itervalues():
+        if conn.state!=Connection.state_closed:
+            iwtd.append(conn.fd)
+        if conn.hasNetOutput() or conn.state==Connection.state_connecting:
+            owtd.append(conn.fd)
+    r,w,x = select.select(iwtd,owtd,[])
+    return len(r)
+
+
+def run(name,wakeup,idle,iterations):
+    pairs = []
+    conns = {}
+    for i in xrange(idle+1):
+        a,b = socket.socketpair()
+        pairs.append((a,b))
+        conn = Connection()
+        conn.fd = a
+        conns[conn.key] = conn
+    active = pairs[-1]
+    poller = None
+    if wakeup is not old_wakeup:
+        poller = wakeup()
+        for conn in conns.itervalues():
+            poller.register(conn.fd,EVENT_READ,conn)
+    active[1].send("x")
+    t0 = time.time()
+    for i in xrange(iterations):
+        if poller:
+            n = len(poller.poll())
+        else:
+            n = old_wakeup(conns,active)
+        assert n==1
+    elapsed = time.time()-t0
+    if poller:
+        poller.close()
+    for a,b in pairs:
+        a.close()
+        b.close()
+    print "%-14s %6d idle %10.1f us/wakeup"%(name,idle,elapsed*1e6/iterations)
+
+
+def main():
+    iterations = 2000
+    if len(sys.argv)>1:
+        iterations = int(sys.argv[1])
+    soft,hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE,(hard,hard))
+    except ValueError:
+        pass
+    max_idle = min(10000,resource.getrlimit(resource.RLIMIT_NOFILE)[0]/2-100)
+    kinds = [("select",old_wakeup),("SelectPoller",SelectPoller)]
+    if hasattr(select,"poll"):
+        kinds.append(("PollPoller",PollPoller))
+    if hasattr(select,"epoll"):
+        kinds.append(("EpollPoller",EpollPoller))
+    for idle in (10,100,500,1000,10000):
+        if idle>max_idle:
+            print "skipping %d idle connections: too few file descriptors"%idle
+            continue
+        for name,wakeup in kinds:
+            if idle>500 and name in ("select","SelectPoller"):
+                continue
+            run(name,wakeup,idle,iterations)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+"""Reactor isolation benchmark.
+A few heavy peers keep large requests outstanding against a server node
+while a light peer sends small requests one at a time. Reports the
+latency of the light peer and the request rate of the heavy peers with
+the server running one reactor and several reactors.
+"""
+
+from diameter import *
+from diameter.node import *
+import threading
+import logging
+import time
+import sys
+
+
+class Server(AsyncNodeManager):
+    def handleRequest(self,request,connkey,peer):
+        answer = Message()
+        answer.prepareResponse(request)
+        answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+        self.node.addOurHostAndRealm(answer)
+        return answer
+
+
+def make_request(node,payload):
+    req = Message()
+    req.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    req.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    req.hdr.setRequest(True)
+    node.addOurHostAndRealm(req)
+    req.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    if payload:
+        req.append(AVP_OctetString(ProtocolConstants.DI_USER_NAME,"x"*payload))
+    return req
+
+
+def connect(name,cap,peer):
+    client = AsyncNodeManager(NodeSettings(name,"example.net",9999,cap,0,"bench",1))
+    client.start()
+    client.node.initiateConnection(peer,True)
+    client.waitForConnection(5)
+    return client
+
+
+def heavy(client,peer,window,payload,stop,count):
+    slots = threading.Semaphore(window)
+    def answer(future):
+        count[0] += 1
+        slots.release()
+    while not stop.isSet():
+        slots.acquire()
+        client.sendRequest(make_request(client.node,payload),[peer]).addCallback(answer)
+
+
+def run(reactors,port,heavy_peers,requests):
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+    settings = NodeSettings("127.0.0.1","example.net",9999,cap,port,"bench",1)
+    settings.setReactors(reactors)
+    server = Server(settings)
+    server.start()
+    peer = Peer("127.0.0.1",port)
+    light = connect("light.example.net",cap,peer)
+    clients = [connect("heavy%d.example.net"%i,cap,peer) for i in range(heavy_peers)]
+    
+    stop = threading.Event()
+    count = [0]
+    threads = [threading.Thread(target=heavy,args=(client,peer,20,32768,stop,count)) for client in clients]
+    for t in threads:
+        t.start()
+    time.sleep(0.5)
+    t0 = time.time()
+    c0 = count[0]
+    latencies = []
+    for i in xrange(requests):
+        start = time.time()
+        assert light.sendRequest(make_request(light.node,0),[peer]).getResult(10) is not None
+        latencies.append(time.time()-start)
+    elapsed = time.time()-t0
+    heavy_rate = (count[0]-c0)/elapsed
+    stop.set()
+    for t in threads:
+        t.join()
+    for client in clients:
+        client.stop(0.05)
+    light.stop(0.05)
+    server.stop(0.05)
+    latencies.sort()
+    print "%2d reactors: light p50 %7.2f ms p99 %7.2f ms, heavy %6.0f req/s"%(
+        reactors,latencies[len(latencies)/2]*1000,latencies[len(latencies)*99/100]*1000,heavy_rate)
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    requests = 500
+    if len(sys.argv)>1:
+        requests = int(sys.argv[1])
+    port = 13940
+    for reactors in (1,2,4):
+        run(reactors,port,3,requests)
+        port += 1
+
+if __name__=="__main__":
+    main()
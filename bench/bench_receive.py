@@ -0,0 +1,121 @@
+#!/usr/bin/python
+"""Receive path benchmark.
+Another thread streams messages through a loopback TCP connection, and
+the receiving side waits in select() and splits the stream into messages
+the way Node used to (one recv(32768) into a new string per wakeup) and
+the way it does now (recv_into() the decoder of the connection with an
+adaptive read size, until the socket is drained or the read budget is
+used up). Reports the time and the select() wakeups and recv() calls
+per megabyte.
+"""
+
+from diameter import *
+from diameter.node.Connection import Connection
+from diameter.node.Node import Node
+import threading
+import socket
+import select
+import time
+import sys
+
+
+def old_receive(conn):
+    "How Node.__handleReadable read before recv_into()"
+    stuff = conn.fd.recv(32768)
+    if len(stuff)==0:
+        return 1,True
+    conn.appendNetInBuffer(stuff)
+    return 1,False
+
+
+def new_receive(conn):
+    "What Node.__handleReadable does now"
+    decoder = conn.decoder
+    budget = Node.read_budget
+    calls = 0
+    while budget>0:
+        size = conn.read_size
+        bytes = conn.fd.recv_into(decoder.writable(size),size)
+        calls += 1
+        if bytes==0:
+            return calls,True
+        decoder.commit(bytes)
+        conn.adjustReadSize(bytes)
+        budget -= bytes
+        if bytes<size:
+            break
+    return calls,False
+
+
+def send_all(sock,chunk,count):
+    for i in xrange(count):
+        sock.sendall(chunk)
+    sock.close()
+
+
+def tcp_pair():
+    l = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    l.bind(("127.0.0.1",0))
+    l.listen(1)
+    a = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    a.connect(l.getsockname())
+    b = l.accept()[0]
+    l.close()
+    b.setblocking(False)
+    return a,b
+
+
+def run(name,receive,chunk,count,messages):
+    a,b = tcp_pair()
+    conn = Connection()
+    conn.fd = b
+    t = threading.Thread(target=send_all,args=(a,chunk,count))
+    wakeups = 0
+    calls = 0
+    got = 0
+    t0 = time.time()
+    t.start()
+    closed = False
+    while not closed:
+        select.select([b],[],[])
+        wakeups += 1
+        c,closed = receive(conn)
+        calls += c
+        for msg in conn.decoder.messages():
+            got += 1
+    elapsed = time.time()-t0
+    t.join()
+    b.close()
+    assert got==messages
+    mb = len(chunk)*count/1e6
+    print "%-8s %8.1f ms %8.1f wakeups/MB %8.1f recv/MB"%(name,elapsed*1e3,wakeups/mb,calls/mb)
+    return elapsed
+
+
+def main():
+    size = 64*1024*1024
+    if len(sys.argv)>1:
+        size = int(sys.argv[1])
+    
+    msg = Message()
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,"client.example.net;1234567890;42"))
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"server.example.net"))
+    msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,"example.net"))
+    small = str(msg.encodeToBuffer())
+    msg = Message()
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_ACCOUNTING
+    msg.append(AVP_OctetString(ProtocolConstants.DI_CLASS,"x"*(1024*1024)))
+    large = str(msg.encodeToBuffer())
+    
+    for one,per_chunk in ((small,1024),(large,1)):
+        chunk = one*per_chunk
+        count = max(size/len(chunk),1)
+        print "%d messages of %d bytes"%(count*per_chunk,len(one))
+        t_o = run("old",old_receive,chunk,count,count*per_chunk)
+        t_n = run("new",new_receive,chunk,count,count*per_chunk)
+        print "  speedup: %.2fx"%(t_o/t_n)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+"""Connection lookup benchmark.
+Looks up the connection to a peer among 10, 1000 and 10000 ready
+connections, by scanning all connections (as Node.findConnection did) and
+with the peer index of a ConnectionRegistry.
+"""
+
+from diameter.node.Connection import Connection
+from diameter.node.ConnectionRegistry import ConnectionRegistry
+from diameter.node.Peer import Peer
+import time
+import sys
+
+
+class FakeSocket:
+    def __init__(self,fd):
+        self.fd = fd
+    def fileno(self):
+        return self.fd
+
+
+def scan(conns,peer):
+    for connkey,conn in conns.iteritems():
+        if conn.peer and conn.peer==peer:
+            return connkey
+    return None
+
+
+def main():
+    lookups = 1000
+    if len(sys.argv)>1:
+        lookups = int(sys.argv[1])
+    for count in (10,1000,10000):
+        registry = ConnectionRegistry()
+        conns = {}
+        for i in xrange(count):
+            conn = Connection()
+            conn.fd = FakeSocket(i)
+            conn.peer = Peer("peer%d.example.net"%i)
+            conn.host_id = conn.peer.host
+            conn.state = Connection.state_ready
+            registry.add(conn)
+            conns[conn.key] = conn
+        peers = [Peer("peer%d.example.net"%(i*7919%count)) for i in xrange(lookups)]
+        start = time.time()
+        for peer in peers:
+            scan(conns,peer)
+        t_scan = (time.time()-start)/lookups
+        start = time.time()
+        for peer in peers:
+            registry.findByPeer(peer,True)
+        t_index = (time.time()-start)/lookups
+        print "%5d connections: scan %9.2f us, index %5.2f us per lookup"%(count,t_scan*1e6,t_index*1e6)
+
+if __name__=="__main__":
+    main()
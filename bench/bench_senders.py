@@ -0,0 +1,116 @@
+#!/usr/bin/python
+"""Concurrent sender benchmark.
+1, 2, 4 and 8 application threads send requests with a large AVP as fast
+as they can, each on its own connection of one client node, while another
+thread measures the round-trip time of probe requests on a connection of
+its own. Reports the send rate and the probe latency, which shows how
+much the reactor of the client is stalled by the senders.
+"""
+
+from diameter import *
+from diameter.node import *
+import threading
+import logging
+import time
+import sys
+
+
+class Server(NodeManager):
+    def __init__(self,settings):
+        NodeManager.__init__(self,settings)
+        self.received = 0
+    
+    def handleRequest(self,request,connkey,peer):
+        self.received += 1
+        if not request.find(ProtocolConstants.DI_USER_NAME):
+            return #bulk requests are not answered
+        answer = Message()
+        answer.prepareResponse(request)
+        answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+        self.node.addOurHostAndRealm(answer)
+        self.answer(answer,connkey)
+
+
+def make_request(node,probe):
+    req = Message()
+    req.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    req.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    req.hdr.setRequest(True)
+    req.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,node.makeNewSessionId()))
+    node.addOurHostAndRealm(req)
+    req.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    if probe:
+        req.append(AVP_UTF8String(ProtocolConstants.DI_USER_NAME,"probe"))
+    else:
+        for i in range(20):
+            req.append(AVP_OctetString(ProtocolConstants.DI_PROXY_INFO,"x"*100))
+    return req
+
+
+def run(threads,port,messages):
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+    client = AsyncNodeManager(NodeSettings("client.example.net","example.net",9999,cap,0,"bench",1))
+    client.start()
+    node = client.node
+    #one server per connection, the first one for the probes
+    servers = []
+    peers = []
+    for i in range(threads+1):
+        server = Server(NodeSettings("server%d.example.net"%i,"example.net",9999,cap,port+i,"bench",1))
+        server.start()
+        servers.append(server)
+        node.initiateConnection(Peer("127.0.0.1",port+i),True)
+        #the peer of a connection is known by its host id after the
+        #capability exchange
+        peers.append(Peer("server%d.example.net"%i,port+i))
+    connkeys = []
+    for peer in peers:
+        while node.findConnection(peer) is None:
+            time.sleep(0.01)
+        connkeys.append(node.findConnection(peer))
+    
+    stop = threading.Event()
+    latencies = []
+    def probe():
+        while not stop.isSet():
+            start = time.time()
+            client.sendRequest(make_request(node,True),peers[0:1]).getResult(10)
+            latencies.append(time.time()-start)
+            time.sleep(0.005)
+    def send(connkey):
+        for i in xrange(messages/threads):
+            req = make_request(node,False)
+            req.hdr.hop_by_hop_identifier = node.nextHopByHopIdentifier(connkey)
+            req.hdr.end_to_end_identifier = node.nextEndToEndIdentifier()
+            node.sendMessage(req,connkey)
+    prober = threading.Thread(target=probe)
+    prober.start()
+    senders = [threading.Thread(target=send,args=(connkey,)) for connkey in connkeys[1:]]
+    start = time.time()
+    for t in senders:
+        t.start()
+    for t in senders:
+        t.join()
+    elapsed = time.time()-start
+    stop.set()
+    prober.join()
+    client.stop(0.05)
+    for server in servers:
+        server.stop(0.05)
+    latencies.sort()
+    print "%d sender threads: %7.0f msg/s, probe p50 %6.2f ms p99 %6.2f ms"%(threads,messages/elapsed,latencies[len(latencies)/2]*1000,latencies[len(latencies)*99/100]*1000)
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    messages = 20000
+    if len(sys.argv)>1:
+        messages = int(sys.argv[1])
+    port = 13990
+    for threads in (1,2,4,8):
+        run(threads,port,messages)
+        port += threads+1
+
+if __name__=="__main__":
+    main()
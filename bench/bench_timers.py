@@ -0,0 +1,64 @@
+#!/usr/bin/python
+"""Connection timer benchmark.
+Measures the cost of one reactor loop iteration's timer handling with
+10000 idle connections: scanning every connection for its next timeout
+and due action (as the reactor did before timers were scheduled on a
+heap), and checking the heap of a Reactor.
+"""
+
+from diameter.node.Connection import Connection
+from diameter.node.Reactor import Reactor
+import time
+import sys
+
+
+def scan(conns,now):
+    timeout = None
+    for conn in conns:
+        ready = (conn.state==Connection.state_ready)
+        conn_timeout = conn.timers.calcNextTimeout(ready)
+        if conn_timeout and ((not timeout) or conn_timeout<timeout):
+            timeout = conn_timeout
+    for conn in conns:
+        conn.timers.calcAction(conn.state==Connection.state_ready,now)
+    return timeout
+
+
+def heap(reactor,now):
+    reactor.now = now
+    for conn in reactor.expiredTimers():
+        reactor.scheduleTimers(conn)
+    return reactor.nextTimer()
+
+
+def main():
+    count = 10000
+    iterations = 200
+    if len(sys.argv)>1:
+        count = int(sys.argv[1])
+    reactor = Reactor(0)
+    conns = []
+    for i in xrange(count):
+        conn = Connection()
+        conn.state = Connection.state_ready
+        reactor.scheduleTimers(conn)
+        conns.append(conn)
+    now = reactor.now
+    
+    start = time.time()
+    for i in xrange(iterations):
+        scan(conns,now)
+    t_scan = (time.time()-start)/iterations
+    
+    start = time.time()
+    for i in xrange(iterations):
+        heap(reactor,now)
+    t_heap = (time.time()-start)/iterations
+    reactor.close()
+    
+    print "%d connections, per loop iteration:"%count
+    print "  full scan %10.1f us"%(t_scan*1e6)
+    print "  heap      %10.1f us"%(t_heap*1e6)
+
+if __name__=="__main__":
+    main()
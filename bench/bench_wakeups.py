@@ -0,0 +1,76 @@
+#!/usr/bin/python
+"""Reactor wake-up benchmark.
+4 application threads send requests on one connection as fast as they
+can, without and with a cork window. Reports how many times the reactor
+of the client node was woken by them and how many wake-ups were avoided
+because the reactor was busy or had been woken already.
+"""
+
+from diameter import *
+from diameter.node import *
+import threading
+import logging
+import time
+import sys
+
+
+class Sink:
+    def handle_connection(self,connkey,peer,updown):
+        pass
+    def handle_message(self,msg,connkey,peer):
+        return True
+
+
+def make_request(node,connkey):
+    req = Message()
+    req.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    req.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    req.hdr.hop_by_hop_identifier = node.nextHopByHopIdentifier(connkey)
+    req.hdr.end_to_end_identifier = node.nextEndToEndIdentifier()
+    req.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,node.makeNewSessionId()))
+    node.addOurHostAndRealm(req)
+    req.append(AVP_OctetString(ProtocolConstants.DI_PROXY_INFO,"x"*500))
+    return req
+
+
+def run(name,port,cork_window,messages):
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+    server = Node(Sink(),Sink(),NodeSettings("server.example.net","example.net",9999,cap,port,"bench",1))
+    server.start()
+    settings = NodeSettings("client.example.net","example.net",9999,cap,0,"bench",1)
+    settings.setCorkWindow(cork_window)
+    client = Node(Sink(),Sink(),settings)
+    client.start()
+    client.initiateConnection(Peer("127.0.0.1",port))
+    client.waitForConnection(5)
+    connkey = client.findConnection(Peer("server.example.net",port))
+    
+    def send():
+        for i in xrange(messages/4):
+            client.sendMessage(make_request(client,connkey),connkey)
+    senders = [threading.Thread(target=send) for i in range(4)]
+    start = time.time()
+    for t in senders:
+        t.start()
+    for t in senders:
+        t.join()
+    elapsed = time.time()-start
+    wakeups,avoided = client.getWakeupStatistics()
+    sent,send_calls = client.getOutputStatistics()
+    client.stop(0.05)
+    server.stop(0.05)
+    print "%-22s %7.0f msg/s, %6d send() calls, %6d wake-ups, %6d avoided"%(name,messages/elapsed,send_calls,wakeups,avoided)
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    messages = 20000
+    if len(sys.argv)>1:
+        messages = int(sys.argv[1])
+    run("no cork window",13950,None,messages)
+    run("cork window 200us",13951,200,messages)
+    run("cork window 2000us",13952,2000,messages)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""Worker process scaling benchmark.
+Runs a server node in 1, 2 and 4 worker processes with Launcher, and
+loads it from several client processes, each keeping a window of
+credit-control requests outstanding for a few seconds. Reports the
+request rate. The rate can only scale with the number of workers if
+there are CPUs for both the workers and the clients.
+"""
+
+from diameter import *
+from diameter.node import *
+import threading
+import logging
+import time
+import os
+import sys
+
+
+class Server(AsyncNodeManager):
+    def handleRequest(self,request,connkey,peer):
+        answer = Message()
+        answer.prepareResponse(request)
+        answer.copyAVP(request,ProtocolConstants.DI_SESSION_ID)
+        answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+        self.node.addOurHostAndRealm(answer)
+        return answer
+
+
+def make_request(node):
+    req = Message()
+    req.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_CC
+    req.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL
+    req.hdr.setRequest(True)
+    req.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,node.makeNewSessionId()))
+    node.addOurHostAndRealm(req)
+    req.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    return req
+
+
+def client(index,cap,port,duration,fd):
+    "Runs in a client process. Writes the number of answers to fd"
+    manager = AsyncNodeManager(NodeSettings("client%d.example.net"%index,"example.net",9999,cap,0,"bench",1))
+    manager.start()
+    peer = Peer("127.0.0.1",port)
+    manager.node.initiateConnection(peer,True)
+    manager.waitForConnection(10)
+    slots = threading.Semaphore(50)
+    count = [0]
+    def answer(future):
+        count[0] += 1
+        slots.release()
+    end = time.time()+duration
+    while time.time()<end:
+        slots.acquire()
+        manager.sendRequest(make_request(manager.node),[peer]).addCallback(answer)
+    os.write(fd,"%d\n"%count[0])
+    manager.stop(0.05)
+
+
+def run(workers,port,clients,duration):
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+    launcher = Launcher(NodeSettings("127.0.0.1","example.net",9999,cap,port,"bench",1),workers,Server,0.05)
+    launcher.start()
+    while None in launcher.getWorkerStatistics():
+        time.sleep(0.1)
+    pipes = []
+    for i in range(clients):
+        r,w = os.pipe()
+        if os.fork()==0:
+            os.close(r)
+            client(i,cap,port,duration,w)
+            os._exit(0)
+        os.close(w)
+        pipes.append(r)
+    answers = 0
+    for r in pipes:
+        answers += int(os.read(r,100) or 0)
+        os.close(r)
+        os.wait()
+    stats = launcher.getStatistics()
+    launcher.stop()
+    print "%d workers: %8.0f req/s (%d connections)"%(workers,answers/float(duration),stats["connections"])
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    duration = 5
+    if len(sys.argv)>1:
+        duration = int(sys.argv[1])
+    print "%d CPUs"%os.sysconf("SC_NPROCESSORS_ONLN")
+    port = 13960
+    for workers in (1,2,4):
+        run(workers,port,4,duration)
+        port += 1
+
+if __name__=="__main__":
+    main()
@@ -1,7 +1,29 @@
 from xdrlib import Packer,Unpacker
 import binascii
+import struct
 
-class AVP:
+_avp_header = struct.Struct("!II")
+_avp_header_vendor = struct.Struct("!III")
+_uint32 = struct.Struct("!I")
+_padding = "\0\0\0"
+
+#Codes of the non-vendor-specific AVPs, and (code,vendor_id) of the
+#vendor-specific AVPs, that get the M-bit set when constructed.
+#Maintained by AVPDictionary.register()
+_mandatory_codes = set()
+_mandatory_vendor_codes = set()
+
+def _slotNames(cls):
+    """Returns the names of the slots of cls and its base classes, base classes first"""
+    names = []
+    for c in reversed(cls.__mro__):
+        slots = c.__dict__.get("__slots__",())
+        if isinstance(slots,str):
+            slots = (slots,)
+        names.extend(slots)
+    return names
+
+class AVP(object):
     """A Diameter AVP
     See RFC3588 section 4 for details.
     An AVP consists of a code, some flags, an optional vendor ID, and a payload.
@@ -21,26 +43,102 @@ class AVP:
         vendor_id (int)     The vendor ID. Assigning directly to this has the delayed effect of of setting/unsetting the vendor flag bit
         payload
     
-    See also: ProtocolConstants
+    AVPs registered as mandatory in AVPDictionary get the M-bit set when
+    they are constructed.
+    
+    See also: ProtocolConstants, AVPDictionary
     """
     
     avp_flag_vendor        = 0x80
     avp_flag_mandatory     = 0x40
     avp_flag_private       = 0x20
     
+    #AVPs are numerous so they have no per-instance __dict__.
+    #_payload_src is the (buffer,start,end) of a payload that has not been
+    #copied out of the receive buffer yet, and _view is the view returned
+    #by the last narrow() of this AVP to a subclass
+    __slots__ = ("code","flags","vendor_id","payload","_payload_src","_view")
+    
     def __init__(self,code=0,payload="",vendor_id=0):
         self.payload = payload
+        self._view = None
         self.code = code
-        self.flags = 0
         self.vendor_id = vendor_id
+        if vendor_id==0:
+            if code in _mandatory_codes:
+                self.flags = AVP.avp_flag_mandatory
+            else:
+                self.flags = 0
+        elif (code,vendor_id) in _mandatory_vendor_codes:
+            self.flags = AVP.avp_flag_mandatory
+        else:
+            self.flags = 0
+    
+    def __getattr__(self,name):
+        #The payload of a decoded AVP is only copied out of the receive
+        #buffer when it is accessed the first time
+        if name!="payload":
+            raise AttributeError(name)
+        buf,start,end = self._payload_src
+        payload = buf[start:end]
+        if not isinstance(payload,str):
+            payload = memoryview(payload).tobytes()
+        self.payload = payload
+        del self._payload_src
+        return payload
+    
+    def __getstate__(self):
+        #copies and pickles must not reference the receive buffer
+        self.payload
+        state = {}
+        for name in _slotNames(self.__class__):
+            if name in ("_payload_src","_view"):
+                continue
+            try:
+                state[name] = getattr(self,name)
+            except AttributeError:
+                pass
+        if hasattr(self,"__dict__"):
+            state.update(self.__dict__)
+        return state
+    
+    def __setstate__(self,state):
+        self._view = None
+        slots = _slotNames(self.__class__)
+        for name in slots:
+            if name in state:
+                setattr(self,name,state[name])
+        for name,value in state.iteritems():
+            if name not in slots:
+                setattr(self,name,value)
+    
+    def cachedView(self,cls):
+        """Returns the view of this AVP created by cls.narrow(), if any.
+        The view is only returned if it is still identical to this AVP.
+        Subclasses use this so narrowing the same AVP repeatedly does not
+        create new instances.
+        Returns the view, or None
+        """
+        view = self._view
+        if view is not None and view.__class__ is cls and \
+           view.payload is self.payload and \
+           view.code==self.code and \
+           view.flags==self.flags and \
+           view.vendor_id==self.vendor_id:
+            return view
+        return None
     
     def decodeSize(unpacker,bytes):
-        start = unpacker.get_position()
+        return AVP.decodeSizeFrom(unpacker.get_buffer(),unpacker.get_position(),bytes)
+    decodeSize = staticmethod(decodeSize)
+    
+    def decodeSizeFrom(buf,offset,bytes):
+        """Determine the size of the AVP at buf[offset:]
+        Returns the padded size of the AVP, or 0 if the AVP header is garbage
+        """
         if bytes<8:
             return 0
-        unpacker.set_position(start+4)
-        flags_and_length = unpacker.unpack_uint()
-        unpacker.set_position(start)
+        flags_and_length = _uint32.unpack_from(buf,offset+4)[0]
         flags_ = (flags_and_length>>24)
         length = (flags_and_length&0x00FFFFFF)
         padded_length = ((length+3)&~3)
@@ -51,34 +149,117 @@ class AVP:
             if length<8:
                 return 0  #garbage
         return padded_length;
-    decodeSize = staticmethod(decodeSize)
+    decodeSizeFrom = staticmethod(decodeSizeFrom)
     
     def decode(self,unpacker,bytes):
+        start = unpacker.get_position()
+        if not self.decodeFrom(unpacker.get_buffer(),start,bytes):
+            return False
+        unpacker.set_position(start+bytes)
+        return True
+    
+    def decodeFrom(self,buf,offset,bytes):
+        """Decode the AVP occupying buf[offset:offset+bytes]
+        The payload is not copied until it is accessed, so buf must not
+        be modified while the AVP is alive.
+        Returns True on success
+        """
         if bytes<8:
             return False
-        i = 0
-        self.code = unpacker.unpack_uint()
-        i += 4
-        flags_and_length = unpacker.unpack_uint()
-        i += 4
-        self.flags = (flags_and_length>>24)
+        code,flags_and_length = _avp_header.unpack_from(buf,offset)
+        flags = flags_and_length>>24
         length = flags_and_length&0x00FFFFFF
         padded_length = ((length+3)&~3)
         if bytes!=padded_length:
             return False
-        length -= 8
-        if (self.flags&AVP.avp_flag_vendor)!=0:
-            if length<4:
+        start = offset+8
+        if (flags&AVP.avp_flag_vendor)!=0:
+            if length<12:
                 return False
-            self.vendor_id = unpacker.unpack_uint()
-            i += 4
-            length -= 4
+            self.vendor_id = _uint32.unpack_from(buf,start)[0]
+            start += 4
         else:
+            if length<8:
+                return False
             self.vendor_id = 0
-        self.payload = unpacker.unpack_fopaque(length)
-        
+        self.code = code
+        self.flags = flags
+        self._payload_src = (buf,start,offset+length)
+        try:
+            del self.payload
+        except AttributeError:
+            pass
         return True
     
+    def scanList(buf,offset,bytes):
+        """Validate the framing of a sequence of AVPs without decoding them.
+        Only the AVP headers are read.
+          buf     A string (or memoryview) containing the AVPs
+          offset  Where the first AVP starts
+          bytes   The number of bytes occupied by the AVPs
+        Returns a list of (code,vendor_id,offset,size) tuples, or None if
+        the AVPs are malformed.
+        """
+        entries = []
+        end = offset+bytes
+        while offset<end:
+            if end-offset<8:
+                return None
+            code,flags_and_length = _avp_header.unpack_from(buf,offset)
+            length = flags_and_length&0x00FFFFFF
+            padded_length = ((length+3)&~3)
+            if offset+padded_length>end:
+                return None
+            if (flags_and_length&(AVP.avp_flag_vendor<<24))!=0:
+                if length<12:
+                    return None
+                vendor_id = _uint32.unpack_from(buf,offset+8)[0]
+            else:
+                if length<8:
+                    return None
+                vendor_id = 0
+            entries.append((code,vendor_id,offset,padded_length))
+            offset += padded_length
+        return entries
+    scanList = staticmethod(scanList)
+    
+    def decodeList(buf,offset,bytes):
+        """Decode a sequence of AVPs from on-the-wire format.
+        The AVPs reference buf and do not copy their payload until it is
+        accessed.
+          buf     A string (or memoryview) containing the AVPs
+          offset  Where the first AVP starts
+          bytes   The number of bytes occupied by the AVPs
+        Returns a list of AVPs, or None if the AVPs are malformed.
+        """
+        avps = []
+        end = offset+bytes
+        while offset<end:
+            if end-offset<8:
+                return None
+            code,flags_and_length = _avp_header.unpack_from(buf,offset)
+            flags = flags_and_length>>24
+            length = flags_and_length&0x00FFFFFF
+            padded_length = ((length+3)&~3)
+            if offset+padded_length>end:
+                return None
+            a = AVP(code)
+            a.flags = flags
+            start = offset+8
+            if (flags&AVP.avp_flag_vendor)!=0:
+                if length<12:
+                    return None
+                a.vendor_id = _uint32.unpack_from(buf,start)[0]
+                start += 4
+            elif length<8:
+                return None
+            del a.payload
+            a._payload_src = (buf,start,offset+length)
+            avps.append(a)
+            offset += padded_length
+        return avps
+    decodeList = staticmethod(decodeList)
+    
     def encodeSize(self):
         sz = 4 + 4
         if self.vendor_id!=0:
@@ -112,6 +293,28 @@ class AVP:
         
         return i
     
+    def encodeInto(self,buf,offset):
+        """Encode the AVP in on-the-wire format into a preallocated buffer.
+          buf     A bytearray (or writable memoryview) with room for
+                  encodeSize() bytes at offset
+          offset  Where to put the AVP
+        Returns the offset just after the (padded) AVP
+        """
+        payload = self.payload
+        payload_len = len(payload)
+        if self.vendor_id!=0:
+            sz = 12 + payload_len
+            _avp_header_vendor.pack_into(buf,offset,self.code,sz|((self.flags|AVP.avp_flag_vendor)<<24),self.vendor_id)
+        else:
+            sz = 8 + payload_len
+            _avp_header.pack_into(buf,offset,self.code,sz|((self.flags&~AVP.avp_flag_vendor)<<24))
+        end = offset+sz
+        buf[end-payload_len:end] = payload
+        padded_end = offset + ((sz+3)&~3)
+        if padded_end!=end:
+            buf[end:padded_end] = _padding[:padded_end-end]
+        return padded_end
+    
     def isVendorSpecific(self):
         """Returns if the AVP is vendor-specific (has non-zero vendor_id)"""
         return (self.vendor_id!=0)
@@ -208,3 +411,65 @@ def _unittest():
     
     assert a1.code == a2.code
     assert a1.vendor_id == a2.vendor_id
+    
+    #decode directly from a buffer
+    a1 = AVP(17,"payload",42)
+    p = Packer()
+    a1.encode(p)
+    raw = p.get_buffer()
+    a2 = AVP()
+    assert a2.decodeFrom(raw,0,len(raw))
+    assert a2.code==17
+    assert a2.vendor_id==42
+    assert a2.isVendorSpecific()
+    assert a2.payload=="payload"
+    a2 = AVP()
+    assert a2.decodeFrom(memoryview("xxxx"+raw),4,len(raw))
+    assert a2.payload=="payload"
+    assert not AVP().decodeFrom(raw,0,len(raw)-4)
+    
+    #decode a list of AVPs
+    p = Packer()
+    AVP(1,"user").encode(p)
+    AVP(2,"foo",7).encode(p)
+    raw = p.get_buffer()
+    avps = AVP.decodeList(raw,0,len(raw))
+    assert len(avps)==2
+    assert avps[0].code==1 and avps[0].payload=="user"
+    assert avps[1].code==2 and avps[1].vendor_id==7 and avps[1].payload=="foo"
+    assert AVP.decodeList(raw,0,len(raw)-4) is None
+    assert AVP.decodeList(raw,0,0)==[]
+    
+    #lazy payloads survive copying
+    import copy
+    avps = AVP.decodeList(memoryview(raw),0,len(raw))
+    a3 = copy.deepcopy(avps[1])
+    assert a3.payload=="foo"
+    assert a3.code==2 and a3.vendor_id==7
+    import pickle
+    for protocol in (0,2):
+        a3 = pickle.loads(pickle.dumps(avps[0],protocol))
+        assert a3.code==1 and a3.payload=="user"
+    
+    #no per-instance dictionary
+    assert not hasattr(AVP(1,"user"),"__dict__")
+    
+    #encode into a preallocated buffer
+    a1 = AVP(1,"user",42)
+    a1.setMandatory(True)
+    buf = bytearray(a1.encodeSize()+4)
+    assert a1.encodeInto(buf,4)==len(buf)
+    p = Packer()
+    a1.encode(p)
+    assert str(buf[4:])==p.get_buffer()
+    a1 = AVP(1,"use")
+    buf = bytearray("x"*a1.encodeSize())
+    assert a1.encodeInto(buf,0)==12
+    p = Packer()
+    a1.encode(p)
+    assert str(buf)==p.get_buffer()
+    
+    #scan a list of AVPs
+    entries = AVP.scanList(raw,0,len(raw))
+    assert entries==[(1,0,0,12),(2,7,12,16)]
+    assert AVP.scanList(raw,0,len(raw)-4) is None
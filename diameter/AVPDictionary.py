@@ -0,0 +1,234 @@
+"""AVP dictionary.
+The dictionary maps (code,vendor_id) to the AVP class that describes the
+payload and to whether the M-bit must be set. It comes seeded with the
+AVPs from RFC3588 (base protocol) and RFC4006 (credit-control), using the
+M-bit rules from Utils. Applications can register their own AVPs.
+
+AVPs constructed with a code registered as mandatory get the M-bit set, so
+calling Utils.setMandatory_RFC3588() and Utils.setMandatory_RFC4006() on
+outgoing messages is no longer necessary (but still harmless).
+
+Example:
+    avp = msg.find(ProtocolConstants.DI_RESULT_CODE)
+    result_code = AVPDictionary.narrow(avp).queryValue()
+"""
+import ProtocolConstants
+import Utils
+import Error
+import AVP as _AVP_module
+from AVP import AVP
+from AVP_Address import AVP_Address
+from AVP_Grouped import AVP_Grouped
+from AVP_Integer32 import AVP_Integer32
+from AVP_Integer64 import AVP_Integer64
+from AVP_OctetString import AVP_OctetString
+from AVP_Time import AVP_Time
+from AVP_UTF8String import AVP_UTF8String
+from AVP_Unsigned32 import AVP_Unsigned32
+from AVP_Unsigned64 import AVP_Unsigned64
+
+#{(code,vendor_id):AVP class}
+_types = {}
+
+def register(code,avp_class,mandatory=False,vendor_id=0):
+    """Registers the type and M-bit rule of an AVP.
+    Registering an AVP again replaces the previous registration.
+      code       The AVP code
+      avp_class  The AVP class of the payload, eg. AVP_Unsigned32. It must
+                 have a narrow() method.
+      mandatory  If true AVPs constructed with this code and vendor_id get
+                 the M-bit set
+      vendor_id  The vendor ID
+    """
+    _types[(code,vendor_id)] = avp_class
+    if vendor_id==0:
+        codes = _AVP_module._mandatory_codes
+        key = code
+    else:
+        codes = _AVP_module._mandatory_vendor_codes
+        key = (code,vendor_id)
+    if mandatory:
+        codes.add(key)
+    else:
+        codes.discard(key)
+
+def lookup(code,vendor_id=0):
+    """Returns the registered AVP class, or None if the AVP is unknown"""
+    return _types.get((code,vendor_id))
+
+def isMandatory(code,vendor_id=0):
+    """Returns if the AVP is registered as mandatory"""
+    if vendor_id==0:
+        return code in _AVP_module._mandatory_codes
+    return (code,vendor_id) in _AVP_module._mandatory_vendor_codes
+
+def narrow(avp):
+    """Convert a generic AVP to the registered type.
+    The result is cached on avp like the narrow() methods of the AVP
+    classes do.
+    Returns the typed AVP, or avp itself if its type is unknown
+    Raises: InvalidAVPLengthError, InvalidAddressTypeError,
+            InvalidAVPValueError
+    """
+    avp_class = _types.get((avp.code,avp.vendor_id))
+    if avp_class is None:
+        return avp
+    return avp_class.narrow(avp)
+
+
+#DiameterIdentity and DiameterURI are handled as AVP_UTF8String,
+#Enumerated as AVP_Unsigned32 and IPFilterRule as AVP_OctetString
+_rfc3588_types = [
+    (ProtocolConstants.DI_ACCT_INTERIM_INTERVAL,         AVP_Unsigned32),
+    (ProtocolConstants.DI_ACCOUNTING_REALTIME_REQUIRED,  AVP_Unsigned32),
+    (ProtocolConstants.DI_ACCT_MULTI_SESSION_ID,         AVP_UTF8String),
+    (ProtocolConstants.DI_ACCOUNTING_RECORD_NUMBER,      AVP_Unsigned32),
+    (ProtocolConstants.DI_ACCOUNTING_RECORD_TYPE,        AVP_Unsigned32),
+    (ProtocolConstants.DI_ACCOUNTING_SESSION_ID,         AVP_OctetString),
+    (ProtocolConstants.DI_ACCOUNTING_SUB_SESSION_ID,     AVP_Unsigned64),
+    (ProtocolConstants.DI_ACCT_APPLICATION_ID,           AVP_Unsigned32),
+    (ProtocolConstants.DI_AUTH_APPLICATION_ID,           AVP_Unsigned32),
+    (ProtocolConstants.DI_AUTH_REQUEST_TYPE,             AVP_Unsigned32),
+    (ProtocolConstants.DI_AUTHORIZATION_LIFETIME,        AVP_Unsigned32),
+    (ProtocolConstants.DI_AUTH_GRACE_PERIOD,             AVP_Unsigned32),
+    (ProtocolConstants.DI_AUTH_SESSION_STATE,            AVP_Unsigned32),
+    (ProtocolConstants.DI_RE_AUTH_REQUEST_TYPE,          AVP_Unsigned32),
+    (ProtocolConstants.DI_CLASS,                         AVP_OctetString),
+    (ProtocolConstants.DI_DESTINATION_HOST,              AVP_UTF8String),
+    (ProtocolConstants.DI_DESTINATION_REALM,             AVP_UTF8String),
+    (ProtocolConstants.DI_DISCONNECT_CAUSE,              AVP_Unsigned32),
+    (ProtocolConstants.DI_E2E_SEQUENCE_AVP,              AVP_Grouped),
+    (ProtocolConstants.DI_ERROR_MESSAGE,                 AVP_UTF8String),
+    (ProtocolConstants.DI_ERROR_REPORTING_HOST,          AVP_UTF8String),
+    (ProtocolConstants.DI_EVENT_TIMESTAMP,               AVP_Time),
+    (ProtocolConstants.DI_EXPERIMENTAL_RESULT,           AVP_Grouped),
+    (ProtocolConstants.DI_EXPERIMENTAL_RESULT_CODE,      AVP_Unsigned32),
+    (ProtocolConstants.DI_FAILED_AVP,                    AVP_Grouped),
+    (ProtocolConstants.DI_FIRMWARE_REVISION,             AVP_Unsigned32),
+    (ProtocolConstants.DI_HOST_IP_ADDRESS,               AVP_Address),
+    (ProtocolConstants.DI_INBAND_SECURITY_ID,            AVP_Unsigned32),
+    (ProtocolConstants.DI_MULTI_ROUND_TIME_OUT,          AVP_Unsigned32),
+    (ProtocolConstants.DI_ORIGIN_HOST,                   AVP_UTF8String),
+    (ProtocolConstants.DI_ORIGIN_REALM,                  AVP_UTF8String),
+    (ProtocolConstants.DI_ORIGIN_STATE_ID,               AVP_Unsigned32),
+    (ProtocolConstants.DI_PRODUCT_NAME,                  AVP_UTF8String),
+    (ProtocolConstants.DI_PROXY_HOST,                    AVP_UTF8String),
+    (ProtocolConstants.DI_PROXY_INFO,                    AVP_Grouped),
+    (ProtocolConstants.DI_PROXY_STATE,                   AVP_OctetString),
+    (ProtocolConstants.DI_REDIRECT_HOST,                 AVP_UTF8String),
+    (ProtocolConstants.DI_REDIRECT_HOST_USAGE,           AVP_Unsigned32),
+    (ProtocolConstants.DI_REDIRECT_MAX_CACHE_TIME,       AVP_Unsigned32),
+    (ProtocolConstants.DI_RESULT_CODE,                   AVP_Unsigned32),
+    (ProtocolConstants.DI_ROUTE_RECORD,                  AVP_UTF8String),
+    (ProtocolConstants.DI_SESSION_ID,                    AVP_UTF8String),
+    (ProtocolConstants.DI_SESSION_TIMEOUT,               AVP_Unsigned32),
+    (ProtocolConstants.DI_SESSION_BINDING,               AVP_Unsigned32),
+    (ProtocolConstants.DI_SESSION_SERVER_FAILOVER,       AVP_Unsigned32),
+    (ProtocolConstants.DI_SUPPORTED_VENDOR_ID,           AVP_Unsigned32),
+    (ProtocolConstants.DI_TERMINATION_CAUSE,             AVP_Unsigned32),
+    (ProtocolConstants.DI_USER_NAME,                     AVP_UTF8String),
+    (ProtocolConstants.DI_VENDOR_ID,                     AVP_Unsigned32),
+    (ProtocolConstants.DI_VENDOR_SPECIFIC_APPLICATION_ID,AVP_Grouped),
+]
+
+_rfc4006_types = [
+    (ProtocolConstants.DI_CC_CORRELATION_ID,             AVP_OctetString),
+    (ProtocolConstants.DI_CC_INPUT_OCTETS,               AVP_Unsigned64),
+    (ProtocolConstants.DI_CC_MONEY,                      AVP_Grouped),
+    (ProtocolConstants.DI_CC_OUTPUT_OCTETS,              AVP_Unsigned64),
+    (ProtocolConstants.DI_CC_REQUEST_NUMBER,             AVP_Unsigned32),
+    (ProtocolConstants.DI_CC_REQUEST_TYPE,               AVP_Unsigned32),
+    (ProtocolConstants.DI_CC_SERVICE_SPECIFIC_UNITS,     AVP_Unsigned64),
+    (ProtocolConstants.DI_CC_SESSION_FAILOVER,           AVP_Unsigned32),
+    (ProtocolConstants.DI_CC_SUB_SESSION_ID,             AVP_Unsigned64),
+    (ProtocolConstants.DI_CC_TIME,                       AVP_Unsigned32),
+    (ProtocolConstants.DI_CC_TOTAL_OCTETS,               AVP_Unsigned64),
+    (ProtocolConstants.DI_CC_UNIT_TYPE,                  AVP_Unsigned32),
+    (ProtocolConstants.DI_CHECK_BALANCE_RESULT,          AVP_Unsigned32),
+    (ProtocolConstants.DI_COST_INFORMATION,              AVP_Grouped),
+    (ProtocolConstants.DI_COST_UNIT,                     AVP_UTF8String),
+    (ProtocolConstants.DI_CREDIT_CONTROL,                AVP_Unsigned32),
+    (ProtocolConstants.DI_CREDIT_CONTROL_FAILURE_HANDLING,AVP_Unsigned32),
+    (ProtocolConstants.DI_CURRENCY_CODE,                 AVP_Unsigned32),
+    (ProtocolConstants.DI_DIRECT_DEBITING_FAILURE_HANDLING,AVP_Unsigned32),
+    (ProtocolConstants.DI_EXPONENT,                      AVP_Integer32),
+    (ProtocolConstants.DI_FINAL_UNIT_ACTION,             AVP_Unsigned32),
+    (ProtocolConstants.DI_FINAL_UNIT_INDICATION,         AVP_Grouped),
+    (ProtocolConstants.DI_GRANTED_SERVICE_UNIT,          AVP_Grouped),
+    (ProtocolConstants.DI_G_S_U_POOL_IDENTIFIER,         AVP_Unsigned32),
+    (ProtocolConstants.DI_G_S_U_POOL_REFERENCE,          AVP_Grouped),
+    (ProtocolConstants.DI_MULTIPLE_SERVICES_CREDIT_CONTROL,AVP_Grouped),
+    (ProtocolConstants.DI_MULTIPLE_SERVICES_INDICATOR,   AVP_Unsigned32),
+    (ProtocolConstants.DI_RATING_GROUP,                  AVP_Unsigned32),
+    (ProtocolConstants.DI_REDIRECT_ADDRESS_TYPE,         AVP_Unsigned32),
+    (ProtocolConstants.DI_REDIRECT_SERVER,               AVP_Grouped),
+    (ProtocolConstants.DI_REDIRECT_SERVER_ADDRESS,       AVP_UTF8String),
+    (ProtocolConstants.DI_REQUESTED_ACTION,              AVP_Unsigned32),
+    (ProtocolConstants.DI_REQUESTED_SERVICE_UNIT,        AVP_Grouped),
+    (ProtocolConstants.DI_RESTRICTION_FILTER_RULE,       AVP_OctetString),
+    (ProtocolConstants.DI_SERVICE_CONTEXT_ID,            AVP_UTF8String),
+    (ProtocolConstants.DI_SERVICE_IDENTIFIER,            AVP_Unsigned32),
+    (ProtocolConstants.DI_SERVICE_PARAMETER_INFO,        AVP_Grouped),
+    (ProtocolConstants.DI_SERVICE_PARAMETER_TYPE,        AVP_Unsigned32),
+    (ProtocolConstants.DI_SERVICE_PARAMETER_VALUE,       AVP_OctetString),
+    (ProtocolConstants.DI_SUBSCRIPTION_ID,               AVP_Grouped),
+    (ProtocolConstants.DI_SUBSCRIPTION_ID_DATA,          AVP_UTF8String),
+    (ProtocolConstants.DI_SUBSCRIPTION_ID_TYPE,          AVP_Unsigned32),
+    (ProtocolConstants.DI_TARIFF_CHANGE_USAGE,           AVP_Unsigned32),
+    (ProtocolConstants.DI_TARIFF_TIME_CHANGE,            AVP_Time),
+    (ProtocolConstants.DI_UNIT_VALUE,                    AVP_Grouped),
+    (ProtocolConstants.DI_USED_SERVICE_UNIT,             AVP_Grouped),
+    (ProtocolConstants.DI_USER_EQUIPMENT_INFO,           AVP_Grouped),
+    (ProtocolConstants.DI_USER_EQUIPMENT_INFO_TYPE,      AVP_Unsigned32),
+    (ProtocolConstants.DI_USER_EQUIPMENT_INFO_VALUE,     AVP_OctetString),
+    (ProtocolConstants.DI_VALUE_DIGITS,                  AVP_Integer64),
+    (ProtocolConstants.DI_VALIDITY_TIME,                 AVP_Unsigned32),
+]
+
+for _code,_avp_class in _rfc3588_types:
+    register(_code,_avp_class,_code in Utils.rfc3588_mandatory_codes)
+for _code,_avp_class in _rfc4006_types:
+    register(_code,_avp_class,_code in Utils.rfc4006_mandatory_codes)
+
+
+def _unittest():
+    assert lookup(ProtocolConstants.DI_RESULT_CODE) is AVP_Unsigned32
+    assert lookup(ProtocolConstants.DI_RESULT_CODE,10415) is None
+    assert isMandatory(ProtocolConstants.DI_ORIGIN_HOST)
+    assert isMandatory(ProtocolConstants.DI_CC_TOTAL_OCTETS)
+    assert not isMandatory(ProtocolConstants.DI_ERROR_MESSAGE)
+    
+    #the M-bit is set on construction
+    assert AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"host.example.net").isMandatory()
+    assert AVP(ProtocolConstants.DI_RESULT_CODE,"\000\000\007\321").isMandatory()
+    assert not AVP_UTF8String(ProtocolConstants.DI_ERROR_MESSAGE,"oops").isMandatory()
+    assert not AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"x",10415).isMandatory()
+    
+    #narrowing is cached
+    a = AVP(ProtocolConstants.DI_RESULT_CODE,"\000\000\007\321")
+    v = narrow(a)
+    assert isinstance(v,AVP_Unsigned32)
+    assert v.queryValue()==2001
+    assert narrow(a) is v
+    assert AVP_Unsigned32.narrow(a) is v
+    a.payload = "\000\000\013\271"
+    assert narrow(a).queryValue()==3001
+    a = AVP(ProtocolConstants.DI_RESULT_CODE,"\000\000\007")
+    try:
+        narrow(a)
+        assert False
+    except Error.InvalidAVPLengthError, details:
+        pass
+    a = AVP(999,"whatever")
+    assert narrow(a) is a
+    
+    #vendor-specific registrations
+    register(1,AVP_Unsigned32,True,10415)
+    try:
+        assert AVP_Unsigned32(1,7,10415).isMandatory()
+        assert not AVP_Unsigned32(1,7,10416).isMandatory()
+        assert narrow(AVP(1,"\000\000\000\007",10415)).queryValue()==7
+        register(1,AVP_Unsigned32,False,10415)
+        assert not AVP_Unsigned32(1,7,10415).isMandatory()
+    finally:
+        del _types[(1,10415)]
@@ -21,20 +21,35 @@ class AVP_Address(AVP):
     Note: Values not conforming to RFC3588 has been seen in the wild.
     """
     
+    #the decoded value and the payload it was decoded from
+    __slots__ = ("_value","_value_payload")
+    
     def __init__(self,code,address,vendor_id=0):
-        """Constructs an AVP_Address. The address is expected to tuple (family,address)"""
-        AVP.__init__(self,code,_pack_address(address),vendor_id)
+        """Constructs an AVP_Address. The address is expected to tuple (family,address)
+        If address is None the payload is left empty.
+        """
+        if address is None:
+            AVP.__init__(self,code,"",vendor_id)
+        else:
+            AVP.__init__(self,code,_pack_address(address),vendor_id)
+        self._value_payload = None
     
     def queryAddress(self):
         """Returns the payload as a tuple (family,address)
         Raises: InvalidAddressTypeError
         """
-        if len(self.payload)==2+4:
-            return (socket.AF_INET,socket.inet_ntop(socket.AF_INET,self.payload[2:]))
-        elif len(self.payload)==2+16:
-            return (socket.AF_INET6,socket.inet_ntop(socket.AF_INET6,self.payload[2:]))
+        payload = self.payload
+        if payload is self._value_payload:
+            return self._value
+        if len(payload)==2+4:
+            value = (socket.AF_INET,socket.inet_ntop(socket.AF_INET,payload[2:]))
+        elif len(payload)==2+16:
+            value = (socket.AF_INET6,socket.inet_ntop(socket.AF_INET6,payload[2:]))
         else:
             raise InvalidAddressTypeError(self)
+        self._value = value
+        self._value_payload = payload
+        return value
         
     def setAddress(self,address):
         """Sets the payload. The address is expected to tuple (family,address)
@@ -54,22 +69,28 @@ class AVP_Address(AVP):
         """Convert a generic AVP to AVP_Address
         Attempts to interpret the payload as an address and returns
         an AVP_Address instance on success.
+        The result is cached on avp, so narrowing it again is cheap.
         Raises: InvalidAVPLengthError
         """
-        if len(avp.payload)<2:
+        a = avp.cachedView(AVP_Address)
+        if a is not None:
+            return a
+        payload = avp.payload
+        if len(payload)<2:
             raise InvalidAVPLengthError(avp)
-        address_family = struct.unpack("!h",avp.payload[0:2])[0]
+        address_family = struct.unpack("!h",payload[0:2])[0]
         if address_family==1:
-            if len(avp.payload) != 2+4:
+            if len(payload) != 2+4:
                 raise InvalidAVPLengthError(avp)
         elif address_family==2:
-            if len(avp.payload) != 2+16:
+            if len(payload) != 2+16:
                 raise InvalidAVPLengthError(avp)
         else:
             raise InvalidAddressTypeError(avp)
-        a = AVP_Address(avp.code, "0.0.0.0", avp.vendor_id)
-        a.payload = avp.payload[:]
+        a = AVP_Address(avp.code, None, avp.vendor_id)
+        a.payload = payload
         a.flags = avp.flags
+        avp._view = a
         return a
     narrow = staticmethod(narrow)
 
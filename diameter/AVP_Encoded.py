@@ -0,0 +1,187 @@
+from diameter.AVP import AVP,_avp_header
+from diameter.Error import InvalidAVPLengthError
+
+_payload_slot = AVP.__dict__["payload"]
+
+class AVP_Encoded(AVP):
+    """AVP kept in on-the-wire format.
+    The AVP is encoded by copying its bytes instead of packing the header
+    and payload again, so adding the same AVP to many messages costs
+    almost nothing. The code, flags, vendor_id and payload members can be
+    read as usual. If the code or flags are modified the header of the
+    copy is patched, and if the vendor_id or payload are modified the AVP
+    is encoded the normal way.
+    
+    Instances used by several messages should be treated as immutable.
+    """
+    
+    #the wire bytes, the header fields they contain, and whether the
+    #payload has been assigned since
+    __slots__ = ("_raw","_raw_code","_raw_flags","_raw_vendor_id","_payload_modified")
+    
+    def __init__(self,raw,offset=0,size=None):
+        """Constructs an AVP from on-the-wire format
+          raw     A string (or bytearray/memoryview) containing the AVP
+          offset  Where the AVP starts. Default: 0
+          size    The padded size of the AVP. Default: the rest of raw
+        Raises: InvalidAVPLengthError
+        """
+        AVP.__init__(self)
+        if size is None:
+            size = len(raw)-offset
+        if offset!=0 or size!=len(raw):
+            raw = raw[offset:offset+size]
+        if not isinstance(raw,str):
+            raw = memoryview(raw).tobytes()
+        if not self.decodeFrom(raw,0,size):
+            raise InvalidAVPLengthError(self)
+        self._raw = raw
+        self._raw_code = self.code
+        self._raw_flags = self.flags
+        self._raw_vendor_id = self.vendor_id
+    
+    #The payload slot of AVP holds None until the payload is copied out of
+    #the raw bytes, so an assignment to the payload can be detected.
+    def __getPayload(self):
+        payload = _payload_slot.__get__(self)
+        if payload is None:
+            payload = AVP.__getattr__(self,"payload")
+            self._payload_modified = False
+        return payload
+    
+    def __setPayload(self,payload):
+        _payload_slot.__set__(self,payload)
+        self._payload_modified = True
+    
+    def __delPayload(self):
+        _payload_slot.__set__(self,None)
+        self._payload_modified = False
+    
+    payload = property(__getPayload,__setPayload,__delPayload)
+    
+    def __rawUsable(self):
+        return self.vendor_id==self._raw_vendor_id and not self._payload_modified
+    
+    def encodeSize(self):
+        if self.__rawUsable():
+            return len(self._raw)
+        return AVP.encodeSize(self)
+    
+    def encodeInto(self,buf,offset):
+        if not self.__rawUsable():
+            return AVP.encodeInto(self,buf,offset)
+        raw = self._raw
+        end = offset+len(raw)
+        buf[offset:end] = raw
+        if self.code!=self._raw_code or self.flags!=self._raw_flags:
+            #patch the header of the copy
+            if self.vendor_id!=0:
+                flags = self.flags|AVP.avp_flag_vendor
+            else:
+                flags = self.flags&~AVP.avp_flag_vendor
+            length = _avp_header.unpack_from(raw)[1]&0x00FFFFFF
+            _avp_header.pack_into(buf,offset,self.code,length|(flags<<24))
+        return end
+    
+    def copy(self):
+        """Returns a copy of the AVP.
+        The copy shares the wire bytes, which are never modified, so it is
+        cheap to make, and modifying it does not affect this AVP.
+        """
+        a = AVP_Encoded.__new__(AVP_Encoded)
+        a.code = self.code
+        a.flags = self.flags
+        a.vendor_id = self.vendor_id
+        a._view = None
+        a._raw = self._raw
+        a._raw_code = self._raw_code
+        a._raw_flags = self._raw_flags
+        a._raw_vendor_id = self._raw_vendor_id
+        payload = _payload_slot.__get__(self)
+        if payload is None:
+            #not copied out of the (immutable) wire bytes yet
+            a._payload_src = self._payload_src
+        _payload_slot.__set__(a,payload)
+        a._payload_modified = self._payload_modified
+        return a
+    
+    def narrow(avp):
+        """Convert an AVP to AVP_Encoded by encoding it"""
+        if isinstance(avp,AVP_Encoded):
+            return avp
+        raw = bytearray(avp.encodeSize())
+        avp.encodeInto(raw,0)
+        return AVP_Encoded(str(raw))
+    narrow = staticmethod(narrow)
+
+def _unittest():
+    a = AVP(1,"user",7)
+    a.setMandatory(True)
+    e = AVP_Encoded.narrow(a)
+    assert e.code==1
+    assert e.vendor_id==7
+    assert e.isMandatory()
+    assert e.payload=="user"
+    assert e.encodeSize()==a.encodeSize()
+    b = bytearray(e.encodeSize()+4)
+    assert e.encodeInto(b,4)==len(b)
+    assert str(b[4:])==e._raw
+    assert AVP_Encoded.narrow(e) is e
+    
+    #setting an already set flag keeps the raw bytes
+    e.setMandatory(True)
+    assert e.encodeInto(bytearray(e.encodeSize()),0)==e.encodeSize()
+    
+    #code and flag modifications patch the header
+    e.setMandatory(False)
+    e.setPrivate(True)
+    e.code = 2
+    b = bytearray(e.encodeSize())
+    e.encodeInto(b,0)
+    a.setMandatory(False)
+    a.setPrivate(True)
+    a.code = 2
+    b2 = bytearray(a.encodeSize())
+    a.encodeInto(b2,0)
+    assert b==b2
+    
+    #other modifications fall back to normal encoding
+    e.vendor_id = 0
+    assert e.encodeSize()==12
+    b = bytearray(e.encodeSize())
+    e.encodeInto(b,0)
+    a.vendor_id = 0
+    b2 = bytearray(a.encodeSize())
+    a.encodeInto(b2,0)
+    assert b==b2
+    e = AVP_Encoded.narrow(AVP(1,"user"))
+    e.payload = "other"
+    assert e.encodeSize()==16
+    b = bytearray(e.encodeSize())
+    e.encodeInto(b,0)
+    assert str(b[8:13])=="other"
+    
+    #copies are independent of the original
+    e = AVP_Encoded.narrow(AVP(1,"user"))
+    c = e.copy()
+    assert c.payload=="user" and c.encodeInto(bytearray(16),0)==12
+    c.payload = "other"
+    c.setMandatory(not e.isMandatory())
+    assert e.payload=="user" and c.isMandatory()!=e.isMandatory()
+    assert e.copy().encodeSize()==12
+    b = bytearray(c.encodeSize())
+    c.encodeInto(b,0)
+    assert str(b[8:13])=="other"
+    
+    #from the middle of a buffer
+    raw = "xxxx" + str(b)
+    e = AVP_Encoded(raw,4,16)
+    assert e.payload=="other"
+    e = AVP_Encoded(bytearray(raw),4)
+    assert e.payload=="other"
+    
+    try:
+        AVP_Encoded("\000\000\000\001\000\000\000\077")
+        assert False
+    except InvalidAVPLengthError, details:
+        pass
@@ -6,12 +6,20 @@ import struct
 class AVP_Float64(AVP):
     """64-bit floating point AVP"""
     
+    #the unpacked value and the payload it was unpacked from
+    __slots__ = ("_value","_value_payload")
+    
     def __init__(self,code,value,vendor_id=0):
         AVP.__init__(self,code,struct.pack("!d",value),vendor_id)
+        self._value_payload = None
     
     def queryValue(self):
         """Returns the payload interpreted as a 64-bit floating point value"""
-        return struct.unpack("!d",self.payload)[0]
+        payload = self.payload
+        if payload is not self._value_payload:
+            self._value = struct.unpack("!d",payload)[0]
+            self._value_payload = payload
+        return self._value
     
     def setValue(self,value):
         """Sets the payload to the spcified 64-bit floating point value"""
@@ -22,16 +30,23 @@ class AVP_Float64(AVP):
     
     def narrow(avp):
         """Convert generic AVP to AVP_Float64
+        The result is cached on avp, so narrowing it again is cheap.
         Raises: InvalidAVPLengthError, InvalidAVPValueError
         """
-        if len(avp.payload)!=8:
+        a = avp.cachedView(AVP_Float64)
+        if a is not None:
+            return a
+        payload = avp.payload
+        if len(payload)!=8:
             raise InvalidAVPLengthError(avp)
         try:
-            value = struct.unpack("!d",avp.payload)[0]
+            struct.unpack("!d",payload)
         except struct.error:
             raise InvalidAVPValueError(avp)
-        a = AVP_Float64(avp.code, value, avp.vendor_id)
+        a = AVP_Float64(avp.code, 0, avp.vendor_id)
+        a.payload = payload
         a.flags = avp.flags
+        avp._view = a
         return a
     narrow = staticmethod(narrow)
 
@@ -1,63 +1,190 @@
-from diameter.AVP import AVP
+from diameter.AVP import AVP,_avp_header,_avp_header_vendor
 from diameter.Error import InvalidAVPLengthError
-from xdrlib import Packer,Unpacker
 
 def _pack(avps):
-    p = Packer()
+    sz = 0
     for a in avps:
-        a.encode(p)
-    return p.get_buffer()
+        sz += a.encodeSize()
+    buf = bytearray(sz)
+    pos = 0
+    for a in avps:
+        pos = a.encodeInto(buf,pos)
+    return str(buf)
+
+_payload_slot = AVP.__dict__["payload"]
 
 class AVP_Grouped(AVP):
-    """AVP grouping multiple AVPs together."""
+    """AVP grouping multiple AVPs together.
+    The embedded AVPs are kept together with the payload. A grouped AVP
+    constructed from a list of AVPs only encodes them when the payload is
+    needed, and a narrowed grouped AVP decodes its payload only once.
+    The payload is kept once it has been encoded, so sending the same
+    grouped AVP again does not encode the embedded AVPs again. It is only
+    re-encoded after setAVPs() or an assignment to the payload. The
+    embedded AVPs are shared, not copied, so if you modify one of them in
+    place you must call setAVPs() afterwards, or the old payload is sent.
+    """
+    
+    #the embedded AVPs, or None if they must be decoded from the payload
+    __slots__ = ("_avps",)
     
     def __init__(self,code,avps=[],vendor_id=0):
-        AVP.__init__(self,code,_pack(avps),vendor_id)
+        AVP.__init__(self,code,None,vendor_id)
+        self._avps = list(avps)
     
-    def getAVPs(self):
-        """Returns a copy of the embedded AVPs in a list"""
-        avps=[]
-        u = Unpacker(self.payload)
-        bytes_left=len(self.payload)
-        while bytes_left!=0:
-            sz = AVP.decodeSize(u,bytes_left)
-            if sz==0:
-                raise InvalidAVPLengthError(self)
-            a = AVP(1,"")
-            a.decode(u,sz)
-            avps.append(a)
-            bytes_left -= sz
+    #The payload slot of AVP holds None until the payload is needed. A
+    #payload assigned directly replaces the embedded AVPs.
+    def __getPayload(self):
+        payload = _payload_slot.__get__(self)
+        if payload is None:
+            if self._avps is not None:
+                payload = _pack(self._avps)
+                _payload_slot.__set__(self,payload)
+            else:
+                payload = AVP.__getattr__(self,"payload")
+        return payload
+    
+    def __setPayload(self,payload):
+        _payload_slot.__set__(self,payload)
+        self._payload_src = None
+        self._avps = None
+    
+    def __delPayload(self):
+        _payload_slot.__set__(self,None)
+    
+    payload = property(__getPayload,__setPayload,__delPayload)
+    
+    def decodeFrom(self,buf,offset,bytes):
+        self._avps = None
+        return AVP.decodeFrom(self,buf,offset,bytes)
+    
+    def encodeSize(self):
+        if self._avps is None or _payload_slot.__get__(self) is not None:
+            return AVP.encodeSize(self)
+        sz = 4 + 4
+        if self.vendor_id!=0:
+            sz += 4
+        for a in self._avps:
+            sz += a.encodeSize()
+        return sz
+    
+    def encodeInto(self,buf,offset):
+        if self._avps is None or _payload_slot.__get__(self) is not None:
+            return AVP.encodeInto(self,buf,offset)
+        #encode the embedded AVPs directly into the buffer, and keep a copy
+        #of them as the payload for the next encoding
+        if self.vendor_id!=0:
+            pos = offset + 12
+        else:
+            pos = offset + 8
+        start = pos
+        for a in self._avps:
+            pos = a.encodeInto(buf,pos)
+        _payload_slot.__set__(self,memoryview(buf)[start:pos].tobytes())
+        if self.vendor_id!=0:
+            _avp_header_vendor.pack_into(buf,offset,self.code,(pos-offset)|((self.flags|AVP.avp_flag_vendor)<<24),self.vendor_id)
+        else:
+            _avp_header.pack_into(buf,offset,self.code,(pos-offset)|((self.flags&~AVP.avp_flag_vendor)<<24))
+        return pos
+    
+    def __embeddedAVPs(self):
+        avps = self._avps
+        if avps is not None:
+            return avps
+        #not decoded yet, or the payload has been assigned directly
+        payload = self.payload
+        avps = AVP.decodeList(payload,0,len(payload))
+        if avps is None:
+            raise InvalidAVPLengthError(self)
+        self._avps = avps
         return avps
     
+    def getAVPs(self):
+        """Returns the embedded AVPs in a new list
+        Raises: InvalidAVPLengthError
+        """
+        return self.__embeddedAVPs()[:]
+    
     def setAVPs(self,avps):
-        """Sets the payload to a copy of the AVPs in the list"""
-        self.payload = _pack(avps)
+        """Sets the embedded AVPs to the AVPs in the list
+        The payload is encoded again from them when it is needed. Call it
+        again with the same list after modifying an embedded AVP.
+        """
+        _payload_slot.__set__(self,None)
+        self._payload_src = None
+        self._avps = list(avps)
+    
+    def find(self,code,vendor_id=0):
+        """Returns the first embedded AVP with a matching code and vendor_id, or None
+        Raises: InvalidAVPLengthError
+        """
+        for a in self.__embeddedAVPs():
+            if a.code==code and a.vendor_id==vendor_id:
+                return a
+        return None
+    
+    def findGrouped(self,code,vendor_id=0):
+        """Returns the first embedded AVP with a matching code and vendor_id as an AVP_Grouped, or None
+        The narrowed AVP replaces the original one in the grouped AVP, so
+        looking it up again does not decode it again.
+        Raises: InvalidAVPLengthError
+        """
+        avps = self.__embeddedAVPs()
+        i = 0
+        for a in avps:
+            if a.code==code and a.vendor_id==vendor_id:
+                if not isinstance(a,AVP_Grouped):
+                    a = AVP_Grouped.narrow(a)
+                    avps[i] = a
+                return a
+            i += 1
+        return None
+    
+    def subset(self,code,vendor_id=0):
+        """Returns a list of the embedded AVPs with a matching code and vendor_id
+        Raises: InvalidAVPLengthError
+        """
+        return [a for a in self.__embeddedAVPs() if a.code==code and a.vendor_id==vendor_id]
+    
+    def count(self,code,vendor_id=0):
+        """Returns the number of embedded AVPs with a matching code and vendor_id
+        Raises: InvalidAVPLengthError
+        """
+        c = 0
+        for a in self.__embeddedAVPs():
+            if a.code==code and a.vendor_id==vendor_id:
+                c += 1
+        return c
     
     def __str__(self):
         #The default str(...sequence...) looks suboptimal here
         s = ""
-        for a in self.getAVPs():
+        for a in self.__embeddedAVPs():
             if s!="": s+=','
             s += a.str_prefix__()
         return str(self.code) + ":[" + s + "]"
     
     def narrow(avp):
-        """Convert generic AVP to AVP_Float64
+        """Convert generic AVP to AVP_Grouped
+        An AVP that already is an AVP_Grouped is returned unchanged. For
+        other AVPs the result is cached on avp, so narrowing it again is
+        cheap.
         Raises: InvalidAVPLengthError
         """
-        avps=[]
-        u = Unpacker(avp.payload)
-        bytes_left=len(avp.payload)
-        while bytes_left!=0:
-            sz = AVP.decodeSize(u,bytes_left)
-            if sz==0:
-                raise InvalidAVPLengthError(avp)
-            a = AVP(1,"")
-            a.decode(u,sz)
-            avps.append(a)
-            bytes_left -= sz
-        a = AVP_Grouped(avp.code, avps, avp.vendor_id)
+        if isinstance(avp,AVP_Grouped):
+            return avp
+        a = avp.cachedView(AVP_Grouped)
+        if a is not None:
+            return a
+        payload = avp.payload
+        avps = AVP.decodeList(payload,0,len(payload))
+        if avps is None:
+            raise InvalidAVPLengthError(avp)
+        a = AVP_Grouped(avp.code,(),avp.vendor_id)
         a.flags = avp.flags
+        a.payload = payload
+        a._avps = avps
+        avp._view = a
         return a
     narrow = staticmethod(narrow)
 
@@ -80,3 +207,91 @@ def _unittest():
     except InvalidAVPLengthError, details:
         pass
     
+    
+    #the payload is encoded on demand and kept in sync with the AVPs
+    a = AVP_Grouped(1,[AVP(2,"u1"),AVP(3,"u2",7)])
+    raw = "\000\000\000\002\000\000\000\012\165\061\000\000\000\000\000\003\200\000\000\016\000\000\000\007\165\062\000\000"
+    assert a.payload==raw
+    assert a.encodeSize()==8+len(raw)
+    b = bytearray(a.encodeSize())
+    assert a.encodeInto(b,0)==len(b)
+    a.setAVPs([AVP(2,"u3")])
+    assert a.encodeSize()==20
+    b2 = bytearray(a.encodeSize())
+    assert a.encodeInto(b2,0)==20
+    assert str(b2[8:])==a.payload
+    assert a.find(2).payload=="u3"
+    a.payload = raw
+    assert a.count(2)==1
+    assert a.find(3,7).payload=="u2"
+    assert a.find(3) is None
+    assert [x.payload for x in a.subset(2)]==["u1"]
+    
+    #encoding directly into the buffer matches encoding the payload
+    a = AVP_Grouped(1,[AVP(2,"u1"),AVP(3,"u2",7)],9)
+    b = bytearray(a.encodeSize())
+    a.encodeInto(b,0)
+    a.payload
+    b2 = bytearray(a.encodeSize())
+    a.encodeInto(b2,0)
+    assert b==b2
+    
+    #the embedded AVPs are encoded once, until they are set again
+    class Counting(AVP):
+        __slots__ = ("encodings",)
+        def encodeInto(self,buf,offset):
+            self.encodings += 1
+            return AVP.encodeInto(self,buf,offset)
+    child = Counting(2,"u1")
+    child.encodings = 0
+    a = AVP_Grouped(1,[child])
+    for i in range(3):
+        b = bytearray(a.encodeSize())
+        a.encodeInto(b,0)
+    assert child.encodings==1
+    assert str(b[8:])==a.payload
+    a.setMandatory(True)
+    b2 = bytearray(a.encodeSize())
+    a.encodeInto(b2,0)
+    assert b2[4]==AVP.avp_flag_mandatory and b2[8:]==b[8:]
+    child.payload = "u2"
+    a.setAVPs(a.getAVPs())
+    b = bytearray(a.encodeSize())
+    a.encodeInto(b,0)
+    assert child.encodings==2 and str(b[16:18])=="u2"
+    
+    #narrow decodes once and reuses the payload
+    a = AVP(1,raw)
+    a.setMandatory(True)
+    g = AVP_Grouped.narrow(a)
+    assert g.isMandatory()
+    assert g.payload is a.payload
+    assert AVP_Grouped.narrow(g) is g
+    assert g.getAVPs()[0] is g.getAVPs()[0]
+    
+    #nested access
+    inner = AVP_Grouped(10,[AVP(11,"x")])
+    outer = AVP(20,AVP_Grouped(21,[AVP(2,"y"),inner]).payload)
+    g = AVP_Grouped.narrow(outer)
+    n = g.findGrouped(10)
+    assert n.find(11).payload=="x"
+    assert g.findGrouped(10) is n
+    assert g.findGrouped(99) is None
+    
+    #copies keep the embedded AVPs
+    import copy
+    a = AVP_Grouped(1,[AVP(2,"u1")])
+    c = copy.deepcopy(a)
+    assert c.find(2).payload=="u1"
+    assert c.find(2) is not a.find(2)
+    c = copy.deepcopy(AVP_Grouped.narrow(AVP(1,raw)))
+    assert c.count(2)==1
+    
+    #garbage is detected when the AVPs are accessed
+    a = AVP_Grouped(1)
+    a.payload = "\000\000\000\002\000\000\000\012\165"
+    try:
+        a.getAVPs()
+        assert False
+    except InvalidAVPLengthError, details:
+        pass
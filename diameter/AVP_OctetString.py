@@ -3,8 +3,26 @@ from diameter.AVP import AVP
 class AVP_OctetString(AVP):
     """AVP containing arbitrary data of variable length."""
     
+    __slots__ = ()
+    
     def __init__(self,code=0,payload="",vendor_id=0):
         AVP.__init__(self,code,payload,vendor_id)
+    
+    def narrow(avp):
+        """Convert generic AVP to AVP_OctetString
+        The result is cached on avp, so narrowing it again is cheap.
+        """
+        a = avp.cachedView(AVP_OctetString)
+        if a is not None:
+            return a
+        a = AVP_OctetString(avp.code, avp.payload, avp.vendor_id)
+        a.flags = avp.flags
+        avp._view = a
+        return a
+    narrow = staticmethod(narrow)
 
 def _unittest():
-    pass
+    g = AVP(1,"data")
+    a = AVP_OctetString.narrow(g)
+    assert a.payload=="data"
+    assert AVP_OctetString.narrow(g) is a
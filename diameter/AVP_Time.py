@@ -14,6 +14,8 @@ class AVP_Time(AVP_Unsigned32):
     than seconds.
     """
     
+    __slots__ = ()
+    
     seconds_between_1900_and_1970 = ((70*365)+17)*86400
     
     def __init__(self,code,seconds_since_1970,vendor_id=0):
@@ -26,14 +28,20 @@ class AVP_Time(AVP_Unsigned32):
         AVP_Unsigned32.setValue(self,seconds_since_1970+AVP_Time.seconds_between_1900_and_1970)
 
     def narrow(avp):
-        """Convert generic AVP to AVP_Float64
+        """Convert generic AVP to AVP_Time
+        The result is cached on avp, so narrowing it again is cheap.
         Raises: InvalidAVPLengthError
         """
-        if len(avp.payload)!=4:
+        a = avp.cachedView(AVP_Time)
+        if a is not None:
+            return a
+        payload = avp.payload
+        if len(payload)!=4:
             raise InvalidAVPLengthError(avp)
-        value = unpack("!I",avp.payload)[0] - AVP_Time.seconds_between_1900_and_1970
-        a = AVP_Time(avp.code, value, avp.vendor_id)
+        a = AVP_Time(avp.code, 0, avp.vendor_id)
+        a.payload = payload
         a.flags = avp.flags
+        avp._view = a
         return a
     narrow = staticmethod(narrow)
     
@@ -8,12 +8,20 @@ utf8decoder=getdecoder("utf_8")
 class AVP_UTF8String(AVP):
     """AVP with UTF-8 string payload."""
     
+    #the decoded value and the payload it was decoded from
+    __slots__ = ("_value","_value_payload")
+    
     def __init__(self,code,value="",vendor_id=0):
         AVP.__init__(self,code,utf8encoder(value)[0],vendor_id)
+        self._value_payload = None
     
     def queryValue(self):
         """Returns the payload as a string (possibly a unicode string)"""
-        return utf8decoder(self.payload)[0]
+        payload = self.payload
+        if payload is not self._value_payload:
+            self._value = utf8decoder(payload)[0]
+            self._value_payload = payload
+        return self._value
     
     def setValue(self,value):
         self.payload = utf8encoder(value)[0]
@@ -23,10 +31,15 @@ class AVP_UTF8String(AVP):
     
     def narrow(avp):
         """Convert generic AVP to AVP_UTF8String
+        The result is cached on avp, so narrowing it again is cheap.
         """
+        a = avp.cachedView(AVP_UTF8String)
+        if a is not None:
+            return a
         a = AVP_UTF8String(avp.code, vendor_id=avp.vendor_id)
         a.flags = avp.flags
         a.payload = avp.payload
+        avp._view = a
         return a
     narrow = staticmethod(narrow)
 
@@ -44,3 +57,16 @@ def _unittest():
     a.setValue(u'\xe6\xf8\xe5')
     assert len(a.payload)>3
     assert len(a.queryValue())==3
+    
+    #narrowing is cached as long as the AVP is unchanged
+    g = AVP(1,"user")
+    a = AVP_UTF8String.narrow(g)
+    assert a.queryValue()=="user"
+    assert AVP_UTF8String.narrow(g) is a
+    a.setValue("other")
+    assert AVP_UTF8String.narrow(g) is not a
+    assert AVP_UTF8String.narrow(g).queryValue()=="user"
+    g.payload = "new"
+    assert AVP_UTF8String.narrow(g).queryValue()=="new"
+    g.setPrivate(True)
+    assert AVP_UTF8String.narrow(g).isPrivate()
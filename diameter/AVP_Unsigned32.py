@@ -9,12 +9,20 @@ class AVP_Unsigned32(AVP):
     equivalent to AVP_Integer32
     """
     
+    #the unpacked value and the payload it was unpacked from
+    __slots__ = ("_value","_value_payload")
+    
     def __init__(self,code,value,vendor_id=0):
         AVP.__init__(self,code,struct.pack("!I",value),vendor_id)
+        self._value_payload = None
     
     def queryValue(self):
         """Returns the payload as a 32-bit unsigned value."""
-        return struct.unpack("!I",self.payload)[0]
+        payload = self.payload
+        if payload is not self._value_payload:
+            self._value = struct.unpack("!I",payload)[0]
+            self._value_payload = payload
+        return self._value
     
     def setValue(self,value):
         """Sets the payload to the specified 32-bit unsigned value."""
@@ -25,13 +33,19 @@ class AVP_Unsigned32(AVP):
 
     def narrow(avp):
         """Convert generic AVP to AVP_Unsigned32
+        The result is cached on avp, so narrowing it again is cheap.
         Raises: InvalidAVPLengthError
         """
-        if len(avp.payload)!=4:
+        a = avp.cachedView(AVP_Unsigned32)
+        if a is not None:
+            return a
+        payload = avp.payload
+        if len(payload)!=4:
             raise InvalidAVPLengthError(avp)
-        value = struct.unpack("!I",avp.payload)[0]
-        a = AVP_Unsigned32(avp.code, value, avp.vendor_id)
+        a = AVP_Unsigned32(avp.code, 0, avp.vendor_id)
+        a.payload = payload
         a.flags = avp.flags
+        avp._view = a
         return a
     narrow = staticmethod(narrow)
 
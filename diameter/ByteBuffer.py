@@ -0,0 +1,168 @@
+class ByteBuffer(object):
+    """A growable byte buffer with read and write cursors.
+    Bytes are appended at the end and consumed from the start by moving
+    cursors in a bytearray, so neither appending nor consuming copies the
+    bytes already in the buffer. The unconsumed bytes are moved to the
+    start of the storage when the consumed space is at least as large as
+    them, and the storage is replaced by a larger one when it is full. This
+    makes the cost per byte constant no matter how much is queued.
+    
+    The buffered bytes can be handed to a socket as a memoryview
+    (readable()), and a socket can receive directly into the buffer with
+    recv_into() (writable() and commit()). The storage is never resized
+    in place, so a memoryview from readable() stays valid until the buffer
+    is modified, but it may then see moved bytes.
+    
+    Example:
+        buf = ByteBuffer()
+        n = sock.recv_into(buf.writable(4096))
+        buf.commit(n)
+        ...
+        n = sock.send(buf.readable())
+        buf.consume(n)
+    """
+    
+    #the storage of an empty buffer is released if it is larger than this
+    max_idle_capacity = 65536
+    
+    #the buffered bytes are _data[_start:_end]
+    __slots__ = ("_data","_start","_end")
+    
+    def __init__(self,data=None):
+        """Constructs a ByteBuffer
+          data  Initial contents (optional)
+        """
+        self._data = bytearray()
+        self._start = 0
+        self._end = 0
+        if data:
+            self.append(data)
+    
+    def __len__(self):
+        return self._end-self._start
+    
+    def capacity(self):
+        """Returns the size of the storage"""
+        return len(self._data)
+    
+    def __makeRoom(self,size):
+        data = self._data
+        if len(data)-self._end>=size:
+            return
+        used = self._end-self._start
+        if self._start>=used and used+size<=len(data):
+            #compact. The bytes moved are no more than the bytes consumed
+            #since the last compaction
+            data[0:used] = data[self._start:self._end]
+        else:
+            capacity = max(2*used+size,4096)
+            new_data = bytearray(capacity)
+            new_data[0:used] = memoryview(data)[self._start:self._end]
+            self._data = new_data
+        self._start = 0
+        self._end = used
+    
+    def append(self,data):
+        """Appends bytes to the buffer
+          data  A string, bytearray or memoryview
+        """
+        size = len(data)
+        if size==0:
+            return
+        self.__makeRoom(size)
+        end = self._end
+        self._data[end:end+size] = data
+        self._end = end+size
+    
+    def writable(self,size):
+        """Returns a memoryview of free space at the end of the buffer.
+        Fill it (eg. with socket.recv_into()) and call commit() with the
+        number of bytes written.
+          size  The minimum number of bytes needed
+        """
+        self.__makeRoom(size)
+        return memoryview(self._data)[self._end:]
+    
+    def commit(self,size):
+        """Adds size bytes written into the memoryview from writable()"""
+        self._end += size
+    
+    def readable(self):
+        """Returns a memoryview of the buffered bytes"""
+        return memoryview(self._data)[self._start:self._end]
+    
+    def getBytes(self,size=None,offset=0):
+        """Returns a copy of buffered bytes as a string
+          size    Number of bytes. Default: all after offset
+          offset  Where to start, relative to the first buffered byte
+        """
+        start = self._start+offset
+        if size is None:
+            end = self._end
+        else:
+            end = min(start+size,self._end)
+        return memoryview(self._data)[start:end].tobytes()
+    
+    def consume(self,size):
+        """Removes size bytes from the start of the buffer"""
+        start = self._start+size
+        if start>=self._end:
+            self._start = 0
+            self._end = 0
+            if len(self._data)>ByteBuffer.max_idle_capacity:
+                self._data = bytearray()
+        else:
+            self._start = start
+    
+    def clear(self):
+        """Removes all bytes from the buffer"""
+        self.consume(len(self))
+
+
+def _unittest():
+    b = ByteBuffer()
+    assert len(b)==0
+    assert b.capacity()==0
+    b.append("hello")
+    b.append(bytearray(" world"))
+    assert len(b)==11
+    assert b.readable().tobytes()=="hello world"
+    assert b.getBytes(5)=="hello"
+    assert b.getBytes(offset=6)=="world"
+    b.consume(6)
+    assert b.getBytes()=="world"
+    b.consume(5)
+    assert len(b)==0
+    
+    #receiving into the buffer
+    b.append("ab")
+    w = b.writable(3)
+    assert len(w)>=3
+    w[0:3] = "cde"
+    del w
+    b.commit(3)
+    assert b.getBytes()=="abcde"
+    
+    #compaction and growth keep the contents
+    b = ByteBuffer()
+    expected = ""
+    for i in xrange(2000):
+        s = chr(ord('a')+i%26)*(i%50)
+        b.append(s)
+        expected += s
+        if i%3==0:
+            n = min(len(b),70)
+            assert b.getBytes(n)==expected[:n]
+            b.consume(n)
+            expected = expected[n:]
+    assert b.getBytes()==expected
+    assert b.capacity()<4*len(expected)+4096
+    
+    #a memoryview of the contents does not block appending
+    b = ByteBuffer("x"*10)
+    r = b.readable()
+    b.append("y"*100000)
+    assert len(b)==100010
+    b.clear()
+    assert len(b)==0
+    assert b.capacity()==0
@@ -18,5 +18,10 @@ class InvalidAVPValueError(Error):
     def __init__(self,avp):
         Error.__init__(self,avp)
 
+class InvalidMessageError(Error):
+    """A message with invalid header or AVP framing was encountered"""
+    def __init__(self,raw=None):
+        Error.__init__(self,raw)
+
 def _unittest():
     pass
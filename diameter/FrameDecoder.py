@@ -0,0 +1,280 @@
+from Message import Message
+from ByteBuffer import ByteBuffer
+from Error import InvalidMessageError
+
+class FrameDecoder(object):
+    """Incremental decoder of the Diameter message framing.
+    Bytes received from a transport are fed to the decoder in whatever
+    pieces they arrive, and complete messages are taken out of it. The
+    decoder remembers the length of a partially received message, so the
+    header is only parsed once and the received pieces are only joined
+    when the message is complete. The cost is linear in the number of
+    bytes no matter how the messages are fragmented.
+    
+    Example:
+        decoder = FrameDecoder()
+        while True:
+            decoder.feed(sock.recv(32768))
+            for msg in decoder.messages():
+                ...
+    
+    Bytes can also be received directly into the decoder with
+    writable() and commit(), which saves allocating a string for every
+    read. The complete messages received that way are copied out in one
+    piece when they are taken out of the decoder:
+        n = sock.recv_into(decoder.writable(4096),4096)
+        decoder.commit(n)
+    
+    The decoder knows nothing about sockets, so it can be used for any
+    stream transport and for replaying captured streams.
+    """
+    
+    #_buf[_pos:] and _chunks hold the _buffered bytes not consumed yet, and
+    #_received (a ByteBuffer or None) the bytes received after them.
+    #_pending is the size of the next message, or 0 if its header has not
+    #been parsed yet.
+    __slots__ = ("_buf","_pos","_chunks","_buffered","_pending","_received")
+    
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._chunks = []
+        self._buffered = 0
+        self._pending = 0
+        self._received = None
+    
+    def feed(self,data):
+        """Adds received bytes to the decoder
+          data  A string (or bytearray/memoryview) with the bytes
+        """
+        if not data:
+            return
+        received = self._received
+        if received is not None and len(received)!=0:
+            #must come after the received bytes
+            received.append(data)
+            return
+        if not isinstance(data,str):
+            data = memoryview(data).tobytes()
+        if self._buffered==0:
+            self._buf = data
+            self._pos = 0
+        else:
+            self._chunks.append(data)
+        self._buffered += len(data)
+    
+    def writable(self,size):
+        """Returns a memoryview to receive bytes into.
+        Fill it (eg. with socket.recv_into()) and call commit() with the
+        number of bytes written. The memoryview must not be used after that.
+        If the size of a partially received message is known the memoryview
+        has room for all of it, so it does not have to be grown piecemeal.
+          size  The minimum number of bytes needed
+        """
+        received = self._received
+        if received is None:
+            received = ByteBuffer()
+            self._received = received
+        if self._buffered==0 and self._pending>len(received)+size:
+            size = self._pending-len(received)
+        return received.writable(size)
+    
+    def commit(self,size):
+        """Adds size bytes written into the memoryview from writable()"""
+        self._received.commit(size)
+    
+    def bufferedBytes(self):
+        """Returns the number of bytes fed but not taken out as messages yet"""
+        if self._received is None:
+            return self._buffered
+        return self._buffered+len(self._received)
+    
+    def pendingSize(self):
+        """Returns the size of the partially received message, or 0 if not known yet"""
+        return self._pending
+    
+    def __coalesce(self):
+        self._buf = self._buf[self._pos:] + "".join(self._chunks)
+        self._pos = 0
+        self._chunks = []
+    
+    def __takeReceived(self):
+        #Moves the complete messages at the start of the received bytes to
+        #_buf as one string. If a message started in the fed bytes all the
+        #received bytes are needed to complete it.
+        received = self._received
+        view = received.readable()
+        available = len(view)
+        if self._buffered!=0:
+            take = available
+        else:
+            take = 0
+            while available-take>=4:
+                size = Message.decodeSizeFrom(view,take)
+                if available-take<size:
+                    if take==0:
+                        self._pending = size
+                    break
+                take += size
+            if take==0:
+                return
+        data = view[:take].tobytes()
+        del view
+        received.consume(take)
+        if self._buffered==0:
+            self._buf = data
+            self._pos = 0
+        else:
+            self._chunks.append(data)
+        self._buffered += take
+    
+    def __nextRange(self):
+        #returns (buffer,offset,size) of the next complete message, or None
+        r = self.__nextBufferedRange()
+        if r is None and self._received is not None and len(self._received)!=0:
+            self.__takeReceived()
+            r = self.__nextBufferedRange()
+        return r
+    
+    def __nextBufferedRange(self):
+        size = self._pending
+        if size==0:
+            if self._buffered<4:
+                return None
+            if len(self._buf)-self._pos<4:
+                self.__coalesce()
+            size = Message.decodeSizeFrom(self._buf,self._pos)
+            self._pending = size
+        if self._buffered<size:
+            return None
+        buf = self._buf
+        pos = self._pos
+        if len(buf)-pos<size:
+            self.__coalesce()
+            buf = self._buf
+            pos = 0
+        self._pos = pos+size
+        if self._pos==len(buf) and not self._chunks:
+            self._buf = ""
+            self._pos = 0
+        self._buffered -= size
+        self._pending = 0
+        return (buf,pos,size)
+    
+    def nextFrame(self):
+        """Takes the next complete message out of the decoder as raw bytes.
+        The frame is not validated beyond what is needed to determine its
+        size, so it may be garbage. See Message.decodeSizeFrom()
+        Returns a string with the message, or None if more bytes are needed
+        """
+        r = self.__nextRange()
+        if r is None:
+            return None
+        buf,pos,size = r
+        if pos==0 and len(buf)==size:
+            return buf
+        return buf[pos:pos+size]
+    
+    def frames(self):
+        """Generator of the complete messages as raw bytes. See nextFrame()"""
+        while True:
+            frame = self.nextFrame()
+            if frame is None:
+                return
+            yield frame
+    
+    def messages(self,lazy=True):
+        """Generator of the complete messages.
+        The messages are decoded directly from the received bytes without
+        copying each of them out first.
+          lazy  Decode the messages lazily. See Message.decodeFrom()
+        Raises: InvalidMessageError with the raw message if a message is
+                garbage. The stream cannot be resynchronized after that.
+        """
+        decoded = Message.decode_status_decoded
+        while True:
+            r = self.__nextRange()
+            if r is None:
+                return
+            buf,pos,size = r
+            msg = Message()
+            if msg.decodeFrom(buf,pos,size,lazy)!=decoded:
+                raise InvalidMessageError(buf[pos:pos+size])
+            yield msg
+
+
+def _unittest():
+    from AVP import AVP
+    m = Message()
+    m.hdr.command_code = 257
+    m.append(AVP(1,"user1"))
+    m.append(AVP(2,"foo",17))
+    raw = str(m.encodeToBuffer())
+    
+    #one byte at a time
+    d = FrameDecoder()
+    got = []
+    for i in xrange(len(raw)*3):
+        d.feed(raw[i%len(raw)])
+        got.extend(d.frames())
+        if i==3:
+            assert d.pendingSize()==len(raw)
+    assert got==[raw,raw,raw]
+    assert d.bufferedBytes()==0
+    assert d.pendingSize()==0
+    
+    #several messages and a partial one in one piece
+    d = FrameDecoder()
+    d.feed(raw+raw+raw[:10])
+    msgs = list(d.messages())
+    assert len(msgs)==2
+    assert msgs[1].hdr.command_code==257
+    assert msgs[1].find(2,17).payload=="foo"
+    assert d.bufferedBytes()==10
+    d.feed(bytearray(raw[10:]))
+    assert d.nextFrame()==raw
+    assert d.nextFrame() is None
+    
+    #garbage
+    d = FrameDecoder()
+    d.feed("\002"+raw[1:])
+    try:
+        list(d.messages())
+        assert False
+    except InvalidMessageError, details:
+        pass
+    d = FrameDecoder()
+    d.feed("\001\000\000\010"+raw)
+    assert len(d.nextFrame())==4
+    
+    #receiving into the decoder, mixed with feeding
+    stream = raw*5
+    d = FrameDecoder()
+    got = []
+    i = 0
+    for n in (3,1,len(raw)*2,5,len(raw)-9,len(raw)+7,len(raw)*5):
+        piece = stream[i:i+n]
+        i += len(piece)
+        if n==5:
+            d.feed(piece)
+        else:
+            w = d.writable(len(piece))
+            assert len(w)>=len(piece)
+            w[0:len(piece)] = piece
+            del w
+            d.commit(len(piece))
+        if n==len(raw)*2:
+            assert d.bufferedBytes()==len(raw)*2+4
+        got.extend(d.frames())
+    assert got==[raw]*5
+    assert d.bufferedBytes()==0
+    
+    #room is made for the rest of a partially received message
+    d = FrameDecoder()
+    w = d.writable(4)
+    w[0:8] = raw[:8]
+    del w
+    d.commit(8)
+    assert d.nextFrame() is None
+    assert d.pendingSize()==len(raw)
+    assert len(d.writable(1))>=len(raw)-8
@@ -1,9 +1,13 @@
 from MessageHeader import MessageHeader
 from AVP import AVP
+from AVP_Encoded import AVP_Encoded
 import binascii
+import struct
 import xdrlib
 
-class Message:
+_uint32 = struct.Struct("!I")
+
+class Message(object):
     """A Diameter message (header and AVPs)
     The Message is a container for the MessageHeader and the AVP s.
     It supports converting to/from the on-the-wire format, and
@@ -35,8 +39,31 @@ class Message:
         avp_reply_message = msg.find(ProtocolConstants.DI_REPLY_MESSAGE)
         if avp:
             #..do something sensible with reply-message
+    
+    A message decoded with lazy=True only has its header and AVP boundaries
+    parsed. AVP objects are created when find(), subset(), indexing or
+    iteration reach them, and the complete AVP list is built the first
+    time the 'avp' member is used or the message is modified.
+    
+    find(), count() and subset() use an index of the AVP positions keyed
+    by (code,vendor_id). The index is built on the first lookup and is
+    dropped when the message is modified with append(), item assignment
+    or item deletion. If you modify the 'avp' list directly, or change the
+    code or vendor_id of an AVP that is already in the message, call
+    invalidateIndex() afterwards.
+    
+    copyAVP() and copyAVPs() copy AVPs from another message, typically
+    when building an answer from a request. AVPs of a message decoded
+    with lazy=True are copied as byte ranges of the received message
+    without being decoded.
     """
     
+    #_lazy is the (buffer,AVP boundaries,materialized AVPs) of a lazily
+    #decoded message, _index the {(code,vendor_id):[position,...]} used by
+    #find/count/subset and _raw the (buffer,AVP boundaries) of an
+    #unmodified lazily decoded message
+    __slots__ = ("hdr","avp","_lazy","_index","_raw")
+    
     def __init__(self,that=None):
         if not that:
             self.hdr = MessageHeader()
@@ -44,6 +71,39 @@ class Message:
         else:
             self.hdr = MessageHeader(that.hdr)
             self.avp = that.avp[:]
+        self._lazy = None
+        self._index = None
+        self._raw = None
+    
+    def __getattr__(self,name):
+        #build the AVP list of a lazily decoded message
+        if name!="avp" or self._lazy is None:
+            raise AttributeError(name)
+        avps = [self.__lazyAVP(i) for i in xrange(len(self._lazy[1]))]
+        self.avp = avps
+        self._lazy = None
+        return avps
+    
+    def __getstate__(self):
+        #copies and pickles must not reference the receive buffer
+        return {"hdr":self.hdr,"avp":self.avp}
+    
+    def __setstate__(self,state):
+        self.hdr = state["hdr"]
+        self.avp = state["avp"]
+        self._lazy = None
+        self._index = None
+        self._raw = None
+    
+    def __lazyAVP(self,i):
+        buf,entries,avps = self._lazy
+        a = avps[i]
+        if a is None:
+            code,vendor_id,offset,size = entries[i]
+            a = AVP()
+            a.decodeFrom(buf,offset,size)
+            avps[i] = a
+        return a
     
     def encodeSize(self):
         """Calculate the size of the message in on-the-wire format.
@@ -58,10 +118,37 @@ class Message:
         """Encode the message in on-the-wire format to the specified byte array.
         packer: xdrlib.Packer
         """
-        sz = self.encodeSize()
-        self.hdr.encode(packer,sz)
+        raw = self.encodeToBuffer()
+        packer.pack_fopaque(len(raw),raw)
+    
+    def encodeInto(self,buf,offset=0,size=None):
+        """Encode the message in on-the-wire format into a preallocated buffer.
+        The header and AVPs are written directly into buf without
+        intermediate copies.
+          buf     A bytearray (or writable memoryview) with room for
+                  encodeSize() bytes at offset
+          offset  Where to put the message
+          size    The result of encodeSize() if the caller already knows it
+        Returns the offset just after the message
+        """
+        if size is None:
+            size = self.encodeSize()
+        self.hdr.encodeInto(buf,offset,size)
+        pos = offset+20
         for a in self.avp:
-            a.encode(packer)
+            pos = a.encodeInto(buf,pos)
+        return pos
+    
+    def encodeToBuffer(self):
+        """Encode the message in on-the-wire format.
+        The size is calculated once and the message is encoded in a single
+        pass into a bytearray of exactly that size.
+        Returns the bytearray
+        """
+        sz = self.encodeSize()
+        buf = bytearray(sz)
+        self.encodeInto(buf,0,sz)
+        return buf
     
     def decodeSize(unpacker):
         """Determine the complete size of the message from a on-the-wire
@@ -70,31 +157,57 @@ class Message:
           unpacker: a xdrlib.Unpacker
         Returns the size (in bytes) of the message
         """
-        start = unpacker.get_position()
-        v_ml = unpacker.unpack_uint()
-        unpacker.set_position(start)
+        return Message.decodeSizeFrom(unpacker.get_buffer(),unpacker.get_position())
+    decodeSize = staticmethod(decodeSize)
+    
+    def decodeSizeFrom(buf,offset):
+        """Determine the complete size of the message starting at buf[offset]
+        There must be at least 4 bytes available in the buffer.
+          buf     a string or memoryview
+          offset  where the message starts
+        Returns the size (in bytes) of the message
+        """
+        v_ml = _uint32.unpack_from(buf,offset)[0]
         sz = v_ml&0x00FFFFFF
         if sz<20: sz=4 #interesting hack to detect NUL bytes
         if (sz % 4)!=0: sz=20 #interesting hack to detect NUL bytes
         return sz
-    decodeSize = staticmethod(decodeSize)
+    decodeSizeFrom = staticmethod(decodeSizeFrom)
     
     decode_status_decoded = 1
     decode_status_not_enough = 2
     decode_status_garbage = 3
     
-    def decode(self,unpacker,bytes):
+    def decode(self,unpacker,bytes,lazy=False):
         """Decode a message from on-the-wire format.
         The message is checked to be in valid format and the VPs to be of
         the correct length etc. Invalid/reserved bits are not checked.
           unpacker  a xdrlib.Unpacker possibly containing a Diameter message
           bytes  the bytes to try to decode
+          lazy   only parse the header and AVP boundaries. See decodeFrom()
         Return the result for the decode operation.
         """
         start = unpacker.get_position()
+        status = self.decodeFrom(unpacker.get_buffer(),start,bytes,lazy)
+        if status==Message.decode_status_decoded:
+            unpacker.set_position(start+Message.decodeSizeFrom(unpacker.get_buffer(),start))
+        return status
+    
+    def decodeFrom(self,buf,offset,bytes,lazy=False):
+        """Decode a message from on-the-wire format without copying it.
+        Works like decode() but reads directly from buf. The AVP payloads
+        reference buf until they are accessed, so buf must not be modified
+        while the message is in use. Immutable strings are always safe.
+          buf     a string or memoryview possibly containing a Diameter message
+          offset  where the message starts
+          bytes   the bytes to try to decode
+          lazy    If true only the header is decoded and the AVP framing
+                  is validated. AVPs are created when they are accessed.
+        Return the result for the decode operation.
+        """
         if bytes < 4:
             return Message.decode_status_not_enough
-        v_ml = unpacker.unpack_uint()
+        v_ml = _uint32.unpack_from(buf,offset)[0]
         version = v_ml>>24
         sz = v_ml&0x00FFFFFF
         if version!=1:
@@ -104,28 +217,29 @@ class Message:
         if (sz%4)!=0:
             return Message.decode_status_garbage
         
-        unpacker.set_position(start)
-        
         # header looks ok
         if bytes<sz:
             return Message.decode_status_not_enough
         
-        self.hdr.decode(unpacker)
-        self.avp = []
-        bytes_left = bytes - 20
-        while bytes_left>0:
-            if bytes_left<8:
+        self.hdr.decodeFrom(buf,offset)
+        self._index = None
+        if lazy:
+            entries = AVP.scanList(buf,offset+20,sz-20)
+            if entries is None:
                 return Message.decode_status_garbage
-            avp_sz = AVP.decodeSize(unpacker,bytes_left)
-            if avp_sz==0:
-                return Message.decode_status_garbage
-            if avp_sz > bytes_left:
+            try:
+                del self.avp
+            except AttributeError:
+                pass
+            self._lazy = (buf,entries,[None]*len(entries))
+            self._raw = (buf,entries)
+        else:
+            avps = AVP.decodeList(buf,offset+20,sz-20)
+            if avps is None:
                 return Message.decode_status_garbage
-            a = AVP(0,[])
-            a.decode(unpacker,avp_sz)
-            self.avp.append(a)
-            bytes_left -= avp_sz
-            
+            self.avp = avps
+            self._lazy = None
+            self._raw = None
         return Message.decode_status_decoded
     
     def prepareResponse(self, request):
@@ -138,57 +252,154 @@ class Message:
     #clone?
     
     def __len__(self):
+        if self._lazy is not None:
+            return len(self._lazy[1])
         return len(self.avp)
     
     def __getitem__(self,key):
+        if self._lazy is not None and isinstance(key,(int,long)):
+            if key<0:
+                key += len(self._lazy[1])
+                if key<0:
+                    raise IndexError(key)
+            return self.__lazyAVP(key)
         return self.avp[key]
     
     def __setitem__(self,key,value):
         self.avp[key] = value
+        self._index = None
+        self._raw = None
     
     def __delitem__(self,key):
         del self.avp[key]
+        self._index = None
+        self._raw = None
     
     def __iter__(self):
+        if self._lazy is not None:
+            return self.__lazyIter()
         return self.avp.__iter__()
     
+    def __lazyIter(self):
+        i = 0
+        while i<len(self):
+            yield self[i]
+            i += 1
+    
     def append(self,a):
         """Appends an AVP to the message"""
         self.avp.append(a)
+        self._index = None
+        self._raw = None
+    
+    def invalidateIndex(self):
+        """Forget the AVP index used by find(), count() and subset().
+        Only needed after modifying the 'avp' list directly or changing the
+        code/vendor_id of an AVP in the message.
+        """
+        self._index = None
+        self._raw = None
+    
+    def __buildIndex(self):
+        index = {}
+        if self._lazy is not None:
+            i = 0
+            for e in self._lazy[1]:
+                key = (e[0],e[1])
+                positions = index.get(key)
+                if positions is None:
+                    index[key] = [i]
+                else:
+                    positions.append(i)
+                i += 1
+        else:
+            i = 0
+            for a in self.avp:
+                key = (a.code,a.vendor_id)
+                positions = index.get(key)
+                if positions is None:
+                    index[key] = [i]
+                else:
+                    positions.append(i)
+                i += 1
+        self._index = index
+        return index
     
     def subset(self,code,vendor_id=0):
         """Returns an iteratable subset of the AVPs where the code and vendor_id match"""
-        class avp_subset:
-            "A subset of the AVPs in a message"
-            
-            def __init__(self, message, code, vendor_id):
-                self.message = message
-                self.code = code
-                self.vendor_id = vendor_id
-                self.iter = message.__iter__()
-            
-            def __iter__(self):
-                return self
-            def next(self):
-                while True:
-                    a = self.iter.next()
-                    if a.code==self.code and a.vendor_id==self.vendor_id:
-                        return a
-        return avp_subset(self,code,vendor_id)
+        index = self._index
+        if index is None:
+            index = self.__buildIndex()
+        positions = index.get((code,vendor_id),())
+        return (self[i] for i in positions)
+    
+    def __copyOf(self,i):
+        raw = self._raw
+        if raw is not None:
+            buf,entries = raw
+            code,vendor_id,offset,size = entries[i]
+            return AVP_Encoded(buf,offset,size)
+        a = self[i]
+        buf = bytearray(a.encodeSize())
+        a.encodeInto(buf,0)
+        return AVP_Encoded(buf)
+    
+    def copyAVP(self,source,code,vendor_id=0,new_code=None):
+        """Appends a copy of the first AVP in source with a matching code and vendor_id.
+        If source was decoded with lazy=True and has not been modified
+        the AVP is copied as raw bytes as it was received.
+          source    The message to copy from, typically a request
+          code      The AVP code
+          vendor_id The AVP vendor_id
+          new_code  If not None the copy gets this code instead, eg. when
+                    answering a Requested-Service-Unit with a
+                    Granted-Service-Unit.
+        Returns the copy, or None if source has no matching AVP
+        """
+        index = source._index
+        if index is None:
+            index = source.__buildIndex()
+        positions = index.get((code,vendor_id))
+        if not positions:
+            return None
+        a = source.__copyOf(positions[0])
+        if new_code is not None:
+            a.code = new_code
+        self.append(a)
+        return a
+    
+    def copyAVPs(self,source,code,vendor_id=0):
+        """Appends copies of all AVPs in source with a matching code and vendor_id.
+        The AVPs are copied as described for copyAVP().
+        Returns the number of AVPs copied
+        """
+        index = source._index
+        if index is None:
+            index = source.__buildIndex()
+        positions = index.get((code,vendor_id),())
+        for i in positions:
+            self.append(source.__copyOf(i))
+        return len(positions)
     
     def find(self,code,vendor_id=0):
         """Returns the first AVP with a matching code (and vendor_id if nonzero)."""
-        for a in self.avp:
-            if a.code==code and a.vendor_id==vendor_id:
-                return a
+        index = self._index
+        if index is None:
+            index = self.__buildIndex()
+        positions = index.get((code,vendor_id))
+        if positions:
+            return self[positions[0]]
+        return None
     
     def count(self,code,vendor_id=0):
         """Return the number of AVPs that matches the specified code (and vendor_id if nonzero)"""
-        c=0
-        for a in self.avp:
-            if a.code==code and a.vendor_id==vendor_id:
-                c += 1
-        return c
+        index = self._index
+        if index is None:
+            index = self.__buildIndex()
+        positions = index.get((code,vendor_id))
+        if positions:
+            return len(positions)
+        return 0
 
 def _unittest():
     m1 = Message()
@@ -278,3 +489,129 @@ def _unittest():
     m7 = Message()
     assert m7.decode(u,len(raw))==Message.decode_status_garbage
     
+    
+    #decode directly from a buffer containing two messages
+    raw = binascii.a2b_hex("0100003000000000000000000000000000000000000000010000000d7573657231000000000000020000000c666f6f31")
+    raw2 = raw+raw
+    assert Message.decodeSizeFrom(raw2,48)==48
+    m8 = Message()
+    assert m8.decodeFrom(raw2,48,48)==Message.decode_status_decoded
+    assert len(m8)==2
+    assert m8[0].payload=="user1"
+    assert m8[1].payload=="foo1"
+    m8 = Message()
+    assert m8.decodeFrom(memoryview(raw2),0,len(raw2))==Message.decode_status_decoded
+    assert len(m8)==2
+    assert m8.find(2).payload=="foo1"
+    m8 = Message()
+    assert m8.decodeFrom(raw2,48,47)==Message.decode_status_not_enough
+    
+    #encode into buffers
+    m9 = Message()
+    m9.hdr.command_code = 257
+    m9.append(AVP(1,"user1"))
+    m9.append(AVP(2,"foo",17))
+    raw = m9.encodeToBuffer()
+    assert len(raw)==m9.encodeSize()
+    p = xdrlib.Packer()
+    m9.encode(p)
+    assert p.get_buffer()==str(raw)
+    buf = bytearray(len(raw)+8)
+    assert m9.encodeInto(buf,8)==len(buf)
+    assert buf[8:]==raw
+    m10 = Message()
+    assert m10.decodeFrom(str(raw),0,len(raw))==Message.decode_status_decoded
+    assert m10.hdr.command_code==257
+    assert m10[1].vendor_id==17 and m10[1].payload=="foo"
+    
+    #lazy decoding
+    raw = binascii.a2b_hex("0100003000000000000000000000000000000000000000010000000d7573657231000000000000020000000c666f6f31")
+    m11 = Message()
+    assert m11.decodeFrom(raw,0,len(raw),lazy=True)==Message.decode_status_decoded
+    assert len(m11)==2
+    assert m11.count(1)==1
+    assert m11.count(117)==0
+    a = m11.find(2)
+    assert a.payload=="foo1"
+    assert m11[1] is a
+    assert m11[-1] is a
+    assert m11[-2].payload=="user1"
+    assert [x.code for x in m11]==[1,2]
+    assert [x.payload for x in m11.subset(1)]==["user1"]
+    assert m11.find(117) is None
+    assert str(m11.encodeToBuffer())==raw
+    m11.append(AVP(3,"bar"))
+    assert len(m11)==3
+    assert m11[1] is a
+    assert m11.find(3).payload=="bar"
+    m12 = Message()
+    u = xdrlib.Unpacker(raw)
+    assert m12.decode(u,len(raw),lazy=True)==Message.decode_status_decoded
+    assert u.get_position()==len(raw)
+    import copy
+    assert copy.deepcopy(m12).find(1).payload=="user1"
+    assert Message(m12).find(1).payload=="user1"
+    assert len(m12.avp)==2
+    raw = binascii.a2b_hex("0100002c00000000000000000000000000000000000000010000000d7573657231000000000000020000000c666f6f")
+    m13 = Message()
+    assert m13.decodeFrom(raw,0,len(raw),lazy=True)==Message.decode_status_garbage
+    
+    #the index follows modifications
+    m14 = Message()
+    m14.append(AVP(1,"a"))
+    m14.append(AVP(2,"b"))
+    m14.append(AVP(1,"c",7))
+    m14.append(AVP(1,"d"))
+    assert m14.count(1)==2
+    assert m14.count(1,7)==1
+    assert [x.payload for x in m14.subset(1)]==["a","d"]
+    m14.append(AVP(1,"e"))
+    assert m14.count(1)==3
+    del m14[0]
+    assert m14.find(1).payload=="d"
+    m14[0] = AVP(3,"f")
+    assert m14.find(2) is None
+    assert m14.find(3).payload=="f"
+    m14.avp.append(AVP(4,"g"))
+    m14.invalidateIndex()
+    assert m14.find(4).payload=="g"
+    
+    #copying AVPs into an answer
+    req = Message()
+    req.hdr.setRequest(True)
+    req.append(AVP(263,"session"))
+    req.append(AVP(284,"proxy1"))
+    req.append(AVP(437,"rsu").setM())
+    req.append(AVP(284,"proxy2"))
+    raw = str(req.encodeToBuffer())
+    for lazy in (False,True):
+        r = Message()
+        r.decodeFrom(raw,0,len(raw),lazy)
+        ans = Message()
+        ans.prepareResponse(r)
+        assert ans.copyAVP(r,263).payload=="session"
+        assert ans.copyAVP(r,999) is None
+        assert ans.copyAVP(r,437,new_code=431).code==431
+        assert ans.copyAVPs(r,284)==2
+        ans.append(AVP(268,"rc"))
+        ans2 = Message()
+        ans2.decodeFrom(str(ans.encodeToBuffer()),0,ans.encodeSize())
+        assert [(x.code,x.payload) for x in ans2]==[(263,"session"),(431,"rsu"),(284,"proxy1"),(284,"proxy2"),(268,"rc")]
+        assert ans2.find(431).isMandatory()
+        #modified messages are copied as they are now
+        r[0] = AVP(263,"other")
+        assert ans.copyAVP(r,263).payload=="other"
+    
+    #copies and pickles of lazily decoded messages
+    import copy
+    import pickle
+    r = Message()
+    r.decodeFrom(memoryview(raw),0,len(raw),True)
+    for c in (copy.deepcopy(r),pickle.loads(pickle.dumps(r,0)),pickle.loads(pickle.dumps(r,2))):
+        assert c.hdr.isRequest()
+        assert len(c)==4
+        assert c.find(437).payload=="rsu"
+        assert c.find(437).isMandatory()
+        assert str(c.encodeToBuffer())==raw
+    assert not hasattr(r,"__dict__")
+    assert not hasattr(r.hdr,"__dict__")
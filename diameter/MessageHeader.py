@@ -1,6 +1,9 @@
 from xdrlib import Packer,Unpacker
+import struct
 
-class MessageHeader:
+_header = struct.Struct("!IIIII")
+
+class MessageHeader(object):
     """The header component of a message.
     See RFC3588 section 3. After you have read that understanding the
     class is trivial. The only fields and methods you will normally use
@@ -21,6 +24,9 @@ class MessageHeader:
     command_flag_error_bit      = 0x20
     command_flag_retransmit_bit = 0x10
     
+    __slots__ = ("version","command_flags","command_code","application_id",
+                 "hop_by_hop_identifier","end_to_end_identifier")
+    
     def __init__(self,that=None):
         """Constructor for MessageHeader.
         If 'that' is None then the command flags are initialized to
@@ -43,6 +49,13 @@ class MessageHeader:
             self.hop_by_hop_identifier = that.hop_by_hop_identifier
             self.end_to_end_identifier = that.end_to_end_identifier
     
+    def __getstate__(self):
+        return dict([(name,getattr(self,name)) for name in MessageHeader.__slots__])
+    
+    def __setstate__(self,state):
+        for name,value in state.iteritems():
+            setattr(self,name,value)
+    
     def isRequest(self):
         return (self.command_flags&MessageHeader.command_flag_request_bit)!=0
     def isProxiable(self):
@@ -88,15 +101,26 @@ class MessageHeader:
         packer.pack_uint(self.hop_by_hop_identifier);
         packer.pack_uint(self.end_to_end_identifier);
     
+    def encodeInto(self,buf,offset,message_length):
+        """Encode the header into buf[offset:offset+20]"""
+        _header.pack_into(buf,offset,
+                          (self.version<<24)|message_length,
+                          (self.command_flags<<24)|self.command_code,
+                          self.application_id,
+                          self.hop_by_hop_identifier,
+                          self.end_to_end_identifier)
+    
     def decode(self,unpacker):
-        v_ml = unpacker.unpack_uint();
-        self.version = v_ml>>24;
-        f_code = unpacker.unpack_uint();
-        self.command_flags = f_code>>24;
-        self.command_code = f_code&0x00FFFFFF;
-        self.application_id = unpacker.unpack_uint()
-        self.hop_by_hop_identifier = unpacker.unpack_uint()
-        self.end_to_end_identifier = unpacker.unpack_uint()
+        start = unpacker.get_position()
+        self.decodeFrom(unpacker.get_buffer(),start)
+        unpacker.set_position(start+20)
+    
+    def decodeFrom(self,buf,offset):
+        """Decode the header from the 20 bytes at buf[offset:]"""
+        v_ml,f_code,self.application_id,self.hop_by_hop_identifier,self.end_to_end_identifier = _header.unpack_from(buf,offset)
+        self.version = v_ml>>24
+        self.command_flags = f_code>>24
+        self.command_code = f_code&0x00FFFFFF
     
     def prepareResponse(self,request):
         """Prepare a response from the specified request header.
@@ -168,3 +192,7 @@ def _unittest():
     assert mh3.command_code == mh.command_code
     assert mh3.hop_by_hop_identifier == mh.hop_by_hop_identifier
     assert mh3.end_to_end_identifier == mh.end_to_end_identifier
+    
+    buf = bytearray(20)
+    mh.encodeInto(buf,0,ml)
+    assert str(buf)==p.get_buffer()
@@ -71,8 +71,7 @@ def copyProxyInfo(source,destination):
          from  The source message.
          to   The destination message.
     """
-    for a in source.subset(ProtocolConstants.DI_PROXY_INFO):
-        destination.append(AVP(a.code,a.payload,a.vendor_id))
+    destination.copyAVPs(source,ProtocolConstants.DI_PROXY_INFO)
 
 
 rfc4006_mandatory_codes = frozenset([
@@ -12,6 +12,12 @@ ProtocolConstants contains symbolic constants from the RFCs.
 Utils contains some utilities that a useful, particular for setting the
 M-bit on AVPs.
 
+FrameDecoder splits a received byte stream into messages. ByteBuffer is
+the buffer used for sending and receiving.
+
+AVPDictionary maps AVP codes to their types and M-bit rules. AVPs with a
+code that must have the M-bit get it set when they are constructed.
+
 
 Note: The following AVP types described in RFC358 have not been implemented:
     DiameterIdentity
@@ -28,6 +34,7 @@ Note: The following AVP types described in RFC358 have not been implemented:
 
 from AVP import AVP
 from AVP_Address import AVP_Address
+from AVP_Encoded import AVP_Encoded
 from AVP_Float32 import AVP_Float32
 from AVP_Float64 import AVP_Float64
 from AVP_Grouped import AVP_Grouped
@@ -36,7 +43,10 @@ from AVP_Time import AVP_Time
 from AVP_UTF8String import AVP_UTF8String
 from AVP_Unsigned32 import AVP_Unsigned32
 from AVP_Unsigned64 import AVP_Unsigned64
-from Error import InvalidAVPLengthError,InvalidAddressTypeError,InvalidAVPValueError
+from ByteBuffer import ByteBuffer
+import AVPDictionary
+from Error import InvalidAVPLengthError,InvalidAddressTypeError,InvalidAVPValueError,InvalidMessageError
+from FrameDecoder import FrameDecoder
 from Message import Message
 from MessageHeader import MessageHeader
 from ProtocolConstants import *
@@ -2,8 +2,10 @@ from diameter.AVP_Grouped import AVP_Grouped
 import diameter.ProtocolConstants
 
 class AVP_FailedAVP(AVP_Grouped):
+    __slots__ = ()
+    
     def __init__(self,a,vendor_id=0):
-        AVP_Grouped.__init__(self,[a],vendor_id)
+        AVP_Grouped.__init__(self,diameter.ProtocolConstants.DI_FAILED_AVP,[a],vendor_id)
 
 
 def _unittest():
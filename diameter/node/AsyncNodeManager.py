@@ -0,0 +1,163 @@
+import logging
+from diameter.node.NodeManager import NodeManager
+from diameter.node.Future import Future
+from diameter import Message
+
+class AsyncNodeManager(NodeManager):
+    """A NodeManager with requests and answers as futures.
+    sendRequest() returns a Future for the answer instead of blocking the
+    calling thread, so any number of requests can be outstanding without
+    a thread or a condition variable for each of them. Handlers of incoming
+    requests can likewise return a Future for the answer and complete it
+    later from any thread, eg. when a database lookup finishes.
+    
+    The callbacks of the answer futures are called by the networking
+    thread (or by the executor, see NodeManager.setExecutor()), so they
+    must not block. See NodeManager.handleAnswer()
+    """
+    
+    def __init__(self,settings,src=None):
+        """
+        Constructor for AsyncNodeManager.
+        See NodeManager.__init__()
+        """
+        NodeManager.__init__(self,settings,src)
+    
+    def sendRequest(self,request,peers):
+        """
+        Sends a request to one of the peers.
+          request  The request to send
+          peers    The candidate peers
+        Returns: A Future with the answer as result. The result is None if
+                 the connection is lost before the answer arrives.
+        Raises:
+          NotARequestError
+            If the request does not have the R bit set in the header.
+          NotRoutableError
+            If the request could not be sent to any of the peers.
+        """
+        future = Future()
+        self.sendRequest_any(request,peers,future)
+        return future
+    
+    def handleAnswer(self,answer,answer_connkey,state):
+        "Completes the future of the request"
+        state.setResult(answer)
+    
+    def handleRequest(self,request,connkey,peer):
+        """
+        Handle a request.
+        This method is meant to be overridden by a subclass. It can return
+        the answer as a Message, a Future with the answer as result, or
+        None if it has answered (or will answer) with answer() itself.
+        This implementation rejects all requests.
+        """
+        NodeManager.handleRequest(self,request,connkey,peer)
+    
+    def __answerWhenDone(self,future,connkey):
+        answer = future.getResult()
+        if answer is None:
+            self.logger.log(logging.DEBUG,"Request handler completed without an answer")
+            return
+        self.answer(answer,connkey)
+    
+    def _callHandleRequest(self,request,connkey,peer):
+        #sends the answer returned by handleRequest()
+        r = self.handleRequest(request,connkey,peer)
+        if isinstance(r,Future):
+            r.addCallback(lambda future: self.__answerWhenDone(future,connkey))
+        elif isinstance(r,Message):
+            self.answer(r,connkey)
+
+
+def _unittest():
+    import threading
+    import time
+    from diameter.node.Executor import Executor
+    from diameter.node import Capability,NodeSettings,Peer
+    from diameter import ProtocolConstants,AVP_UTF8String,AVP_Unsigned32
+    
+    class Server(AsyncNodeManager):
+        def handleRequest(self,request,connkey,peer):
+            answer = Message()
+            answer.prepareResponse(request)
+            answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+            self.node.addOurHostAndRealm(answer)
+            if request.find(ProtocolConstants.DI_USER_NAME):
+                #answered later by another thread
+                future = Future()
+                threading.Timer(0.01,future.setResult,(answer,)).start()
+                return future
+            return answer
+    
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_NASREQ)
+    server = Server(NodeSettings("127.0.0.1","i1.dk",1,cap,3869,"pythondiameter",1))
+    server.start()
+    client = AsyncNodeManager(NodeSettings("client.i1.dk","i1.dk",1,cap,0,"pythondiameter",1))
+    client.start()
+    peer = Peer("127.0.0.1",3869)
+    client.node.initiateConnection(peer,True)
+    client.waitForConnection(5)
+    
+    futures = []
+    for i in range(10):
+        msg = Message()
+        msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_NASREQ
+        msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_AA
+        msg.hdr.setRequest(True)
+        client.node.addOurHostAndRealm(msg)
+        msg.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_NASREQ))
+        if i%2:
+            msg.append(AVP_UTF8String(ProtocolConstants.DI_USER_NAME,"user%d"%i))
+        futures.append(client.sendRequest(msg,[peer]))
+    for future in futures:
+        answer = future.getResult(5)
+        assert answer is not None
+        assert AVP_Unsigned32.narrow(answer.find(ProtocolConstants.DI_RESULT_CODE)).queryValue()==ProtocolConstants.DIAMETER_RESULT_SUCCESS
+    
+    #with an executor the requests of a session are handled in order
+    class SlowServer(Server):
+        def __init__(self,settings):
+            Server.__init__(self,settings)
+            self.handled = {}
+        def handleRequest(self,request,connkey,peer):
+            session_id = AVP_UTF8String.narrow(request.find(ProtocolConstants.DI_SESSION_ID)).queryValue()
+            self.handled.setdefault(session_id,[]).append(request.hdr.end_to_end_identifier)
+            time.sleep(0.01)
+            return Server.handleRequest(self,request,connkey,peer)
+    slow_server = SlowServer(NodeSettings("127.0.0.1","i1.dk",1,cap,3871,"pythondiameter",1))
+    slow_server.setExecutor(Executor(2,100))
+    slow_server.start()
+    slow_peer = Peer("127.0.0.1",3871)
+    slow_client = AsyncNodeManager(NodeSettings("client.i1.dk","i1.dk",1,cap,0,"pythondiameter",1))
+    slow_client.start()
+    slow_client.node.initiateConnection(slow_peer,True)
+    slow_client.waitForConnection(5)
+    def sendRequests(session_ids):
+        futures = []
+        sent = {}
+        for session_id in session_ids:
+            msg = Message()
+            msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_NASREQ
+            msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_AA
+            msg.hdr.setRequest(True)
+            msg.append(AVP_UTF8String(ProtocolConstants.DI_SESSION_ID,session_id))
+            slow_client.node.addOurHostAndRealm(msg)
+            msg.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_NASREQ))
+            futures.append(slow_client.sendRequest(msg,[slow_peer]))
+            sent.setdefault(session_id,[]).append(msg.hdr.end_to_end_identifier)
+        return [AVP_Unsigned32.narrow(future.getResult(5).find(ProtocolConstants.DI_RESULT_CODE)).queryValue() for future in futures],sent
+    result_codes,sent = sendRequests(["s1","s2","s3"]*5)
+    assert result_codes==[ProtocolConstants.DIAMETER_RESULT_SUCCESS]*15
+    assert slow_server.handled==sent
+    #requests are rejected when the queue is full
+    slow_server.executor.queue_size = 1
+    result_codes,sent = sendRequests(["s4"]*5)
+    assert ProtocolConstants.DIAMETER_RESULT_TOO_BUSY in result_codes
+    assert slow_server.getStatistics()["rejected"]>0
+    slow_client.stop()
+    slow_server.stop()
+    
+    client.stop()
+    server.stop()
@@ -0,0 +1,38 @@
+import time
+import sys
+
+#Timers must not be affected by changes of the wall clock, but Python 2
+#has no time.monotonic(). clock_gettime(CLOCK_MONOTONIC) is called through
+#ctypes where it is available (Linux). Elsewhere the wall clock is used.
+
+monotonic = time.time
+
+if sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        import ctypes.util
+        
+        class _timespec(ctypes.Structure):
+            _fields_ = [("tv_sec",ctypes.c_long),("tv_nsec",ctypes.c_long)]
+        
+        _CLOCK_MONOTONIC = 1
+        _libc = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"),use_errno=True)
+        _clock_gettime = _libc.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int,ctypes.POINTER(_timespec)]
+        
+        def monotonic():
+            """Returns the time in seconds since an arbitrary point in the past"""
+            ts = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC,ctypes.byref(ts))!=0:
+                raise OSError(ctypes.get_errno(),"clock_gettime(CLOCK_MONOTONIC) failed")
+            return ts.tv_sec + ts.tv_nsec*1e-9
+        monotonic()
+    except (ImportError,OSError,AttributeError):
+        monotonic = time.time
+
+
+def _unittest():
+    t1 = monotonic()
+    time.sleep(0.01)
+    t2 = monotonic()
+    assert t2-t1>=0.009
@@ -1,11 +1,13 @@
 from ConnectionTimers import ConnectionTimers
 from ConnectionBuffers import NormalConnectionBuffers
+from diameter.FrameDecoder import FrameDecoder
 import random
+import threading
 
-class ConnectionKey:
-    pass
+class ConnectionKey(object):
+    __slots__ = ()
 
-class Connection:
+class Connection(object):
     #public Peer peer;  //initially null
     #public String host_id; //always set, updated from CEA/CER
     #public ConnectionTimers timers;
@@ -13,6 +15,15 @@ class Connection:
     #private int hop_by_hop_identifier_seq;
     #SocketChannel channel;
     #ConnectionBuffers connection_buffers;
+    #FrameDecoder decoder; //received bytes not consumed as messages yet
+    #int read_size; //size of the next recv()
+    #boolean congested; //over the output high watermark, not yet down to the low
+    #list congestion_reports; //transitions not reported to the listener yet
+    #Reactor reactor; //the I/O loop the connection belongs to
+    #Lock lock; //protects the output: buffers, congested, corked, counters
+    #Condition output_space_cv; //notified when no longer congested or closed
+    #boolean corked; //output is corked, see NodeSettings.setCorkWindow()
+    #int messages_sent, send_calls;
     
     state_connecting=0
     state_connected_in=1  #connected, waiting for cer
@@ -22,6 +33,18 @@ class Connection:
     state_closing=5       #DPR sent, waiting for DPA
     state_closed=6
     
+    #bounds of the adaptive read size. Connections that get little data
+    #use small reads, so they only keep small receive buffers
+    min_read_size = 4096
+    max_read_size = 65536
+    
+    #there can be many idle connections so they have no __dict__
+    __slots__ = ("peer","host_id","timers","key","hop_by_hop_identifier_seq",
+                 "fd","state","connection_buffers","decoder","read_size",
+                 "congested","congestion_reports","reactor","lock",
+                 "output_space_cv","corked",
+                 "messages_sent","send_calls")
+    
     def __init__(self):
         self.peer = None
         self.host_id = None
@@ -31,14 +54,37 @@ class Connection:
         self.fd = None
         self.state = Connection.state_connected_in
         self.connection_buffers = NormalConnectionBuffers()
+        self.decoder = FrameDecoder()
+        self.read_size = Connection.min_read_size
+        self.congested = False
+        self.congestion_reports = []
+        self.reactor = None
+        self.lock = threading.Lock()
+        self.output_space_cv = threading.Condition(self.lock)
+        self.corked = False
+        self.messages_sent = 0
+        self.send_calls = 0
     
     def nextHopByHopIdentifier(self):
+        self.lock.acquire()
         v = self.hop_by_hop_identifier_seq
         self.hop_by_hop_identifier_seq += 1
+        self.lock.release()
         return v
     
     def appendNetInBuffer(self,stuff):
-        self.connection_buffers.appendNetInBuffer(stuff)
+        self.decoder.feed(stuff)
+    def adjustReadSize(self,bytes):
+        """Adapts the read size to the number of bytes the last recv() got.
+        It is doubled when a read fills it and halved when a read gets less
+        than a quarter of it.
+        """
+        size = self.read_size
+        if bytes>=size:
+            if size<Connection.max_read_size:
+                self.read_size = size*2
+        elif bytes<size/4 and size>Connection.min_read_size:
+            self.read_size = size/2
     def appendAppOutputBuffer(self,stuff):
         self.connection_buffers.appendAppOutputBuffer(stuff)
 	
@@ -48,19 +94,41 @@ class Connection:
         self.connection_buffers.processAppOutBuffer()
     
     def hasAppInput(self):
-        return self.connection_buffers.hasAppInput()
+        return self.decoder.bufferedBytes()!=0
     def hasNetOutput(self):
         return self.connection_buffers.hasNetOutput()
     
-    def getAppInBuffer(self):
-        return self.connection_buffers.getAppInBuffer()
     def getNetOutBuffer(self):
         return self.connection_buffers.getNetOutBuffer()
+    def netOutputBytes(self):
+        return self.connection_buffers.netOutputBytes()
     
-    def consumeAppInBuffer(self,bytes):
-        self.connection_buffers.consumeAppInBuffer(bytes)
     def consumeNetOutBuffer(self,bytes):
         self.connection_buffers.consumeNetOutBuffer(bytes)
     
 def _unittest():
-    pass
+    c = Connection()
+    assert c.state==Connection.state_connected_in
+    v = c.nextHopByHopIdentifier()
+    assert c.nextHopByHopIdentifier()==v+1
+    c.appendAppOutputBuffer("abc")
+    assert c.hasNetOutput()
+    c.consumeNetOutBuffer(3)
+    assert not c.hasNetOutput()
+    assert not hasattr(c,"__dict__")
+    d = {c.key:c}
+    assert d[c.key] is c
+    assert Connection().key not in d
+    c.appendNetInBuffer("\001\000\000")
+    assert c.hasAppInput()
+    assert c.decoder.nextFrame() is None
+    
+    c.adjustReadSize(Connection.min_read_size)
+    assert c.read_size==Connection.min_read_size*2
+    for i in range(20):
+        c.adjustReadSize(c.read_size)
+    assert c.read_size==Connection.max_read_size
+    c.adjustReadSize(100)
+    assert c.read_size==Connection.max_read_size/2
+    c.adjustReadSize(c.read_size/2)
+    assert c.read_size==Connection.max_read_size/2
@@ -1,10 +1,13 @@
-class ConnectionBuffers:
+from collections import deque
+
+class ConnectionBuffers(object):
     #abstract ByteBuffer netOutBuffer();
     #abstract ByteBuffer netInBuffer();
     #abstract ByteBuffer appInBuffer();
     #abstract ByteBuffer appOutBuffer();
     #abstract void processNetInBuffer();
     #abstract void processAppOutBuffer();
+    __slots__ = ()
     
     def __init__(self):
         pass
@@ -12,9 +15,6 @@ class ConnectionBuffers:
     def consumeNetOutBuffer(self,bytes):
         pass #todo
     
-    def consumeAppInBuffer(self,bytes):
-        pass #todo
-    
     
 #    static private void consume(ByteBuffer bb, int bytes) {
 #        bb.limit(bb.position());
@@ -22,35 +22,163 @@ class ConnectionBuffers:
 #        bb.compact();
 
 class NormalConnectionBuffers(ConnectionBuffers):
+    #Received bytes go straight to the FrameDecoder of the Connection.
+    #Output is a queue of buffers. Small messages are appended in place to
+    #a bytearray at the tail of the queue, so a burst of them is sent with
+    #few send() calls, and large messages are queued as they are, so they
+    #are never copied. A partial send only moves an offset into the first
+    #buffer.
+    
+    #messages smaller than this are copied into the tail buffer
+    small_size = 16384
+    #a new tail buffer is started when this much of the tail has been sent
+    gather_size = 65536
+    
+    #out_queue is None when there is no output, so idle connections do
+    #not keep a deque. out_tail is the bytearray at the end of the queue
+    #that small messages are appended to, or None. out_sealed is the size
+    #of the other queued buffers, and out_offset how much of the first
+    #buffer has been sent. The size of the tail is not counted while it
+    #is appended to, so appending costs no more than growing a bytearray
+    __slots__ = ("out_queue","out_tail","out_sealed","out_offset")
+    
     def __init__(self):
         ConnectionBuffers.__init__(self)
-        self.in_buffer = ""
-        self.out_buffer = ""
+        self.out_queue = None
+        self.out_tail = None
+        self.out_sealed = 0
+        self.out_offset = 0
     
-    def appendNetInBuffer(self,stuff):
-        self.in_buffer += stuff
     def appendAppOutputBuffer(self,stuff):
-        self.out_buffer += stuff
+        """Queues bytes for sending.
+        Small buffers are copied. Large buffers are queued as they are, so
+        they must not be modified afterwards.
+          stuff  A string, bytearray or memoryview
+        """
+        tail = self.out_tail
+        if tail is not None and len(stuff)<NormalConnectionBuffers.small_size:
+            tail += stuff
+            return
+        size = len(stuff)
+        if size==0:
+            return
+        if tail is not None:
+            self.out_sealed += len(tail)
+        if size<NormalConnectionBuffers.small_size:
+            stuff = bytearray(stuff)
+            self.out_tail = stuff
+        else:
+            self.out_tail = None
+            self.out_sealed += size
+        if self.out_queue is None:
+            self.out_queue = deque()
+        self.out_queue.append(stuff)
     
     def processNetInBuffer(self):
         pass
     def processAppOutBuffer(self):
         pass
     
-    def hasAppInput(self):
-        return len(self.in_buffer)!=0
     def hasNetOutput(self):
-        return len(self.out_buffer)!=0
+        return self.out_queue is not None
+    
+    def netOutputBytes(self):
+        """Returns the number of bytes waiting to be sent"""
+        tail = self.out_tail
+        if tail is None:
+            return self.out_sealed-self.out_offset
+        return self.out_sealed+len(tail)-self.out_offset
     
-    def getAppInBuffer(self):
-        return self.in_buffer
     def getNetOutBuffer(self):
-        return self.out_buffer
+        """Returns the next bytes to send in one send() call: the unsent part
+        of the first queued buffer. The result must not be kept after
+        calling other methods.
+        Returns a string, bytearray or memoryview, empty if there is no output
+        """
+        q = self.out_queue
+        if not q:
+            return ""
+        if self.out_offset==0:
+            return q[0]
+        return memoryview(q[0])[self.out_offset:]
     
-    def consumeAppInBuffer(self,bytes):
-        self.in_buffer = self.in_buffer[bytes:]
     def consumeNetOutBuffer(self,bytes):
-        self.out_buffer = self.out_buffer[bytes:]
+        """Removes bytes that have been sent from the queue"""
+        if bytes>=self.netOutputBytes():
+            self.out_queue = None
+            self.out_tail = None
+            self.out_sealed = 0
+            self.out_offset = 0
+            return
+        #the tail is the last buffer, so it is not removed here
+        q = self.out_queue
+        offset = self.out_offset+bytes
+        while offset>=len(q[0]):
+            size = len(q.popleft())
+            offset -= size
+            self.out_sealed -= size
+        self.out_offset = offset
+        if offset>=NormalConnectionBuffers.gather_size and q[0] is self.out_tail:
+            #start a new tail, so the sent part of this one is freed once
+            #the rest has been sent
+            self.out_sealed += len(self.out_tail)
+            self.out_tail = None
 
 def _unittest():
-    pass
+    b = NormalConnectionBuffers()
+    assert not b.hasNetOutput()
+    b.appendAppOutputBuffer("abc")
+    b.appendAppOutputBuffer(bytearray("def"))
+    b.appendAppOutputBuffer("ghi")
+    assert b.hasNetOutput()
+    assert str(b.getNetOutBuffer())=="abcdefghi"
+    b.consumeNetOutBuffer(4)
+    assert b.getNetOutBuffer().tobytes()=="efghi"
+    b.consumeNetOutBuffer(5)
+    assert not b.hasNetOutput()
+    assert b.getNetOutBuffer()==""
+    
+    #small buffers are copied into one, which partial sends do not copy
+    first = bytearray("a"*10)
+    b.appendAppOutputBuffer(first)
+    b.appendAppOutputBuffer("")
+    b.appendAppOutputBuffer(bytearray("b"*20))
+    b.appendAppOutputBuffer("c"*30)
+    first[0:1] = "x"
+    assert b.netOutputBytes()==60
+    assert str(b.getNetOutBuffer())=="a"*10+"b"*20+"c"*30
+    b.consumeNetOutBuffer(20)
+    assert b.getNetOutBuffer().tobytes()=="b"*10+"c"*30
+    b.appendAppOutputBuffer("d")
+    assert b.getNetOutBuffer().tobytes()=="b"*10+"c"*30+"d"
+    assert b.netOutputBytes()==41
+    b.consumeNetOutBuffer(41)
+    assert not b.hasNetOutput()
+    
+    #large buffers are sent from their own memory
+    small = "s"*100
+    big = bytearray(NormalConnectionBuffers.small_size)
+    b.appendAppOutputBuffer(small)
+    b.appendAppOutputBuffer(small)
+    b.appendAppOutputBuffer(big)
+    b.appendAppOutputBuffer(small)
+    assert b.netOutputBytes()==300+len(big)
+    assert len(b.getNetOutBuffer())==200
+    b.consumeNetOutBuffer(200)
+    assert b.getNetOutBuffer() is big
+    b.consumeNetOutBuffer(len(big))
+    assert len(b.getNetOutBuffer())==100
+    b.consumeNetOutBuffer(100)
+    assert not b.hasNetOutput()
+    
+    #the tail is replaced once much of it has been sent
+    for i in xrange(1000):
+        b.appendAppOutputBuffer(small)
+    assert len(b.getNetOutBuffer())==100000
+    b.consumeNetOutBuffer(NormalConnectionBuffers.gather_size)
+    b.appendAppOutputBuffer(small)
+    assert b.netOutputBytes()==100100-NormalConnectionBuffers.gather_size
+    b.consumeNetOutBuffer(100000-NormalConnectionBuffers.gather_size)
+    assert b.getNetOutBuffer()==small
+    b.consumeNetOutBuffer(100)
+    assert not b.hasNetOutput()
@@ -0,0 +1,181 @@
+import threading
+from diameter.node.Connection import Connection
+
+class ConnectionRegistry(object):
+    """The connections of a node, indexed by connection key, socket, peer
+    and host id, with a count of the ready connections.
+    The indexes are maintained incrementally: when a connection is added
+    or removed, and when update() is called after its peer, host id or
+    readiness has changed. Single lookups do not take the lock. The indexes map
+    to tuples that are replaced, not modified, on changes, and single
+    dict operations are atomic.
+    """
+    
+    __slots__ = ("lock","__by_key","__by_fd","__by_peer","__ready_by_peer",
+                 "__by_host_id","__indexed","ready_count")
+    
+    def __init__(self):
+        #held while the indexes are changed
+        self.lock = threading.Lock()
+        self.__by_key = {}
+        self.__by_fd = {}
+        #(host,port) -> tuple of connections, like Peer.__eq__
+        self.__by_peer = {}
+        self.__ready_by_peer = {}
+        #host_id -> tuple of connections
+        self.__by_host_id = {}
+        #connkey -> (fd,peer,host_id,ready) the connection is indexed by
+        self.__indexed = {}
+        self.ready_count = 0
+    
+    def __len__(self):
+        return len(self.__by_key)
+    
+    def add(self,conn):
+        "Adds a connection"
+        self.lock.acquire()
+        self.__by_key[conn.key] = conn
+        fd = conn.fd.fileno()
+        self.__by_fd[fd] = conn
+        self.__indexed[conn.key] = (fd,None,None,False)
+        self.__reindex(conn)
+        self.lock.release()
+    
+    def remove(self,conn):
+        "Removes a connection. Must be called before its socket is closed"
+        self.lock.acquire()
+        fd,peer,host_id,ready = self.__indexed.pop(conn.key)
+        del self.__by_key[conn.key]
+        del self.__by_fd[fd]
+        self.__unindex(conn,peer,host_id,ready)
+        self.lock.release()
+    
+    def update(self,conn):
+        """Updates the indexes of a connection after its peer, host id or
+        state has changed. Connections that have been removed are ignored.
+        """
+        self.lock.acquire()
+        if conn.key in self.__indexed:
+            self.__reindex(conn)
+        self.lock.release()
+    
+    def get(self,connkey):
+        "Returns the connection with the key, or None"
+        return self.__by_key.get(connkey)
+    
+    def values(self):
+        "Returns a list of all connections"
+        self.lock.acquire()
+        conns = self.__by_key.values()
+        self.lock.release()
+        return conns
+    
+    def findByFd(self,fd):
+        "Returns the connection using a socket file descriptor, or None"
+        return self.__by_fd.get(fd)
+    
+    def findByPeer(self,peer,ready_only=False):
+        """Returns a connection to a peer, or None. Ready connections are
+        preferred.
+          peer        The peer
+          ready_only  If True only ready connections are considered
+        """
+        conns = self.__ready_by_peer.get((peer.host,peer.port))
+        if conns:
+            return conns[0]
+        if ready_only:
+            return None
+        conns = self.__by_peer.get((peer.host,peer.port))
+        if conns:
+            return conns[0]
+        return None
+    
+    def findByHostId(self,host_id,exclude=None):
+        """Returns a connection with the host id other than exclude, or None"""
+        for conn in self.__by_host_id.get(host_id,()):
+            if conn is not exclude:
+                return conn
+        return None
+    
+    def __reindex(self,conn):
+        fd,peer,host_id,ready = self.__indexed[conn.key]
+        self.__unindex(conn,peer,host_id,ready)
+        if conn.peer:
+            peer = (conn.peer.host,conn.peer.port)
+        else:
+            peer = None
+        host_id = conn.host_id
+        ready = conn.state==Connection.state_ready
+        if peer:
+            ConnectionRegistry.__insert(self.__by_peer,peer,conn)
+            if ready:
+                ConnectionRegistry.__insert(self.__ready_by_peer,peer,conn)
+        if host_id:
+            ConnectionRegistry.__insert(self.__by_host_id,host_id,conn)
+        if ready:
+            self.ready_count += 1
+        self.__indexed[conn.key] = (fd,peer,host_id,ready)
+    
+    def __unindex(self,conn,peer,host_id,ready):
+        if peer:
+            ConnectionRegistry.__delete(self.__by_peer,peer,conn)
+            if ready:
+                ConnectionRegistry.__delete(self.__ready_by_peer,peer,conn)
+        if host_id:
+            ConnectionRegistry.__delete(self.__by_host_id,host_id,conn)
+        if ready:
+            self.ready_count -= 1
+    
+    def __insert(index,k,conn):
+        index[k] = index.get(k,()) + (conn,)
+    __insert = staticmethod(__insert)
+    
+    def __delete(index,k,conn):
+        conns = tuple([c for c in index[k] if c is not conn])
+        if conns:
+            index[k] = conns
+        else:
+            del index[k]
+    __delete = staticmethod(__delete)
+
+
+def _unittest():
+    import socket
+    from diameter.node.Peer import Peer
+    r = ConnectionRegistry()
+    conns = []
+    for i in range(3):
+        conn = Connection()
+        conn.fd = socket.socket()
+        conn.host_id = "10.0.0.%d"%i
+        r.add(conn)
+        conns.append(conn)
+    assert len(r)==3 and r.ready_count==0
+    assert r.get(conns[1].key) is conns[1]
+    assert r.findByFd(conns[2].fd.fileno()) is conns[2]
+    assert r.findByHostId("10.0.0.1") is conns[1]
+    assert r.findByHostId("10.0.0.1",conns[1]) is None
+    
+    #capability exchange gives the connections their identity
+    for conn in conns[0:2]:
+        conn.host_id = "peer.example.net"
+        conn.peer = Peer("peer.example.net")
+        r.update(conn)
+    assert r.findByHostId("10.0.0.1") is None
+    assert r.findByHostId("peer.example.net",conns[0]) is conns[1]
+    assert r.findByPeer(Peer("peer.example.net")) is conns[0]
+    assert r.findByPeer(Peer("peer.example.net"),True) is None
+    conns[1].state = Connection.state_ready
+    r.update(conns[1])
+    assert r.ready_count==1
+    assert r.findByPeer(Peer("peer.example.net")) is conns[1]
+    assert r.findByPeer(Peer("peer.example.net"),True) is conns[1]
+    assert r.findByPeer(Peer("other.example.net")) is None
+    
+    for conn in conns:
+        r.remove(conn)
+        conn.fd.close()
+    assert len(r)==0 and r.ready_count==0
+    assert r.findByPeer(Peer("peer.example.net")) is None
+    assert r.findByHostId("peer.example.net") is None
+    r.update(conns[0])
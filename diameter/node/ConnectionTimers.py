@@ -1,47 +1,55 @@
-import time
+from diameter.node.Clock import monotonic
 
-class ConnectionTimers:
+class ConnectionTimers(object):
     #last_activity;
     #last_real_activity;
     #last_in_dw;
     #dw_outstanding;
     #cfg_watchdog_timer;
     #cfg_idle_close_timeout;
+    #scheduled; //when the reactor checks the timers next. None if not scheduled
+    #The times are from Clock.monotonic(). The mark*() methods are given
+    #the time cached by the reactor for the current loop iteration.
+    __slots__ = ("last_activity","last_real_activity","last_in_dw",
+                 "dw_outstanding","cfg_watchdog_timer","cfg_idle_close_timeout",
+                 "scheduled")
     
     def __init__(self,watchdog_timer, idle_close_timeout):
-        self.last_activity = time.time();
-        self.last_real_activity = time.time()
-        self.last_in_dw = time.time()
+        now = monotonic()
+        self.last_activity = now
+        self.last_real_activity = now
+        self.last_in_dw = now
         self.dw_outstanding = False
         self.cfg_watchdog_timer = watchdog_timer
         self.cfg_idle_close_timeout = idle_close_timeout
+        self.scheduled = None
     
-    def markDWR(self): #got a DWR
-        self.last_in_dw = time.time()
+    def markDWR(self,now): #got a DWR
+        self.last_in_dw = now
     
-    def markDWA(self): #got a DWA    
-        self.last_in_dw = time.time()
+    def markDWA(self,now): #got a DWA
+        self.last_in_dw = now
         self.dw_outstanding = False
     
-    def markActivity(self): #got something
-        self.last_activity = time.time()
+    def markActivity(self,now): #got something
+        self.last_activity = now
     
-    def markCER(self): #got a CER
-        self.last_activity = time.time()
+    def markCER(self,now): #got a CER
+        self.last_activity = now
     
     def markRealActivity(self): #got something non-CER, non-DW
         self.last_real_activity = self.last_activity;
     
-    def markDWR_out(self): #sent a DWR
+    def markDWR_out(self,now): #sent a DWR
         self.dw_outstanding = True
-        self.last_activity = time.time()
+        self.last_activity = now
     
     timer_action_none = 0
     timer_action_disconnect_no_cer = 1
     timer_action_disconnect_idle = 2
     timer_action_disconnect_no_dw = 3
     timer_action_dwr = 4
-
+    
     def calcNextTimeout(self,ready):
         if not ready:
             #when we haven't received a CER or negotiated TLS it will time out
@@ -51,16 +59,14 @@ class ConnectionTimers:
             next_watchdog_timeout = self.last_activity + self.cfg_watchdog_timer; #when to send a DWR
         else:
             next_watchdog_timeout = self.last_activity + self.cfg_watchdog_timer + self.cfg_watchdog_timer; #when to kill the connection due to no response
-
+        
         if self.cfg_idle_close_timeout!=0:
             idle_timeout = self.last_real_activity + self.cfg_idle_close_timeout;
             if idle_timeout<next_watchdog_timeout:
                 return idle_timeout;
         return next_watchdog_timeout;
     
-    def calcAction(self,ready):
-        now = time.time()
-
+    def calcAction(self,ready,now):
         if not ready and now >= self.last_activity + self.cfg_watchdog_timer:
             return ConnectionTimers.timer_action_disconnect_no_cer
         
@@ -80,4 +86,19 @@ class ConnectionTimers:
         return ConnectionTimers.timer_action_none
 
 def _unittest():
-    pass
+    t = ConnectionTimers(30,3600)
+    now = t.last_activity
+    assert t.calcNextTimeout(False)==now+30
+    assert t.calcAction(False,now+29)==ConnectionTimers.timer_action_none
+    assert t.calcAction(False,now+30)==ConnectionTimers.timer_action_disconnect_no_cer
+    t.markActivity(now+10)
+    t.markRealActivity()
+    assert t.calcNextTimeout(True)==now+40
+    assert t.calcAction(True,now+40)==ConnectionTimers.timer_action_dwr
+    t.markDWR_out(now+40)
+    assert t.calcNextTimeout(True)==now+100
+    assert t.calcAction(True,now+100)==ConnectionTimers.timer_action_disconnect_no_dw
+    t.markActivity(now+50)
+    t.markDWA(now+50)
+    assert t.calcNextTimeout(True)==now+80
+    assert t.calcAction(True,now+3610)==ConnectionTimers.timer_action_disconnect_idle
@@ -0,0 +1,232 @@
+from diameter import *
+
+def _encoded(avps):
+    Utils.setMandatory_RFC3588(avps)
+    return [AVP_Encoded.narrow(a) for a in avps]
+
+def _capabilityKey(capabilities):
+    return (frozenset(capabilities.supported_vendor),
+            frozenset(capabilities.auth_app),
+            frozenset(capabilities.acct_app),
+            frozenset(capabilities.auth_vendor),
+            frozenset(capabilities.acct_vendor))
+
+class EncodedAVPCache:
+    """Pre-encoded AVPs for the messages a node generates itself.
+    The AVPs are built from the node settings and node state the first time
+    they are needed, and are rebuilt when the values they were built from
+    change. The M-bit is set according to RFC3588. The AVPs are shared
+    between messages and must not be modified.
+    """
+    
+    #upper bound on the number of entries in the per-value dictionaries
+    max_entries = 64
+    
+    def __init__(self,node):
+        self.node = node
+        self.invalidate()
+    
+    def invalidate(self):
+        """Forget all cached AVPs"""
+        #(host_id,realm,AVPs)
+        self.__host_and_realm = (None,None,None)
+        #(state_id,AVP)
+        self.__state_id = (None,None)
+        #{result_code:AVP}
+        self.__result_codes = {}
+        #{(address,non-compliant format):AVP}
+        self.__host_ip_addresses = {}
+        #{(settings...,capabilities):AVPs}
+        self.__ce = {}
+    
+    def originHostAndRealm(self):
+        """Returns a list with the Origin-Host and Origin-Realm AVPs"""
+        settings = self.node.settings
+        entry = self.__host_and_realm
+        if entry[0] is not settings.host_id or entry[1] is not settings.realm:
+            entry = (settings.host_id,
+                     settings.realm,
+                     _encoded([AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,settings.host_id),
+                               AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,settings.realm)]))
+            self.__host_and_realm = entry
+        return entry[2]
+    
+    def originStateId(self):
+        """Returns the Origin-State-Id AVP"""
+        state_id = self.node.node_state.state_id
+        entry = self.__state_id
+        if entry[0]!=state_id:
+            entry = (state_id,
+                     _encoded([AVP_Unsigned32(ProtocolConstants.DI_ORIGIN_STATE_ID,state_id)])[0])
+            self.__state_id = entry
+        return entry[1]
+    
+    def resultCode(self,result_code):
+        """Returns a Result-Code AVP with the specified value"""
+        avp = self.__result_codes.get(result_code)
+        if not avp:
+            avp = _encoded([AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,result_code)])[0]
+            self.__store(self.__result_codes,result_code,avp)
+        return avp
+    
+    def hostIPAddress(self,address,ericsson_format=False):
+        """Returns a Host-IP-Address AVP
+          address          The IP address
+          ericsson_format  Use the non-compliant payload without the
+                           address family that some servers require
+        """
+        key = (address,ericsson_format)
+        avp = self.__host_ip_addresses.get(key)
+        if not avp:
+            tmp_avp = AVP_Address(ProtocolConstants.DI_HOST_IP_ADDRESS,address)
+            if ericsson_format:
+                tmp_avp = AVP(ProtocolConstants.DI_HOST_IP_ADDRESS,tmp_avp.payload[2:])
+            avp = _encoded([tmp_avp])[0]
+            self.__store(self.__host_ip_addresses,key,avp)
+        return avp
+    
+    def capabilitiesExchange(self,capabilities):
+        """Returns the CER/CEA AVPs following Host-IP-Address
+        These are Vendor-Id, Product-Name, Origin-State-Id,
+        Supported-Vendor-Id, Auth-Application-Id, Acct-Application-Id,
+        Vendor-Specific-Application-Id and Firmware-Revision.
+          capabilities  The capabilities to announce
+        """
+        settings = self.node.settings
+        key = (settings.vendor_id,
+               settings.product_name,
+               settings.firmware_revision,
+               self.node.node_state.state_id,
+               _capabilityKey(capabilities))
+        avps = self.__ce.get(key)
+        if avps:
+            return avps
+        avps = []
+        #Vendor-Id
+        avps.append(AVP_Unsigned32(ProtocolConstants.DI_VENDOR_ID, settings.vendor_id))
+        #Product-Name
+        avps.append(AVP_UTF8String(ProtocolConstants.DI_PRODUCT_NAME, settings.product_name))
+        #Origin-State-Id
+        avps.append(self.originStateId())
+        #Error-Message, Failed-AVP: not in success
+        #Supported-Vendor-Id
+        for i in capabilities.supported_vendor:
+            avps.append(AVP_Unsigned32(ProtocolConstants.DI_SUPPORTED_VENDOR_ID,i))
+        #Auth-Application-Id
+        for i in capabilities.auth_app:
+            avps.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,i))
+        #Inband-Security-Id
+        #  todo
+        #Acct-Application-Id
+        for i in capabilities.acct_app:
+            avps.append(AVP_Unsigned32(ProtocolConstants.DI_ACCT_APPLICATION_ID,i))
+        #Vendor-Specific-Application-Id
+        for va in capabilities.auth_vendor:
+            g = []
+            g.append(AVP_Unsigned32(ProtocolConstants.DI_VENDOR_ID,va.vendor_id))
+            g[-1].setMandatory(True)
+            g.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,va.application_id))
+            g[-1].setMandatory(True)
+            avps.append(AVP_Grouped(ProtocolConstants.DI_VENDOR_SPECIFIC_APPLICATION_ID,g))
+        for va in capabilities.acct_vendor:
+            g = []
+            g.append(AVP_Unsigned32(ProtocolConstants.DI_VENDOR_ID,va.vendor_id))
+            g[-1].setMandatory(True)
+            g.append(AVP_Unsigned32(ProtocolConstants.DI_ACCT_APPLICATION_ID,va.application_id))
+            g[-1].setMandatory(True)
+            avps.append(AVP_Grouped(ProtocolConstants.DI_VENDOR_SPECIFIC_APPLICATION_ID,g))
+        #Firmware-Revision
+        if settings.firmware_revision!=0:
+            avps.append(AVP_Unsigned32(ProtocolConstants.DI_FIRMWARE_REVISION,settings.firmware_revision))
+        avps = _encoded(avps)
+        self.__store(self.__ce,key,avps)
+        return avps
+    
+    def watchdogRequest(self):
+        """Returns the AVPs of a DWR"""
+        return self.originHostAndRealm() + [self.originStateId()]
+    
+    def watchdogAnswer(self):
+        """Returns the AVPs of a successful DWA"""
+        return [self.resultCode(ProtocolConstants.DIAMETER_RESULT_SUCCESS)] + \
+               self.originHostAndRealm() + \
+               [self.originStateId()]
+    
+    def disconnectPeerAnswer(self):
+        """Returns the AVPs of a successful DPA"""
+        return [self.resultCode(ProtocolConstants.DIAMETER_RESULT_SUCCESS)] + \
+               self.originHostAndRealm()
+    
+    def __store(self,d,key,value):
+        if len(d)>=self.max_entries:
+            d.clear()
+        d[key] = value
+
+
+def _unittest():
+    from diameter.node.NodeSettings import NodeSettings
+    from diameter.node.NodeState import NodeState
+    from diameter.node.Capability import Capability
+    class FakeNode:
+        pass
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL)
+    cap.addVendorAuthApp(10415,4)
+    node = FakeNode()
+    node.settings = NodeSettings("somehost.example.net","example.net",1,cap,3868,"PythonDiameter",1)
+    node.node_state = NodeState()
+    cache = EncodedAVPCache(node)
+    
+    hr = cache.originHostAndRealm()
+    assert AVP_UTF8String.narrow(hr[0]).queryValue()=="somehost.example.net"
+    assert hr[0].isMandatory()
+    assert cache.originHostAndRealm() is hr
+    node.settings.realm = "other.example.net"
+    hr2 = cache.originHostAndRealm()
+    assert hr2 is not hr
+    assert AVP_UTF8String.narrow(hr2[1]).queryValue()=="other.example.net"
+    
+    s = cache.originStateId()
+    assert AVP_Unsigned32.narrow(s).queryValue()==node.node_state.state_id
+    assert cache.originStateId() is s
+    
+    rc = cache.resultCode(ProtocolConstants.DIAMETER_RESULT_SUCCESS)
+    assert cache.resultCode(ProtocolConstants.DIAMETER_RESULT_SUCCESS) is rc
+    assert AVP_Unsigned32.narrow(rc).queryValue()==ProtocolConstants.DIAMETER_RESULT_SUCCESS
+    
+    a = cache.hostIPAddress("127.0.0.1")
+    assert AVP_Address.narrow(a).queryAddress()[1]=="127.0.0.1"
+    assert len(cache.hostIPAddress("127.0.0.1",True).payload)==4
+    
+    #the encoded AVPs are the same as the ones built by hand
+    ce = cache.capabilitiesExchange(cap)
+    assert cache.capabilitiesExchange(cap) is ce
+    m = Message()
+    for a in ce:
+        m.append(a)
+    assert m.find(ProtocolConstants.DI_VENDOR_ID).isMandatory()
+    assert m.count(ProtocolConstants.DI_AUTH_APPLICATION_ID)==1
+    g = AVP_Grouped.narrow(m.find(ProtocolConstants.DI_VENDOR_SPECIFIC_APPLICATION_ID))
+    assert AVP_Unsigned32.narrow(g.find(ProtocolConstants.DI_VENDOR_ID)).queryValue()==10415
+    m2 = Message()
+    m2.append(AVP_Unsigned32(ProtocolConstants.DI_VENDOR_ID,1))
+    m2.append(AVP_UTF8String(ProtocolConstants.DI_PRODUCT_NAME,"PythonDiameter"))
+    m2.append(AVP_Unsigned32(ProtocolConstants.DI_ORIGIN_STATE_ID,node.node_state.state_id))
+    m2.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_CREDIT_CONTROL))
+    m2.append(AVP_Grouped(ProtocolConstants.DI_VENDOR_SPECIFIC_APPLICATION_ID,
+                          [AVP_Unsigned32(ProtocolConstants.DI_VENDOR_ID,10415).setM(),
+                           AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,4).setM()]))
+    m2.append(AVP_Unsigned32(ProtocolConstants.DI_FIRMWARE_REVISION,1))
+    Utils.setMandatory_RFC3588(m2)
+    assert m.encodeToBuffer()==m2.encodeToBuffer()
+    
+    #settings and capability changes are picked up
+    node.settings.product_name = "Other"
+    ce2 = cache.capabilitiesExchange(cap)
+    assert ce2 is not ce
+    cap.addAcctApp(3)
+    assert len(cache.capabilitiesExchange(cap))==len(ce2)+1
+    
+    assert len(cache.watchdogAnswer())==4
+    assert len(cache.watchdogRequest())==3
+    assert len(cache.disconnectPeerAnswer())==3
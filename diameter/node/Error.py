@@ -23,12 +23,16 @@ class NotARequestError(error):
         error.__init__(self,"")
 
 class NotRoutableError(error):
-    def __init__(self):
-        error.__init__(self,"The message could not be routed to any peers")
+    def __init__(self,why="The message could not be routed to any peers"):
+        error.__init__(self,why)
     
 class NotProxiableError(error):
     def __init__(self):
         error.__init__(self,"")
 
+class ConnectionCongestedError(error):
+    def __init__(self):
+        error.__init__(self,"The connection has too much output queued")
+
 def _unittest():
     pass
@@ -0,0 +1,167 @@
+import threading
+import collections
+import time
+import logging
+
+class _Partition:
+    def __init__(self):
+        self.queue = collections.deque()
+        self.cv = threading.Condition()
+        self.thread = None
+
+
+class Executor:
+    """A pool of threads running functions in order per key.
+    Each key (eg. a Session-Id) is mapped to one of the threads, so the
+    functions submitted with the same key are run one at a time in the
+    order they were submitted, while functions with different keys can
+    run in parallel. Every thread has its own queue. The number of
+    entries in a queue is limited for bounded submissions.
+    See NodeManager.setExecutor()
+    
+    Any object with the methods start(), stop(), submit() and
+    getStatistics() can be used as an executor by NodeManager.
+    """
+    
+    def __init__(self,threads=4,queue_size=1000):
+        """
+        Constructor for Executor.
+          threads     The number of threads
+          queue_size  The maximum number of entries in the queue of a
+                      thread for bounded submissions
+        """
+        self.queue_size = queue_size
+        self.partitions = [_Partition() for i in range(threads)]
+        self.please_stop = False
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.logger = logging.getLogger("dk.i1.diameter.node")
+    
+    def start(self):
+        """Starts the threads"""
+        self.please_stop = False
+        for i in range(len(self.partitions)):
+            p = self.partitions[i]
+            p.thread = threading.Thread(target=self.__run,args=(p,),name="Diameter executor %d"%i)
+            p.thread.setDaemon(True)
+            p.thread.start()
+    
+    def stop(self):
+        """Stops the threads when their queues have been processed"""
+        self.please_stop = True
+        for p in self.partitions:
+            p.cv.acquire()
+            p.cv.notify()
+            p.cv.release()
+        for p in self.partitions:
+            if p.thread is not threading.currentThread():
+                p.thread.join()
+            p.thread = None
+    
+    def submit(self,key,function,args,bounded=True):
+        """Queues a function call.
+          key       The key deciding the thread. Calls with equal keys are
+                    run in order
+          function  The function
+          args      A tuple with the arguments to call it with
+          bounded   If True, the call is rejected if the queue is full.
+                    Otherwise it is always queued.
+        Returns: False if the call was rejected, otherwise True
+        """
+        p = self.partitions[hash(key)%len(self.partitions)]
+        p.cv.acquire()
+        if bounded and len(p.queue)>=self.queue_size:
+            p.cv.release()
+            self.stats_lock.acquire()
+            self.rejected += 1
+            self.stats_lock.release()
+            return False
+        p.queue.append((time.time(),function,args))
+        p.cv.notify()
+        p.cv.release()
+        self.stats_lock.acquire()
+        self.submitted += 1
+        self.stats_lock.release()
+        return True
+    
+    def getQueueDepths(self):
+        """Returns the number of queued calls of each thread"""
+        return [len(p.queue) for p in self.partitions]
+    
+    def getStatistics(self):
+        """Returns the statistics of the executor as a dictionary:
+          queued         The number of calls currently queued
+          submitted      The number of calls submitted
+          rejected       The number of calls rejected because the queue
+                         was full
+          wait_time      The total time calls have waited in the queues
+                         (seconds)
+          max_wait_time  The longest time a call has waited (seconds)
+        """
+        self.stats_lock.acquire()
+        stats = {"queued":sum(self.getQueueDepths()),
+                 "submitted":self.submitted,
+                 "rejected":self.rejected,
+                 "wait_time":self.wait_time,
+                 "max_wait_time":self.max_wait_time}
+        self.stats_lock.release()
+        return stats
+    
+    def __run(self,p):
+        while True:
+            p.cv.acquire()
+            while not p.queue and not self.please_stop:
+                p.cv.wait()
+            if not p.queue:
+                p.cv.release()
+                break
+            queued,function,args = p.queue.popleft()
+            p.cv.release()
+            
+            waited = time.time()-queued
+            self.stats_lock.acquire()
+            self.wait_time += waited
+            if waited>self.max_wait_time:
+                self.max_wait_time = waited
+            self.stats_lock.release()
+            try:
+                function(*args)
+            except:
+                self.logger.log(logging.ERROR,"Exception in executor thread",exc_info=True)
+
+
+def _unittest():
+    e = Executor(3,5)
+    e.start()
+    results = {}
+    lock = threading.Lock()
+    def work(key,i):
+        lock.acquire()
+        results.setdefault(key,[]).append(i)
+        lock.release()
+    for i in range(20):
+        for key in ("a","b","c","d"):
+            assert e.submit(key,work,(key,i),False)
+    e.stop()
+    for key in ("a","b","c","d"):
+        assert results[key]==range(20)
+    stats = e.getStatistics()
+    assert stats["submitted"]==80 and stats["queued"]==0 and stats["rejected"]==0
+    
+    #bounded submissions are rejected when the queue is full
+    e = Executor(1,2)
+    e.start()
+    blocker = threading.Event()
+    assert e.submit("k",blocker.wait,())
+    time.sleep(0.05) #let the thread take it
+    assert e.submit("k",work,("k",1))
+    assert e.submit("k",work,("k",2))
+    assert not e.submit("k",work,("k",3))
+    assert e.submit("k",work,("k",4),False)
+    assert e.getQueueDepths()==[3]
+    blocker.set()
+    e.stop()
+    assert e.getStatistics()["rejected"]==1
@@ -0,0 +1,109 @@
+import threading
+
+#Protects the state of all futures. It is only held for a few
+#instructions, so one lock is cheaper than one per future.
+_lock = threading.Lock()
+
+class Future(object):
+    """The result of an operation that completes later, eg. the answer to
+    a request.
+    The result is delivered to callbacks, so a thread does not have to
+    wait for it. A thread can still wait for it with getResult(). The
+    event needed for that is only created when a thread waits.
+    
+    Example:
+        def done(future):
+            answer = future.getResult()
+            ...
+        manager.sendRequest(request,peers).addCallback(done)
+    """
+    
+    __slots__ = ("_done","_result","_callbacks","_waiter")
+    
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._callbacks = None
+        self._waiter = None
+    
+    def isDone(self):
+        """Returns True if the result has been set"""
+        return self._done
+    
+    def setResult(self,result):
+        """Sets the result and calls the callbacks in the calling thread.
+        Setting the result of a future that is already done has no effect.
+          result  The result
+        Returns True if the result was set
+        """
+        _lock.acquire()
+        if self._done:
+            _lock.release()
+            return False
+        self._result = result
+        self._done = True
+        callbacks = self._callbacks
+        self._callbacks = None
+        waiter = self._waiter
+        _lock.release()
+        if waiter:
+            waiter.set()
+        if callbacks:
+            for callback in callbacks:
+                callback(self)
+        return True
+    
+    def addCallback(self,callback):
+        """Adds a function to call with the future when it is done.
+        The callback is called by the thread setting the result, or right
+        away if the future is already done.
+          callback  A function taking the future as its only argument
+        """
+        _lock.acquire()
+        if not self._done:
+            if self._callbacks is None:
+                self._callbacks = [callback]
+            else:
+                self._callbacks.append(callback)
+            _lock.release()
+            return
+        _lock.release()
+        callback(self)
+    
+    def getResult(self,timeout=None):
+        """Returns the result, waiting for it if necessary.
+          timeout  Maximum number of seconds to wait. None means forever
+        Returns the result, or None if the timeout expired first. Use
+        isDone() to tell a None result from a timeout.
+        """
+        if not self._done:
+            _lock.acquire()
+            if not self._done and self._waiter is None:
+                self._waiter = threading.Event()
+            waiter = self._waiter
+            _lock.release()
+            if waiter:
+                waiter.wait(timeout)
+        return self._result
+
+
+def _unittest():
+    f = Future()
+    assert not f.isDone()
+    got = []
+    f.addCallback(lambda f: got.append(f.getResult()))
+    assert f.getResult(0.01) is None
+    assert f.setResult(42)
+    assert f.isDone()
+    assert got==[42]
+    assert not f.setResult(43)
+    assert f.getResult()==42
+    f.addCallback(lambda f: got.append(f.getResult()))
+    assert got==[42,42]
+    
+    #waiting for a result set by another thread
+    f = Future()
+    t = threading.Timer(0.05,f.setResult,("late",))
+    t.start()
+    assert f.getResult()=="late"
+    t.join()
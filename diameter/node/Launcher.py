@@ -0,0 +1,321 @@
+import os
+import copy
+import errno
+import select
+import signal
+import struct
+import cPickle
+import threading
+import time
+import logging
+
+class _Worker:
+    "The parent's view of a worker process"
+    def __init__(self,index):
+        self.index = index
+        self.pid = None
+        self.fd = None          #read end of the statistics pipe
+        self.buffer = ""        #partially received statistics
+        self.stats = None       #the latest statistics
+        self.started = 0
+        self.last_report = 0
+        self.restarts = 0
+
+
+class Launcher:
+    """Runs a node in several worker processes.
+    One Python process cannot use more than one CPU for handling messages,
+    so a node with more load than that can be run in several processes.
+    The launcher forks the workers, and each of them runs its own node
+    manager with the same settings, listening on the same port with
+    SO_REUSEPORT so the kernel spreads the inbound connections over them.
+    The workers share the host identity, but take end-to-end identifiers
+    and Session-Ids from separate ranges (see NodeSettings.setWorker()).
+    
+    The launcher supervises the workers: a worker that exits, or that has
+    not reported its statistics for hang_timeout seconds, is (killed and)
+    restarted. The statistics of the workers are aggregated by
+    getStatistics().
+    
+    The workers are forked from the process creating the launcher, so it
+    should be started before the process creates any other threads, and
+    before it starts any node.
+    
+    Example:
+        def makeManager(settings):
+            return MyServer(settings)
+        launcher = Launcher(settings,4,makeManager)
+        launcher.start()
+        ...
+        launcher.stop()
+    """
+    
+    #how often the workers report their statistics (seconds)
+    report_interval = 1.0
+    #workers that have not reported for this long are restarted (seconds)
+    hang_timeout = 10.0
+    #minimum time between starting a worker and restarting it (seconds)
+    restart_delay = 1.0
+    
+    def __init__(self,settings,workers,make_manager,grace_time=1.0):
+        """
+        Constructor for Launcher.
+          settings      The node settings. Each worker uses a copy with
+                        SO_REUSEPORT enabled and its own worker index.
+          workers       The number of worker processes
+          make_manager  A function that is called in each worker with its
+                        settings and returns the (not started) node
+                        manager. It may also have a getStatistics() method
+                        returning a dictionary of numbers, which is
+                        reported to the launcher.
+          grace_time    How long the workers wait for their connections to
+                        close gracefully when stopped.
+        """
+        self.settings = settings
+        self.make_manager = make_manager
+        self.grace_time = grace_time
+        self.workers = [_Worker(i) for i in range(workers)]
+        self.lock = threading.Lock()
+        self.please_stop = False
+        self.supervisor_thread = None
+        self.logger = logging.getLogger("dk.i1.diameter.node")
+    
+    def start(self):
+        """Forks the workers and starts supervising them"""
+        self.please_stop = False
+        for worker in self.workers:
+            self.__startWorker(worker)
+        self.supervisor_thread = threading.Thread(target=self.__supervise,name="Diameter launcher supervisor")
+        self.supervisor_thread.setDaemon(True)
+        self.supervisor_thread.start()
+    
+    def stop(self):
+        """Stops the workers.
+        The workers are asked to stop, and killed if they have not stopped
+        within the grace time (plus a bit).
+        """
+        self.please_stop = True
+        self.supervisor_thread.join()
+        self.supervisor_thread = None
+        for worker in self.workers:
+            if worker.pid:
+                self.__signal(worker,signal.SIGTERM)
+        deadline = time.time()+self.grace_time+self.report_interval+1
+        for worker in self.workers:
+            while worker.pid and time.time()<deadline:
+                if not self.__reap(worker):
+                    time.sleep(0.05)
+            if worker.pid:
+                self.logger.log(logging.WARNING,"Worker %d did not stop, killing it"%worker.index)
+                self.__signal(worker,signal.SIGKILL)
+                os.waitpid(worker.pid,0)
+                self.__workerExited(worker)
+    
+    def getStatistics(self):
+        """Returns the sums of the statistics of the workers.
+        Each worker reports the number of connections ("connections"), the
+        number of messages sent and the number of send() calls used for
+        sending them ("messages_sent" and "send_calls"), the wake-ups of its
+        reactors ("wakeups" and "wakeups_avoided"), plus what the
+        getStatistics() method of its node manager returns, if it has one.
+        Statistics named max_* are the maximum over the workers. The number
+        of running workers ("workers") and the number of restarts
+        ("restarts") are added.
+        Returns: A dictionary
+        """
+        total = {}
+        self.lock.acquire()
+        for worker in self.workers:
+            if worker.stats and worker.pid:
+                for k,v in worker.stats.iteritems():
+                    if k.startswith("max_"):
+                        total[k] = max(total.get(k,0),v)
+                    else:
+                        total[k] = total.get(k,0) + v
+        total["workers"] = len([worker for worker in self.workers if worker.pid])
+        total["restarts"] = sum([worker.restarts for worker in self.workers])
+        self.lock.release()
+        return total
+    
+    def getWorkerStatistics(self):
+        """Returns the latest statistics of each worker.
+        Returns: A list with a dictionary per worker, or None for workers
+                 that are not running or have not reported yet.
+        """
+        self.lock.acquire()
+        r = [(worker.pid and worker.stats) or None for worker in self.workers]
+        self.lock.release()
+        return r
+    
+    def __startWorker(self,worker):
+        r,w = os.pipe()
+        pid = os.fork()
+        if pid==0:
+            #child
+            os.close(r)
+            for other in self.workers:
+                if other.fd is not None:
+                    os.close(other.fd)
+            code = 0
+            try:
+                self.__runWorker(worker.index,w)
+            except:
+                self.logger.log(logging.ERROR,"Worker %d failed"%worker.index,exc_info=True)
+                code = 1
+            os._exit(code)
+        os.close(w)
+        self.lock.acquire()
+        worker.pid = pid
+        worker.fd = r
+        worker.buffer = ""
+        worker.stats = None
+        worker.started = worker.last_report = time.time()
+        self.lock.release()
+        self.logger.log(logging.INFO,"Started worker %d (pid %d)"%(worker.index,pid))
+    
+    def __runWorker(self,index,fd):
+        stopping = []
+        signal.signal(signal.SIGTERM,lambda signum,frame: stopping.append(signum))
+        #the parent handles ^C
+        signal.signal(signal.SIGINT,signal.SIG_IGN)
+        settings = copy.copy(self.settings)
+        settings.setReusePort(True)
+        settings.setWorker(index,len(self.workers))
+        manager = self.make_manager(settings)
+        manager.start()
+        while not stopping:
+            self.__report(manager,fd)
+            time.sleep(self.report_interval) #interrupted by SIGTERM
+        manager.stop(self.grace_time)
+    
+    def __report(self,manager,fd):
+        node = manager.node
+        messages_sent,send_calls = node.getOutputStatistics()
+        wakeups,wakeups_avoided = node.getWakeupStatistics()
+        stats = {"connections":len(node.registry),
+                 "messages_sent":messages_sent,
+                 "send_calls":send_calls,
+                 "wakeups":wakeups,
+                 "wakeups_avoided":wakeups_avoided}
+        if hasattr(manager,"getStatistics"):
+            stats.update(manager.getStatistics())
+        data = cPickle.dumps(stats,2)
+        os.write(fd,struct.pack("!I",len(data))+data)
+    
+    def __supervise(self):
+        while not self.please_stop:
+            fds = [worker.fd for worker in self.workers if worker.fd is not None]
+            try:
+                ready = select.select(fds,[],[],self.report_interval)[0]
+            except select.error, (err,errstr):
+                if err!=errno.EINTR:
+                    raise
+                ready = []
+            now = time.time()
+            for worker in self.workers:
+                if worker.fd is not None and worker.fd in ready:
+                    self.__receiveReport(worker,now)
+                if worker.pid:
+                    if self.__reap(worker):
+                        self.logger.log(logging.WARNING,"Worker %d exited"%worker.index)
+                    elif now-worker.last_report>self.hang_timeout:
+                        self.logger.log(logging.WARNING,"Worker %d has not reported for %.1f seconds, killing it"%(worker.index,now-worker.last_report))
+                        self.__signal(worker,signal.SIGKILL)
+                if not worker.pid and not self.please_stop and \
+                   now>=worker.started+self.restart_delay:
+                    worker.restarts += 1
+                    self.__startWorker(worker)
+    
+    def __receiveReport(self,worker,now):
+        data = os.read(worker.fd,65536)
+        if not data:
+            #the worker has exited. It is reaped by the caller
+            return
+        buf = worker.buffer + data
+        stats = None
+        while len(buf)>=4:
+            size = struct.unpack("!I",buf[0:4])[0]
+            if len(buf)<4+size:
+                break
+            stats = cPickle.loads(buf[4:4+size])
+            buf = buf[4+size:]
+        self.lock.acquire()
+        worker.buffer = buf
+        if stats is not None:
+            worker.stats = stats
+            worker.last_report = now
+        self.lock.release()
+    
+    def __reap(self,worker):
+        #Returns True if the worker has exited
+        pid,status = os.waitpid(worker.pid,os.WNOHANG)
+        if pid==0:
+            return False
+        self.__workerExited(worker)
+        return True
+    
+    def __workerExited(self,worker):
+        self.lock.acquire()
+        worker.pid = None
+        os.close(worker.fd)
+        worker.fd = None
+        self.lock.release()
+    
+    def __signal(self,worker,signum):
+        try:
+            os.kill(worker.pid,signum)
+        except OSError, ex:
+            if ex.errno!=errno.ESRCH:
+                raise
+
+
+def _unittest():
+    from diameter.node import Capability,NodeSettings,Peer
+    from diameter.node.AsyncNodeManager import AsyncNodeManager
+    from diameter.node.SimpleSyncClient import SimpleSyncClient
+    from diameter import Message,ProtocolConstants,AVP_Unsigned32
+    
+    class Server(AsyncNodeManager):
+        def handleRequest(self,request,connkey,peer):
+            answer = Message()
+            answer.prepareResponse(request)
+            answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE,ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+            self.node.addOurHostAndRealm(answer)
+            return answer
+        def getStatistics(self):
+            return {"answers":1}
+    
+    def waitFor(condition):
+        deadline = time.time()+10
+        while not condition():
+            assert time.time()<deadline
+            time.sleep(0.05)
+    
+    cap = Capability()
+    cap.addAuthApp(ProtocolConstants.DIAMETER_APPLICATION_NASREQ)
+    launcher = Launcher(NodeSettings("127.0.0.1","i1.dk",1,cap,3870,"pythondiameter",1),2,Server,0.1)
+    launcher.report_interval = 0.1
+    launcher.restart_delay = 0.1
+    launcher.start()
+    waitFor(lambda: None not in launcher.getWorkerStatistics())
+    assert launcher.getStatistics()["answers"]==2
+    
+    client = SimpleSyncClient(NodeSettings("client.i1.dk","i1.dk",1,cap,0,"pythondiameter",1),[Peer("127.0.0.1",3870)])
+    client.start()
+    client.waitForConnection(5)
+    msg = Message()
+    msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_NASREQ
+    msg.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_AA
+    msg.hdr.setRequest(True)
+    client.node.addOurHostAndRealm(msg)
+    msg.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_NASREQ))
+    assert client.sendRequest(msg) is not None
+    waitFor(lambda: launcher.getStatistics().get("connections")==1)
+    
+    #a worker that dies is restarted
+    os.kill(launcher.workers[0].pid,signal.SIGKILL)
+    waitFor(lambda: launcher.getStatistics()["restarts"]==1 and None not in launcher.getWorkerStatistics())
+    
+    client.stop()
+    launcher.stop()
+    assert launcher.getStatistics()["workers"]==0
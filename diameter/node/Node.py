@@ -7,25 +7,39 @@ from diameter.node.NodeSettings import NodeSettings
 from diameter.node.NodeState import NodeState
 from diameter.node.Peer import Peer
 from diameter.node.Connection import Connection
+from diameter.node.ConnectionRegistry import ConnectionRegistry
+from diameter.node.ConnectionBuffers import NormalConnectionBuffers
+from diameter.node.Poller import createPoller,EVENT_READ,EVENT_WRITE
+from diameter.node.Reactor import Reactor
+from diameter.node.Waker import createWaker
 from diameter.node.ConnectionTimers import ConnectionTimers
+from diameter.node.Clock import monotonic
 from diameter.node.Capability import Capability
+from diameter.node.EncodedAVPCache import EncodedAVPCache
 from diameter import *
 from diameter.node.Error import *
 import struct
-import xdrlib
-import struct
-import select
 import errno
+import os
 import logging
+import itertools
 
 import sctp
 
 class SelectThread(threading.Thread):
+    def __init__(self,node,reactor):
+        threading.Thread.__init__(self,name="Diameter node thread %d"%reactor.index);
+        self.node=node
+        self.reactor=reactor
+    def run(self):
+        self.node.run_select(self.reactor)
+
+class AcceptThread(threading.Thread):
     def __init__(self,node):
-        threading.Thread.__init__(self,name="Diameter node thread");
+        threading.Thread.__init__(self,name="Diameter node accept thread");
         self.node=node
     def run(self):
-        self.node.run_select()
+        self.node.run_accept()
 
 class ReconnectThread(threading.Thread):
     def __init__(self,node,src=None):
@@ -43,8 +57,21 @@ class Node:
     connection listener is notified. Message can be sent and received through
     the node but no state is maintained per message.
     Node is quite low-level. You probably want to use NodeManager instead.
+    
+    The connections are handled by one or more reactors, each with its own
+    thread (see NodeSettings.setReactors()). Inbound connections are
+    accepted by the first reactor, or by an accept thread (see
+    NodeSettings.setAcceptThread()), and then handed to a reactor chosen by
+    the balancing policy, as are the connections initiated by the node.
     """
     
+    #how many bytes to read from a connection before serving the others
+    read_budget = 262144
+    #how many inbound connections to accept before serving the others
+    accept_budget = 64
+    #how long to stop accepting when out of file descriptors or memory
+    accept_backoff = 0.1
+    
     def __init__(self,message_dispatcher,connection_listener,settings):
         """
         Constructor for Node.
@@ -59,17 +86,24 @@ class Node:
         self.message_dispatcher = message_dispatcher
         self.connection_listener = connection_listener
         self.settings = settings
-        self.node_state = NodeState()
-        self.map_key_conn_lock = threading.Lock()
-        self.map_key_conn_cv = threading.Condition(self.map_key_conn_lock)
+        self.node_state = NodeState(settings.worker_index,settings.worker_count)
+        self.avp_cache = EncodedAVPCache(self)
+        #The state of a connection is protected by the lock of its reactor,
+        #and its output by the lock of the connection. A thread holding the
+        #lock of a reactor may take the lock of the registry or the lock of
+        #a connection, but not the other way around
+        self.registry = ConnectionRegistry()
+        self.reconnect_cv = threading.Condition()
         self.obj_conn_wait = threading.Condition()
-        self.fd_pipe = socket.socketpair()
         self.persistent_peers = set([])
         self.persistent_peers_lock = threading.Lock()
-        self.node_thread = None
+        self.reactors = []
+        self.accept_thread = None
+        self.accept_waker = None
+        #when to resume accepting after running out of resources, or None
+        self.accept_resume = None
         self.reconnect_thread = None
-        self.map_key_conn = {}
-        self.map_fd_conn = {}
+        self.__next_reactor = itertools.count()
         self.logger = logging.getLogger("dk.i1.diameter.node")
     
     def start(self,src=None):
@@ -83,10 +117,22 @@ class Node:
         self.please_stop = False
         self.shutdown_deadline = None
         self.__prepare(src)
+        self.reactors = [Reactor(i) for i in range(self.settings.reactors)]
+        if self.sock_listen:
+            self.sock_listen.setblocking(False)
+            if not self.settings.accept_thread:
+                self.reactors[0].poller.register(self.sock_listen,EVENT_READ,self.sock_listen)
         
-        self.node_thread = SelectThread(self)
-        self.node_thread.setDaemon(True)
-        self.node_thread.start()
+        for reactor in self.reactors:
+            reactor.thread = SelectThread(self,reactor)
+            reactor.thread.setDaemon(True)
+            reactor.thread.start()
+        
+        if self.sock_listen and self.settings.accept_thread:
+            self.accept_waker = createWaker()
+            self.accept_thread = AcceptThread(self)
+            self.accept_thread.setDaemon(True)
+            self.accept_thread.start()
         
         self.reconnect_thread = ReconnectThread(self,src)
         self.reconnect_thread.setDaemon(True)
@@ -104,18 +150,21 @@ class Node:
           grace_time  Maximum time to wait for connections to close gracefully.
         """
         self.logger.log(logging.INFO,"Stopping Diameter node")
-        self.map_key_conn_cv.acquire()
+        self.reconnect_cv.acquire()
         self.shutdown_deadline = time.time() + grace_time
         self.please_stop = True
-        for connkey in self.map_key_conn.keys():
-            conn = self.map_key_conn[connkey]
+        self.reconnect_cv.release()
+        conns = self.registry.values()
+        for conn in conns:
+            reactor = conn.reactor
+            reactor.lock.acquire()
             if conn.state==Connection.state_connecting or \
                conn.state==Connection.state_connected_in or \
                conn.state==Connection.state_connected_out:
                 self.logger.log(logging.INFO,"Closing connection to %s because were are shutting down"%conn.host_id)
-                del self.map_fd_conn[conn.fd.fileno()]
-                del self.map_key_conn[connkey]
+                self.__removeConnection_unlocked(conn)
                 conn.fd.close()
+                conn.state = Connection.state_closed
             elif conn.state==Connection.state_tls:
                 pass #todo
             elif conn.state==Connection.state_ready:
@@ -126,20 +175,33 @@ class Node:
                 pass #nothing to do
             elif conn.state==Connection.state_closed:
                 pass #nothing to do
-        self.map_key_conn_cv.release()
-        self.__wakeSelectThread()
-        self.map_key_conn_cv.acquire()
-        self.map_key_conn_cv.notify()
-        self.map_key_conn_cv.release()
-        self.node_thread.join()
-        self.node_thread = None
+            reactor.lock.release()
+        for reactor in self.reactors:
+            reactor.wake()
+        if self.accept_thread:
+            self.accept_waker.wake()
+            self.accept_thread.join()
+            self.accept_thread = None
+            self.accept_waker.close()
+            self.accept_waker = None
+        self.reconnect_cv.acquire()
+        self.reconnect_cv.notify()
+        self.reconnect_cv.release()
+        for reactor in self.reactors:
+            reactor.thread.join()
+            reactor.thread = None
         self.reconnect_thread.join()
         self.reconnect_thread = None
         if self.sock_listen:
+            if not self.settings.accept_thread and self.accept_resume is None:
+                self.reactors[0].poller.unregister(self.sock_listen)
             self.sock_listen.close()
         self.sock_listen = None
-        self.map_key_conn = {}
-        self.map_fd_conn = {}
+        self.accept_resume = None
+        for reactor in self.reactors:
+            reactor.close()
+        self.reactors = []
+        self.registry = ConnectionRegistry()
         self.logger.log(logging.INFO,"Diameter node stopped")
     
     def __prepare(self,src=None):
@@ -158,8 +220,13 @@ class Node:
                 
                 try:
                     sock_listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,struct.pack("i",1));
+                    if self.settings.reuse_port:
+                        if not hasattr(socket,"SO_REUSEPORT"):
+                            sock_listen.close()
+                            raise StartError("SO_REUSEPORT is not supported on this platform")
+                        sock_listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT,struct.pack("i",1))
                     sock_listen.bind(addr[4])
-                    sock_listen.listen(10)
+                    sock_listen.listen(self.settings.listen_backlog)
                 except socket.error:
                     #most likely error: IPv6 enabled, but no interfaces has IPv6 address(es)
                     sock_listen.close()
@@ -174,17 +241,10 @@ class Node:
             self.sock_listen = sock_listen
         else:
             self.sock_listen = None
-        self.map_key_conn = {}
+        self.registry = ConnectionRegistry()
     
     def __anyReadyConnection(self):
-        rc=False
-        self.map_key_conn_lock.acquire()
-        for conn in self.map_key_conn.itervalues():
-            if conn.state==Connection.state_ready:
-                rc=True
-                break
-        self.map_key_conn_lock.release()
-        return rc
+        return self.registry.ready_count>0
     
     def waitForConnection(self,timeout=None):
         """Wait until at least one connection has been established or until the timeout expires.
@@ -208,20 +268,14 @@ class Node:
 
     def findConnection(self,peer):
         """Returns the connection key for a peer.
+        A ready connection is returned if there is one.
         Returns: The connection key. None if there is no connection to the peer.
         """
-        self.logger.log(logging.DEBUG,"Finding '" + peer.host +"'")
-        connkey=None
-        self.map_key_conn_lock.acquire()
-        for connkey2,conn in self.map_key_conn.iteritems():
-            if conn.peer and conn.peer==peer:
-                connkey=connkey2
-                break
-        self.logger.log(logging.DEBUG,str(conn.peer.host)+' vs '+str(peer.host))
-        self.map_key_conn_lock.release()
-        if not connkey:
+        conn = self.registry.findByPeer(peer)
+        if conn is None:
             self.logger.log(logging.DEBUG,peer.host+" NOT found")
-        return connkey
+            return None
+        return conn.key
     
     def isConnectionKeyValid(self,connkey):
         """Returns if the connection is still valid.
@@ -230,42 +284,41 @@ class Node:
         usually much easier to just call sendMessage() and catch the
         exception if the connection has gone stale.
         """
-        self.map_key_conn_lock.acquire()
-        rc=self.map_key_conn.has_key(connkey)
-        self.map_key_conn_lock.release()
-        return rc
+        return self.registry.get(connkey) is not None
     
     def connectionKey2Peer(self,connkey):
-        self.map_key_conn_lock.acquire()
-        try:
-            peer = self.map_key_conn[connkey].peer
-        except KeyError:
-            peer = None
-        self.map_key_conn_lock.release()
-        return peer
+        conn = self.registry.get(connkey)
+        if conn is None:
+            return None
+        return conn.peer
     
     def connectionKey2InetAddress(self,connkey):
-        self.map_key_conn_lock.acquire()
         try:
-            conn = self.map_key_conn[connkey]
-        except KeyError:
-            self.map_key_conn_lock.release()
+            conn = self.__lockConnection(connkey)
+        except StaleConnectionError:
             return None
         a = conn.fd.getpeername()
-        self.map_key_conn_lock.release()
+        conn.lock.release()
         return a
     
     def nextHopByHopIdentifier(self,connkey):
         "Returns the next hop-by-hop identifier for a connection"
-        self.map_key_conn_lock.acquire()
-        try:
-            conn = self.map_key_conn[connkey]
-        except KeyError:
-            self.map_key_conn_lock.release()
+        return self.__findConnection(connkey).nextHopByHopIdentifier()
+    
+    def __findConnection(self,connkey):
+        conn = self.registry.get(connkey)
+        if conn is None:
             raise StaleConnectionError()
-        rc = conn.nextHopByHopIdentifier()
-        self.map_key_conn_lock.release()
-        return rc
+        return conn
+    
+    def __lockConnection(self,connkey):
+        #Returns an open connection with its lock held
+        conn = self.__findConnection(connkey)
+        conn.lock.acquire()
+        if conn.state==Connection.state_closed:
+            conn.lock.release()
+            raise StaleConnectionError()
+        return conn
     
     def sendMessage(self,msg,connkey):
         """Send a message.
@@ -273,33 +326,219 @@ class Node:
           msg      The message to be sent
           connkey  The connection to use. If the connection has been closed in
                    the meantime StaleConnectionError is thrown.
+        Raises:
+          ConnectionCongestedError
+            If the connection is congested and does not drain within the
+            congestion timeout. See NodeSettings.setOutputWatermarks()
         """
-        self.map_key_conn_lock.acquire()
-        try:
-            conn = self.map_key_conn[connkey]
-        except KeyError:
-            self.map_key_conn_lock.release()
+        conn = self.__findConnection(connkey)
+        #The message is encoded before taking any lock, so senders only
+        #serialize with each other and with the reactor while appending
+        raw = self.__encodeMessage(msg,conn)
+        conn.lock.acquire()
+        if conn.state!=Connection.state_ready:
+            conn.lock.release()
             raise StaleConnectionError()
+        if conn.congested:
+            self.__waitForOutputSpace_unlocked(conn)
+        handoff = self.__queueOutput_unlocked(conn,raw)
+        conn.lock.release()
+        self.__reportCongestion(conn)
+        if handoff:
+            self.__handOff(conn)
+    
+    def __waitForOutputSpace_unlocked(self,conn):
+        #Waits until a congested connection has been drained to the low
+        #watermark. Releases the lock of the connection and raises if it is
+        #not. The reactor threads never wait.
+        if self.settings.output_high_watermark is None:
+            #the watermarks have been removed since it became congested
+            self.__setCongested_unlocked(conn,False)
+            return
+        timeout = self.settings.congestion_timeout
+        if timeout and not self.__inReactorThread():
+            deadline = time.time()+timeout
+            while conn.congested and conn.state==Connection.state_ready:
+                now = time.time()
+                if now>=deadline:
+                    break
+                conn.output_space_cv.wait(deadline-now)
         if conn.state!=Connection.state_ready:
-            self.map_key_conn_lock.release()
+            conn.lock.release()
             raise StaleConnectionError()
-        self.__sendMessage_unlocked(msg,conn)
-        self.map_key_conn_lock.release()
+        if conn.congested:
+            conn.lock.release()
+            raise ConnectionCongestedError()
     
-    def __sendMessage_unlocked(self,msg,conn):
+    def __inReactorThread(self):
+        t = threading.currentThread()
+        return isinstance(t,SelectThread) and t.node is self
+    
+    def isCongested(self,connkey):
+        """Returns if a connection is congested.
+        See NodeSettings.setOutputWatermarks()
+          connkey  The connection
+        Returns: True if the connection is congested. False if it is not or
+                 if it no longer exists.
+        """
+        conn = self.registry.get(connkey)
+        return conn is not None and conn.congested
+    
+    def __setCongested_unlocked(self,conn,congested):
+        #Called with the lock of the connection held. The transition is
+        #reported by __reportCongestion() once the lock has been released
+        conn.congested = congested
+        if congested:
+            self.logger.log(logging.INFO,"Connection to %s is congested"%conn.host_id)
+        else:
+            self.logger.log(logging.INFO,"Connection to %s is no longer congested"%conn.host_id)
+            conn.output_space_cv.notifyAll()
+        if self.connection_listener and hasattr(self.connection_listener,"handle_congestion"):
+            conn.congestion_reports.append(congested)
+    
+    def __reportCongestion(self,conn):
+        #Calls the connection listener for the congestion transitions of a
+        #connection. Called without the lock of the connection held, so the
+        #listener may send on it
+        if not conn.congestion_reports:
+            return
+        conn.lock.acquire()
+        reports = conn.congestion_reports
+        conn.congestion_reports = []
+        conn.lock.release()
+        for congested in reports:
+            self.connection_listener.handle_congestion(conn.key,conn.peer,congested)
+    
+    def getOutputStatistics(self):
+        """Returns the number of messages sent and the number of send()
+        calls used for sending them, as a tuple (messages,send_calls).
+        Their ratio shows how well output is coalesced.
+        """
+        messages = 0
+        send_calls = 0
+        for reactor in self.reactors:
+            reactor.lock.acquire()
+            messages += reactor.messages_sent
+            send_calls += reactor.send_calls
+            for conn in reactor.connections.itervalues():
+                messages += conn.messages_sent
+                send_calls += conn.send_calls
+            reactor.lock.release()
+        return (messages,send_calls)
+    
+    def getWakeupStatistics(self):
+        """Returns how many times the reactors were woken up by other
+        threads, and how many wake-ups were not needed because the reactor
+        was busy or had been woken already, as a tuple (wakeups,avoided).
+        The counts are approximate.
+        """
+        wakeups = 0
+        avoided = 0
+        for reactor in self.reactors:
+            wakeups += reactor.wakeups
+            avoided += reactor.wakeups_avoided
+        return (wakeups,avoided)
+    
+    def __encodeMessage(self,msg,conn):
         self.logger.log(logging.DEBUG,"command=%d, to=%s"%(msg.hdr.command_code,conn.peer.host))
-        p = xdrlib.Packer()
-        msg.encode(p)
-        raw = p.get_buffer()
+        raw = msg.encodeToBuffer()
         self.__hexDump(logging.DEBUG,"Sending to "+conn.host_id,raw);
+        return raw
+    
+    def __sendMessage_unlocked(self,msg,conn):
+        #Sends a message of the node itself. The caller may hold the lock of
+        #the reactor, but not the lock of the connection. Unlike
+        #sendMessage() it is not held back by congestion, so the reactor
+        #threads never raise ConnectionCongestedError
+        raw = self.__encodeMessage(msg,conn)
+        conn.lock.acquire()
+        if conn.state==Connection.state_closed:
+            conn.lock.release()
+            return
+        handoff = self.__queueOutput_unlocked(conn,raw)
+        conn.lock.release()
+        self.__reportCongestion(conn)
+        if handoff:
+            self.__handOff(conn)
+    
+    def __queueOutput_unlocked(self,conn,raw):
+        #Queues encoded output. Called with the lock of the connection held.
+        #If nothing was queued before, nobody else is going to send it, so
+        #it is sent right away. Returns True if the connection must be
+        #handed to the reactor because the output was not sent completely
+        conn.messages_sent += 1
         was_empty = not conn.hasNetOutput()
         conn.appendAppOutputBuffer(raw)
         conn.processAppOutBuffer()
-        if was_empty:
-            self.__handleWritable(conn)
-            if conn.hasNetOutput():
-                # still some output. Wake select thread so it re-evaluates fdsets
-                self.__wakeSelectThread()
+        high = self.settings.output_high_watermark
+        if high is not None and not conn.congested and conn.netOutputBytes()>=high:
+            self.__setCongested_unlocked(conn,True)
+        if self.settings.cork_window is not None:
+            self.__cork_unlocked(conn)
+            return False
+        if not was_empty:
+            return False
+        if not self.__send_unlocked(conn):
+            #the reactor gets the error again and closes the connection
+            return True
+        return conn.hasNetOutput()
+    
+    def __handOff(self,conn):
+        #Makes the reactor of a connection send the rest of its output
+        reactor = conn.reactor
+        reactor.handoff.append(conn)
+        if not reactor.inThread():
+            reactor.wake()
+    
+    def __drainHandoff(self,reactor):
+        handoff = reactor.handoff
+        if not handoff:
+            return
+        reactor.lock.acquire()
+        while handoff:
+            conn = handoff.popleft()
+            if conn.state!=Connection.state_closed:
+                self.__handleWritable(conn)
+        reactor.lock.release()
+    
+    def __cork_unlocked(self,conn):
+        #Called with the lock of the connection held.
+        #Output queued by the thread of the reactor is sent at the end of
+        #the current iteration, and output queued by other threads when the
+        #cork window has passed. The reactor is only woken for the first
+        #message of a window.
+        reactor = conn.reactor
+        now = time.time()
+        in_reactor_thread = reactor.inThread()
+        if in_reactor_thread or conn.netOutputBytes()>=NormalConnectionBuffers.gather_size:
+            deadline = now
+        else:
+            deadline = now + self.settings.cork_window/1000000.0
+        reactor.cork_lock.acquire()
+        if not conn.corked:
+            conn.corked = True
+            reactor.corked.append(conn)
+        wake = reactor.cork_deadline is None or deadline<reactor.cork_deadline
+        if wake:
+            reactor.cork_deadline = deadline
+        reactor.cork_lock.release()
+        if wake and not in_reactor_thread:
+            reactor.wake()
+    
+    def __flushCorked(self,reactor):
+        reactor.cork_lock.acquire()
+        if reactor.cork_deadline is None or reactor.cork_deadline>time.time():
+            reactor.cork_lock.release()
+            return
+        corked = reactor.corked
+        reactor.corked = []
+        reactor.cork_deadline = None
+        reactor.cork_lock.release()
+        reactor.lock.acquire()
+        for conn in corked:
+            if conn.state!=Connection.state_closed:
+                self.__handleWritable(conn,True)
+        reactor.lock.release()
     
     def initiateConnection(self,peer,persistent=False,src=None):
         """Initiate a connection to a peer.
@@ -321,15 +560,14 @@ class Node:
             self.persistent_peers.add(peer)
             self.persistent_peers_lock.release()
         
-        self.map_key_conn_lock.acquire()
-        for conn in self.map_key_conn.itervalues():
-            if conn.peer and \
-               conn.peer == peer:
-                #already has a connection to that peer
-                self.map_key_conn_lock.release()
-                return
-            #what if we are connecting and the host_id matches?
-        self.map_key_conn_lock.release()
+        if self.registry.findByPeer(peer) is not None:
+            #already has a connection to that peer
+            return
+        #what if we are connecting and the host_id matches?
+        
+        if not self.reactors:
+            self.logger.log(logging.WARNING,"Cannot connect to '%s' before the node is started"%peer.host)
+            return
         
         #look up the ip-address first without the large mutex held
         #We should really try all the possible addresses...
@@ -365,148 +603,244 @@ class Node:
             self.logger.log(logging.DEBUG,"Connection to %s succeeded immediately"%peer.host)
             conn.state = Connection.state_connected_out
         conn.fd = fd
+        conn.reactor = self.__chooseReactor()
         
-        self.map_key_conn_lock.acquire()
-        self.map_key_conn[conn.key] = conn
-        self.map_fd_conn[conn.fd.fileno()] = conn
-        self.map_key_conn_lock.release()
-        
+        conn.reactor.lock.acquire()
+        self.__addConnection_unlocked(conn)
         if conn.state == Connection.state_connected_out:
             self.__sendCER(conn)
+        conn.reactor.lock.release()
+    
+    def __chooseReactor(self):
+        reactors = self.reactors
+        if len(reactors)==1:
+            return reactors[0]
+        if self.settings.reactor_balance==NodeSettings.balance_round_robin:
+            #itertools.count.next() is atomic
+            return reactors[self.__next_reactor.next()%len(reactors)]
+        #The connection counts are read without the locks of the reactors,
+        #so they may be slightly off. It does not matter for balancing
+        return min(reactors,key=lambda reactor: len(reactor.connections))
+    
+    def __addConnection_unlocked(self,conn):
+        #Registers a new connection with its reactor and in the registry.
+        #When called by another thread (accepting or initiating the
+        #connection), scheduleTimers() wakes the reactor, which may be
+        #sleeping without any timers
+        reactor = conn.reactor
+        reactor.connections[conn.key] = conn
+        if conn.state == Connection.state_connecting:
+            reactor.poller.register(conn.fd,EVENT_READ|EVENT_WRITE,conn)
         else:
-            self.__wakeSelectThread()
+            reactor.poller.register(conn.fd,EVENT_READ,conn)
+        reactor.pollerChanged()
+        reactor.scheduleTimers(conn)
+        self.registry.add(conn)
     
-    def run_select(self):
-        if self.sock_listen:
-            self.sock_listen.setblocking(False)
-        
+    def __removeConnection_unlocked(self,conn):
+        #Reverses __addConnection_unlocked(). The socket is not closed
+        reactor = conn.reactor
+        self.registry.remove(conn)
+        del reactor.connections[conn.key]
+        reactor.messages_sent += conn.messages_sent
+        reactor.send_calls += conn.send_calls
+        reactor.poller.unregister(conn.fd)
+        reactor.pollerChanged()
+        reactor.unscheduleTimers(conn)
+    
+    def run_select(self,reactor):
+        accepting = self.sock_listen and reactor.index==0 and not self.settings.accept_thread
         while True:
+            reactor.now = monotonic()
+            if accepting and self.accept_resume is not None and reactor.now>=self.accept_resume:
+                self.__resumeAccepting(reactor.poller)
+            #From here until poll() returns, other threads wake the reactor
+            #after queueing work for it. Work queued before is seen below
+            reactor.polling = True
             if self.please_stop:
                 if time.time()>=self.shutdown_deadline:
                     break
-                self.map_key_conn_lock.acquire()
-                isempty = len(self.map_key_conn)==0
-                self.map_key_conn_lock.release()
+                reactor.lock.acquire()
+                isempty = len(reactor.connections)==0
+                reactor.lock.release()
                 if isempty:
                     break
             
-            #build FD sets
-            self.map_key_conn_lock.acquire()
-            iwtd=[]
-            owtd=[]
-            for conn in self.map_key_conn.itervalues():
-                if conn.state!=Connection.state_closed:
-                    iwtd.append(conn.fd)
-                if conn.hasNetOutput() or conn.state == Connection.state_connecting:
-                    owtd.append(conn.fd)
-            self.map_key_conn_lock.release()
-            if self.sock_listen:
-                iwtd.append(self.sock_listen)
-            iwtd.append(self.fd_pipe[0])
-            #calc timeout
-            timeout = self.__calcNextTimeout()
-            #do select
-            if timeout:
-                now=time.time()
-                if timeout>now:
-                    ready_fds = select.select(iwtd,owtd,[],timeout - now)
+            timeout = self.__calcNextTimeout(reactor)
+            events = reactor.poller.poll(timeout)
+            reactor.polling = False
+            reactor.now = monotonic()
+            for data,events in events:
+                if data is self.sock_listen:
+                    if not self.__acceptConnections():
+                        self.__pauseAccepting(reactor.poller)
+                elif data is reactor.waker:
+                    self.logger.log(logging.DEBUG,"woken up")
+                    reactor.drainWakeups()
                 else:
-                    ready_fds = select.select(iwtd,owtd,[])
-            else:
-                ready_fds = select.select(iwtd,owtd,[])
-            for fd in ready_fds[0]:
-                if fd==self.sock_listen:
-                    #accept
-                    self.logger.log(logging.DEBUG,"Got an inbound connection (key is acceptable)")
-                    client = self.sock_listen.accept()
-                    if client:
-                        self.logger.log(logging.INFO,"Got an inbound connection from %s on %d"%(str(client[1]),client[0].fileno()))
-                        if not self.please_stop:
-                            conn = Connection()
-                            conn.fd = client[0]
-                            conn.fd.setblocking(False)
-                            conn.host_id = client[1][0]
-                            conn.state = Connection.state_connected_in
-                            self.map_key_conn_lock.acquire()
-                            self.map_key_conn[conn.key] = conn
-                            self.map_fd_conn[conn.fd.fileno()] = conn
-                            self.map_key_conn_lock.release()
-                        else:
-                            #We don't want to add the connection if were are shutting down.
-                            client[0].close()
-                    else:
-                        self.logger.log(logging.DEBUG,"Spurious wakeup on listen socket")
-                elif fd==self.fd_pipe[0]:
-                    self.logger.log(logging.DEBUG,"wake-up pipe ready")
-                    self.fd_pipe[0].recv(16)
-                else:
-                    #readable
-                    self.logger.log(logging.DEBUG,"fd is readable")
-                    self.map_key_conn_lock.acquire()
-                    conn = self.map_fd_conn[fd.fileno()]
-                    self.map_key_conn_lock.release()
-                    self.__handleReadable(conn)
-                    if conn.state==Connection.state_closed:
-                        #remove from ready_fds[1] to avoid silly exception in fileno() call
-                        for i in range(0,len(ready_fds[1])):
-                            if ready_fds[1][i]==conn.fd:
-                                del ready_fds[1][i]
-                                break;
-            for fd in ready_fds[1]:
-                self.map_key_conn_lock.acquire()
-                conn = self.map_fd_conn[fd.fileno()]
-                if conn.state==Connection.state_connecting:
-                    #connection status ready
-                    self.logger.log(logging.DEBUG,"An outbound connection is ready (key is connectable)")
-                    err = fd.getsockopt(socket.SOL_SOCKET,socket.SO_ERROR)
-                    if err==0:
-                        self.logger.log(logging.DEBUG,"Connected!")
-                        conn.state = Connection.state_connected_out
-                        self.__sendCER(conn)
-                    else:
-                        self.logger.log(logging.WARNING,"Connection to '"+conn.host_id+"' failed", ex)
-                        fd.close()
-                        del self.map_key_conn[conn.key]
-                        del self.map_fd_conn[fd.fileno()]
-                else:
-                    #plain writable
-                    self.logger.log(logging.DEBUG,"fd is writable")
-                    self.__handleWritable(conn)
-                self.map_key_conn_lock.release()
+                    conn = data
+                    if events&EVENT_READ and conn.state!=Connection.state_closed:
+                        self.logger.log(logging.DEBUG,"fd is readable")
+                        self.__handleReadable(conn)
+                    if events&EVENT_WRITE and conn.state!=Connection.state_closed:
+                        reactor.lock.acquire()
+                        if conn.state==Connection.state_connecting:
+                            self.__handleConnected(conn)
+                        elif conn.state!=Connection.state_closed:
+                            self.logger.log(logging.DEBUG,"fd is writable")
+                            self.__handleWritable(conn)
+                        reactor.lock.release()
             
-            self.__runTimers()
+            self.__drainHandoff(reactor)
+            self.__runTimers(reactor)
+            self.__flushCorked(reactor)
         
         #close all connections
         self.logger.log(logging.DEBUG,"Closing all transport connections")
-        self.map_key_conn_lock.acquire()
-        for connkey in self.map_key_conn.keys():
-            conn = self.map_key_conn[connkey]
+        reactor.lock.acquire()
+        for conn in reactor.connections.values():
             self.__closeConnection_unlocked(conn,True)
-        self.map_key_conn_lock.release()
+        reactor.lock.release()
+    
+    def run_accept(self):
+        #Accepts inbound connections and hands them to the reactors until
+        #the node is stopped
+        poller = createPoller()
+        poller.register(self.sock_listen,EVENT_READ,self.sock_listen)
+        poller.register(self.accept_waker,EVENT_READ,self.accept_waker)
+        while not self.please_stop:
+            timeout = None
+            if self.accept_resume is not None:
+                timeout = max(self.accept_resume-monotonic(),0)
+                if timeout==0:
+                    self.__resumeAccepting(poller)
+                    timeout = None
+            for data,events in poller.poll(timeout):
+                if data is self.sock_listen:
+                    if not self.__acceptConnections():
+                        self.__pauseAccepting(poller)
+                else:
+                    self.accept_waker.drain()
+        poller.close()
+    
+    def __acceptConnections(self):
+        #Accepts the queued inbound connections, up to accept_budget so the
+        #connections of the reactor are not starved during a reconnect storm.
+        #Returns False if accepting must pause because the process is out of
+        #file descriptors or memory. Then the connections stay queued by
+        #the kernel instead of the listen socket being polled in a busy loop
+        self.logger.log(logging.DEBUG,"Got an inbound connection (key is acceptable)")
+        for i in xrange(Node.accept_budget):
+            try:
+                client = self.sock_listen.accept()
+            except socket.error, (err,errstr):
+                if isTransientError(err):
+                    if i==0:
+                        self.logger.log(logging.DEBUG,"Spurious wakeup on listen socket")
+                    return True
+                if err==errno.ECONNABORTED:
+                    #the peer gave up while it was queued
+                    continue
+                if err in (errno.EMFILE,errno.ENFILE,errno.ENOBUFS,errno.ENOMEM):
+                    self.logger.log(logging.WARNING,"accept() failed, err=%d, errstr=%s. Pausing accepting connections"%(err,errstr))
+                    return False
+                self.logger.log(logging.WARNING,"accept() failed, err=%d, errstr=%s"%(err,errstr))
+                return True
+            self.__acceptConnection(client)
+        return True
+    
+    def __pauseAccepting(self,poller):
+        #Called by the thread that accepts connections, with the poller it
+        #uses
+        poller.unregister(self.sock_listen)
+        self.accept_resume = monotonic()+Node.accept_backoff
+    
+    def __resumeAccepting(self,poller):
+        poller.register(self.sock_listen,EVENT_READ,self.sock_listen)
+        self.accept_resume = None
+    
+    def __acceptConnection(self,client):
+        self.logger.log(logging.INFO,"Got an inbound connection from %s on %d"%(str(client[1]),client[0].fileno()))
+        if self.please_stop:
+            #We don't want to add the connection if were are shutting down.
+            client[0].close()
+            return
+        conn = Connection()
+        conn.fd = client[0]
+        conn.fd.setblocking(False)
+        conn.host_id = client[1][0]
+        conn.state = Connection.state_connected_in
+        conn.reactor = self.__chooseReactor()
+        conn.reactor.lock.acquire()
+        self.__addConnection_unlocked(conn)
+        conn.reactor.lock.release()
     
-    def __wakeSelectThread(self):
-        self.fd_pipe[1].send("d")
+    def __handleConnected(self,conn):
+        #connection status ready
+        self.logger.log(logging.DEBUG,"An outbound connection is ready (key is connectable)")
+        err = conn.fd.getsockopt(socket.SOL_SOCKET,socket.SO_ERROR)
+        if err==0:
+            self.logger.log(logging.DEBUG,"Connected!")
+            conn.state = Connection.state_connected_out
+            self.__updateInterest(conn)
+            self.__sendCER(conn)
+        else:
+            self.logger.log(logging.WARNING,"Connection to '%s' failed: %s"%(conn.host_id,os.strerror(err)))
+            self.__removeConnection_unlocked(conn)
+            conn.fd.close()
+            conn.state = Connection.state_closed
+    
+    def __updateInterest(self,conn):
+        #Connections are only polled for writability while they have output
+        #to send (and it is not corked) or are connecting
+        reactor = conn.reactor
+        if conn.state==Connection.state_connecting or \
+           (conn.hasNetOutput() and not conn.corked):
+            events = EVENT_READ|EVENT_WRITE
+        else:
+            events = EVENT_READ
+        if reactor.poller.modify(conn.fd,events):
+            reactor.pollerChanged()
     
-    def __calcNextTimeout(self):
+    def __calcNextTimeout(self,reactor):
+        #Returns how long the reactor may sleep (seconds), or None
+        if reactor.handoff:
+            return 0
         timeout = None
-        self.map_key_conn_lock.acquire()
-        for conn in self.map_key_conn.itervalues():
-            ready = (conn.state==Connection.state_ready)
-            conn_timeout = conn.timers.calcNextTimeout(ready)
-            if conn_timeout and ((not timeout) or conn_timeout<timeout):
-                timeout = conn_timeout
-        self.map_key_conn_lock.release()
+        reactor.lock.acquire()
+        next_timer = reactor.nextTimer()
+        if next_timer is not None:
+            timeout = next_timer-reactor.now
+        reactor.lock.release()
+        cork_deadline = reactor.cork_deadline
+        now = time.time()
+        if cork_deadline is not None:
+            if timeout is None or cork_deadline-now<timeout:
+                timeout = cork_deadline-now
         if self.please_stop:
-            if (not timeout) or self.shutdown_deadline<timeout:
-                timeout = self.shutdown_deadline
+            if timeout is None or self.shutdown_deadline-now<timeout:
+                timeout = self.shutdown_deadline-now
+        if reactor.index==0 and self.accept_resume is not None and not self.settings.accept_thread:
+            if timeout is None or self.accept_resume-reactor.now<timeout:
+                timeout = self.accept_resume-reactor.now
+        if timeout is not None:
+            timeout = max(timeout,0)
         return timeout
     
-    def __runTimers(self):
-        self.map_key_conn_lock.acquire()
-        for connkey in self.map_key_conn.keys():
-            conn = self.map_key_conn[connkey]
+    def __scheduleTimers(self,conn):
+        #The timers of the connection may expire earlier than scheduled
+        conn.reactor.lock.acquire()
+        if conn.state!=Connection.state_closed:
+            conn.reactor.scheduleTimers(conn)
+        conn.reactor.lock.release()
+    
+    def __runTimers(self,reactor):
+        #Only the connections whose timers are due are checked. Those that
+        #stay open are scheduled again
+        reactor.lock.acquire()
+        for conn in reactor.expiredTimers():
             ready = (conn.state==Connection.state_ready)
-            action=conn.timers.calcAction(ready)
+            action=conn.timers.calcAction(ready,reactor.now)
             if action==ConnectionTimers.timer_action_none:
                 pass
             elif action==ConnectionTimers.timer_action_disconnect_no_cer:
@@ -522,16 +856,18 @@ class Node:
                 self.__closeConnection_unlocked(conn)
             elif action==ConnectionTimers.timer_action_dwr:
                 self.__sendDWR(conn)
-        self.map_key_conn_lock.release()
+            if conn.state!=Connection.state_closed:
+                reactor.scheduleTimers(conn)
+        reactor.lock.release()
     
     def run_reconnect(self,src=None):
         while True:
-            self.map_key_conn_cv.acquire()
+            self.reconnect_cv.acquire()
             if self.please_stop:
-                self.map_key_conn_cv.release()
+                self.reconnect_cv.release()
                 break
-            self.map_key_conn_cv.wait(30.0)
-            self.map_key_conn_cv.release()
+            self.reconnect_cv.wait(30.0)
+            self.reconnect_cv.release()
             
             self.persistent_peers_lock.acquire()
             for pp in self.persistent_peers:
@@ -542,29 +878,45 @@ class Node:
     
     def __handleReadable(self,conn):
         self.logger.log(logging.DEBUG,"handlereadable()...")
-        try:
-            stuff = conn.fd.recv(32768)
-        except socket.error, (err,errstr):
-            if isTransientError(err):
-                #Not a real error
-                self.logger.log(logging.DEBUG,"recv() failed, err=%d, errstr=%s"%(err,errstr))
+        #Receive directly into the decoder of the connection until the
+        #socket is drained or the budget is used up
+        decoder = conn.decoder
+        budget = Node.read_budget
+        peer_closed = False
+        while budget>0:
+            size = conn.read_size
+            try:
+                bytes = conn.fd.recv_into(decoder.writable(size),size)
+            except socket.error, (err,errstr):
+                if isTransientError(err):
+                    #Not a real error
+                    self.logger.log(logging.DEBUG,"recv() failed, err=%d, errstr=%s"%(err,errstr))
+                    break
+                #hard error
+                self.logger.log(logging.INFO,"recv() failed, err=%d, errstr=%s"%(err,errstr))
+                self.__closeConnection(conn)
                 return
-            #hard error
-            self.logger.log(logging.INFO,"recv() failed, err=%d, errstr=%s"%(err,errstr))
-            self.__closeConnection(conn)
-            return
-        if len(stuff)==0:
-            #peer closed connection
-            self.logger.log(logging.DEBUG,"Read 0 bytes from peer")
-            self.__closeConnection(conn)
-            return
+            if bytes==0:
+                #peer closed connection
+                self.logger.log(logging.DEBUG,"Read 0 bytes from peer")
+                peer_closed = True
+                break
+            decoder.commit(bytes)
+            conn.adjustReadSize(bytes)
+            budget -= bytes
+            if bytes<size:
+                #short read, so there is nothing more to read
+                break
         
-        conn.appendNetInBuffer(stuff)
-        conn.processNetInBuffer()
-        self.__processInBuffer(conn)
+        if conn.hasAppInput():
+            conn.processNetInBuffer()
+            self.__processInBuffer(conn)
+        if peer_closed and conn.state!=Connection.state_closed:
+            self.__closeConnection(conn)
     
     def __hexDump(self,level,msg,raw):
         if not self.logger.isEnabledFor(level): return
+        raw = str(raw)
         #todo: there must be a faster way of doing this...
         s=msg+'\n'
         for i in range(0,len(raw),16):
@@ -588,76 +940,89 @@ class Node:
     
     def __processInBuffer(self,conn):
         self.logger.log(logging.DEBUG,"Node.__processInBuffer()")
-        raw = conn.getAppInBuffer()
-        self.logger.log(logging.DEBUG,"len(raw)=%d"%len(raw))
-        u = xdrlib.Unpacker(raw)
-        while u.get_position()<len(raw):
-            msg_start = u.get_position()
-            bytes_left = len(raw)-msg_start
-            #print "  msg_start=",msg_start," bytes_left=",bytes_left
-            if bytes_left<4:
-                break
-            msg_size = Message.decodeSize(u)
-            if bytes_left<msg_size:
-                break
-            msg = Message()
-            status = msg.decode(u,msg_size)
-            #print "  state=",status
-            if status==Message.decode_status_decoded:
-                self.__hexDump(logging.DEBUG,"Got message "+conn.host_id,raw[msg_start:msg_start+msg_size]);
+        self.logger.log(logging.DEBUG,"buffered=%d"%conn.decoder.bufferedBytes())
+        try:
+            for msg in conn.decoder.messages():
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.__hexDump(logging.DEBUG,"Got message "+conn.host_id,msg.encodeToBuffer());
                 b = self.__handleMessage(msg,conn)
                 if not b:
                     self.logger.log(logging.DEBUG,"handle error")
                     self.__closeConnection(conn)
                     return
-            elif status==Message.decode_status_not_enough:
-                break #?
-            elif status==Message.decode_status_garbage:
-                self.__hexDump(logging.WARNING,"Garbage from "+conn.host_id,raw[msg_start:msg_start+msg_size]);
-                #self.__hexDump(logging.INFO,"Complete inbuffer: ",raw,0,raw_bytes);
-                self.__closeConnection(conn,reset=True)
-                return
-        conn.consumeAppInBuffer(u.get_position())
+        except InvalidMessageError, details:
+            self.__hexDump(logging.WARNING,"Garbage from "+conn.host_id,details.args[0]);
+            self.__closeConnection(conn,reset=True)
     
     
-    def __handleWritable(self,conn):
+    def __handleWritable(self,conn,uncork=False):
+        #Called with the lock of the reactor held
         self.logger.log(logging.DEBUG,"__handleWritable():")
-        raw = conn.getNetOutBuffer()
-        if len(raw)==0: return
+        conn.lock.acquire()
+        if uncork:
+            conn.corked = False
+        ok = True
+        if conn.hasNetOutput():
+            ok = self.__send_unlocked(conn)
+        conn.lock.release()
+        self.__reportCongestion(conn)
+        if ok:
+            self.__updateInterest(conn)
+        else:
+            self.__closeConnection_unlocked(conn)
+    
+    def __send_unlocked(self,conn):
+        #Sends as much of the queued output as the socket takes. Called with
+        #the lock of the connection held. Returns False on hard errors
         try:
-            bytes_sent = conn.fd.send(raw)
+            bytes_sent = conn.fd.send(conn.getNetOutBuffer())
+            conn.send_calls += 1
         except socket.error, (err,errstr):
             if isTransientError(err):
                 #Not a real error
                 self.logger.log(logging.DEBUG,"send() failed, err=%d, errstr=%s"%(err,errstr))
-                return
+                return True
             #hard error
             self.logger.log(logging.INFO,"send() failed, err=%d, errstr=%s"%(err,errstr))
-            self.__closeConnection_unlocked(conn)
-            return
+            return False
             
         conn.consumeNetOutBuffer(bytes_sent)
+        if conn.congested:
+            low = self.settings.output_low_watermark
+            #the watermarks may have been removed in the meantime
+            if low is None or conn.netOutputBytes()<=low:
+                self.__setCongested_unlocked(conn,False)
+        return True
     
     def __closeConnection_unlocked(self,conn,reset=False):
         if conn.state==Connection.state_closed:
             return
-        del self.map_key_conn[conn.key]
-        del self.map_fd_conn[conn.fd.fileno()]
+        if conn.corked and not reset:
+            #last chance for corked output, eg. a DPR or an error answer
+            self.__handleWritable(conn,True)
+            if conn.state==Connection.state_closed:
+                return
+        self.__removeConnection_unlocked(conn)
+        conn.lock.acquire()
         if reset:
             #Set lingertime to zero to force a RST when closing the socket
             #rfc3588, section 2.1
            conn.fd.setsockopt(socket.SOL_SOCKET,socket.SO_LINGER,struct.pack("ii",1,0))
            pass
         conn.fd.close()
+        conn.state = Connection.state_closed
+        if conn.congested:
+            #senders waiting for the connection give up
+            conn.output_space_cv.notifyAll()
+        conn.lock.release()
         if self.connection_listener:
             self.connection_listener.handle_connection(conn.key,conn.peer,False)
-        conn.state = Connection.state_closed
     
     def __closeConnection(self,conn,reset=False):
         self.logger.log(logging.INFO,"Closing connection to " + conn.host_id)
-        self.map_key_conn_lock.acquire()
+        conn.reactor.lock.acquire()
         self.__closeConnection_unlocked(conn,reset)
-        self.map_key_conn_lock.release()
+        conn.reactor.lock.release()
         self.logger.log(logging.DEBUG,"Closed connection to " + conn.host_id)
     
     def __initiateConnectionClose(self,conn,why):
@@ -665,11 +1030,12 @@ class Node:
             return #Should probably never happen
         self.__sendDPR(conn,why)
         conn.state = Connection.state_closing
+        self.registry.update(conn)
     
     def __handleMessage(self,msg,conn):
         if self.logger.isEnabledFor(logging.DEBUG):
             self.logger.log(logging.DEBUG,"command_code=%d application_id=%d connection_state=%d"%(msg.hdr.command_code,msg.hdr.application_id,conn.state))
-        conn.timers.markActivity()
+        conn.timers.markActivity(conn.reactor.now)
         if conn.state==Connection.state_connected_in:
             #only CER allowed
             if (not msg.hdr.isRequest()) or \
@@ -778,18 +1144,25 @@ class Node:
         response = Message()
         response.prepareResponse(msg)
         response.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, result_code))
-        self.addOurHostAndRealm(response)
+        self.__addOurHostAndRealm(response)
         Utils.copyProxyInfo(msg,response)
         Utils.setMandatory_RFC3588(response)
-        self.sendMessage(response,conn.key);
+        self.__sendMessage_unlocked(response,conn)
     
     def addOurHostAndRealm(self,msg):
         """Add origin-host and origin-realm to a message.
         The configured host and realm is added to the message as origin-host
-        and origin-realm AVPs
+        and origin-realm AVPs. They are copies of pre-encoded AVPs, so they
+        are cheap to encode and can be modified like any other AVP.
         """
-        msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,self.settings.host_id))
-        msg.append(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_REALM,self.settings.realm))
+        for a in self.avp_cache.originHostAndRealm():
+            msg.append(a.copy())
+    
+    def __addOurHostAndRealm(self,msg):
+        #For the messages of the node itself, which are never modified after
+        #they are built, so the pre-encoded AVPs are shared
+        for a in self.avp_cache.originHostAndRealm():
+            msg.append(a)
     
     def nextEndToEndIdentifier(self):
         """Returns an end-to-end identifier that is unique.
@@ -797,7 +1170,7 @@ class Node:
         """
         return self.node_state.nextEndToEndIdentifier()
     
-    def __doElection(self,cer_host_id):
+    def __doElection(self,cer_host_id,conn):
         #5.6.4
         c = cmp(self.settings.host_id,cer_host_id)
         if c==0:
@@ -806,17 +1179,14 @@ class Node:
         
         close_other_connection = c>0
         rc = True
-        self.map_key_conn_cv.acquire()
-        for connkey,conn in self.map_key_conn.iteritems():
-            if conn.host_id and conn.host_id==cer_host_id:
-                if close_other_connection:
-                    self.__closeConnection(conn)
-                    rc = True
-                    break
-                else:
-                    rc = False #close this one
-                    break
-        self.map_key_conn_cv.release()
+        other = self.registry.findByHostId(cer_host_id,conn)
+        if other:
+            if close_other_connection:
+                #it may belong to another reactor, so it is closed under the
+                #lock of its own reactor
+                self.__closeConnection(other)
+            else:
+                rc = False #close this one
         return rc
 
     def __handleCER(self,msg,conn):
@@ -828,18 +1198,18 @@ class Node:
             error_response = Message()
             error_response.prepareResponse(msg)
             error_response.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_MISSING_AVP))
-            self.addOurHostAndRealm(error_response);
+            self.__addOurHostAndRealm(error_response);
             error_response.append(AVP_FailedAVP(AVP_UTF8String(ProtocolConstants.DI_ORIGIN_HOST,"")))
             Utils.setMandatory_RFC3588(error_response)
             self.__sendMessage_unlocked(error_response,conn)
             return False
         host_id = AVP_UTF8String.narrow(avp).queryValue()
         self.logger.log(logging.DEBUG,"Peer's origin-host-id is " + host_id)
-        if not self.__doElection(host_id):
+        if not self.__doElection(host_id,conn):
             error_response = Message()
             error_response.prepareResponse(msg)
             error_response.append(AVP_Unsigned32(ProtocolConstants.DIAMETER_RESULT_ELECTION_LOST, ProtocolConstants.DIAMETER_RESULT_MISSING_AVP))
-            self.addOurHostAndRealm(error_response)
+            self.__addOurHostAndRealm(error_response)
             Utils.setMandatory_RFC3588(error_response)
             self.__sendMessage_unlocked(error_response,conn)
             return False
@@ -847,19 +1217,22 @@ class Node:
         conn.peer = Peer(socket_address=conn.fd.getpeername())
         conn.peer.host = host_id
         conn.host_id = host_id
+        self.registry.update(conn)
         
         if self.__handleCEx(msg,conn):
             #todo: check inband-security
             cea = Message()
             cea.prepareResponse(msg)
             #Result-Code
-            cea.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_SUCCESS))
+            cea.append(self.avp_cache.resultCode(ProtocolConstants.DIAMETER_RESULT_SUCCESS))
             self.__addCEStuff(cea,conn.peer.capabilities,conn)
             
             self.logger.log(logging.INFO,"Connection to " +conn.host_id + " is now ready")
             Utils.setMandatory_RFC3588(cea);
             self.__sendMessage_unlocked(cea,conn)
             conn.state=Connection.state_ready;
+            self.registry.update(conn)
+            self.__scheduleTimers(conn)
             
             if self.connection_listener:
                 self.connection_listener.handle_connection(conn.key, conn.peer, True)
@@ -882,10 +1255,13 @@ class Node:
         conn.peer = Peer(socket_address=conn.fd.getpeername())
         conn.peer.host = host_id
         conn.host_id = host_id
+        self.registry.update(conn)
         
         rc = self.__handleCEx(msg,conn)
         if rc:
             conn.state=Connection.state_ready;
+            self.registry.update(conn)
+            self.__scheduleTimers(conn)
             self.logger.log(logging.INFO,"Connection to " +conn.host_id + " is now ready");
             if self.connection_listener:
                 self.connection_listener.handle_connection(conn.key, conn.peer, True)
@@ -962,7 +1338,7 @@ class Node:
                     error_response = Message()
                     error_response.prepareResponse(msg)
                     error_response.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_NO_COMMON_APPLICATION))
-                    self.addOurHostAndRealm(error_response)
+                    self.__addOurHostAndRealm(error_response)
                     Utils.setMandatory_RFC3588(error_response)
                     self.__sendMessage_unlocked(error_response,conn)
                 return False
@@ -974,7 +1350,7 @@ class Node:
                 error_response = Message()
                 error_response.prepareResponse(msg);
                 error_response.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_INVALID_AVP_LENGTH))
-                self.addOurHostAndRealm(error_response)
+                self.__addOurHostAndRealm(error_response)
                 error_response.append(AVP_FailedAVP(ex.avp))
                 Utils.setMandatory_RFC3588(error_response)
                 self.__sendMessage_unlocked(error_response,conn)
@@ -985,7 +1361,7 @@ class Node:
                 error_response = Message()
                 error_response.prepareResponse(msg)
                 error_response.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_INVALID_AVP_VALUE))
-                self.addOurHostAndRealm(error_response)
+                self.__addOurHostAndRealm(error_response)
                 error_response.append(AVP_FailedAVP(ex.avp))
                 Utils.setMandatory_RFC3588(error_response)
                 self.__sendMessage_unlocked(error_response,conn)
@@ -1007,79 +1383,44 @@ class Node:
 
     def __addCEStuff(self,msg,capabilities,conn):
         #Origin-Host, Origin-Realm
-        self.addOurHostAndRealm(msg);
+        self.__addOurHostAndRealm(msg);
         #Host-IP-Address
         #  This is not really that good...
-        if conn.peer and conn.peer.use_ericsson_host_ip_address_format:
-            #Some servers (ericsson) requires a non-compliant payload in the host-ip-address AVP
-            tmp_avp = AVP_Address(ProtocolConstants.DI_HOST_IP_ADDRESS, conn.fd.getsockname()[0])
-            msg.append(AVP(ProtocolConstants.DI_HOST_IP_ADDRESS, tmp_avp.payload[2:]))
-        else:
-            msg.append(AVP_Address(ProtocolConstants.DI_HOST_IP_ADDRESS, conn.fd.getsockname()[0]))
-        #Vendor-Id
-        msg.append(AVP_Unsigned32(ProtocolConstants.DI_VENDOR_ID, self.settings.vendor_id))
-        #Product-Name
-        msg.append(AVP_UTF8String(ProtocolConstants.DI_PRODUCT_NAME, self.settings.product_name))
-        #Origin-State-Id
-        msg.append(AVP_Unsigned32(ProtocolConstants.DI_ORIGIN_STATE_ID, self.node_state.state_id));
-        #Error-Message, Failed-AVP: not in success
-        #Supported-Vendor-Id
-        for i in capabilities.supported_vendor:
-            msg.append(AVP_Unsigned32(ProtocolConstants.DI_SUPPORTED_VENDOR_ID,i))
-        #Auth-Application-Id
-        for i in capabilities.auth_app:
-            msg.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,i))
-        #Inband-Security-Id
-        #  todo
-        #Acct-Application-Id
-        for i in capabilities.acct_app:
-            msg.append(AVP_Unsigned32(ProtocolConstants.DI_ACCT_APPLICATION_ID,i))
-        #Vendor-Specific-Application-Id
-        for va in capabilities.auth_vendor:
-            g = []
-            g.append(AVP_Unsigned32(ProtocolConstants.DI_VENDOR_ID,va.vendor_id))
-            g[-1].setMandatory(True)
-            g.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,va.application_id))
-            g[-1].setMandatory(True)
-            msg.append(AVP_Grouped(ProtocolConstants.DI_VENDOR_SPECIFIC_APPLICATION_ID,g))
-        for va in capabilities.acct_vendor:
-            g = []
-            g.append(AVP_Unsigned32(ProtocolConstants.DI_VENDOR_ID,va.vendor_id))
-            g[-1].setMandatory(True)
-            g.append(AVP_Unsigned32(ProtocolConstants.DI_ACCT_APPLICATION_ID,va.application_id))
-            g[-1].setMandatory(True)
-            msg.append(AVP_Grouped(ProtocolConstants.DI_VENDOR_SPECIFIC_APPLICATION_ID,g))
-        #Firmware-Revision
-        if self.settings.firmware_revision!=0:
-            msg.append(AVP_Unsigned32(ProtocolConstants.DI_FIRMWARE_REVISION,self.settings.firmware_revision))
+        #  Some servers (ericsson) requires a non-compliant payload in the host-ip-address AVP
+        ericsson_format = bool(conn.peer and conn.peer.use_ericsson_host_ip_address_format)
+        msg.append(self.avp_cache.hostIPAddress(conn.fd.getsockname()[0],ericsson_format))
+        #Vendor-Id, Product-Name, Origin-State-Id, capabilities and Firmware-Revision
+        for a in self.avp_cache.capabilitiesExchange(capabilities):
+            msg.append(a)
 
     def __handleDWR(self,msg,conn):
         self.logger.log(logging.INFO,"DWR received from "+conn.host_id);
-        conn.timers.markDWR()
+        conn.timers.markDWR(conn.reactor.now)
         dwa = Message()
         dwa.prepareResponse(msg)
-        dwa.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_SUCCESS))
-        self.addOurHostAndRealm(dwa)
-        dwa.append(AVP_Unsigned32(ProtocolConstants.DI_ORIGIN_STATE_ID, self.node_state.state_id))
-        Utils.setMandatory_RFC3588(dwa)
+        #Result-Code, Origin-Host, Origin-Realm, Origin-State-Id
+        for a in self.avp_cache.watchdogAnswer():
+            dwa.append(a)
         
-        self.sendMessage(dwa,conn.key)
+        self.__sendMessage_unlocked(dwa,conn)
         return True
 
     def __handleDWA(self,msg,conn):
         self.logger.log(logging.DEBUG,"DWA received from "+conn.host_id)
-        conn.timers.markDWA()
+        conn.timers.markDWA(conn.reactor.now)
+        #the next DWR is due earlier now
+        self.__scheduleTimers(conn)
         return True
     
     def __handleDPR(self,msg,conn):
         self.logger.log(logging.DEBUG,"DPR received from "+conn.host_id);
         dpa = Message()
         dpa.prepareResponse(msg)
-        dpa.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_SUCCESS))
-        self.addOurHostAndRealm(dpa)
-        Utils.setMandatory_RFC3588(dpa)
+        #Result-Code, Origin-Host, Origin-Realm
+        for a in self.avp_cache.disconnectPeerAnswer():
+            dpa.append(a)
         
-        self.sendMessage(dpa,conn.key)
+        self.__sendMessage_unlocked(dpa,conn)
         return False
     
     def __handleDPA(self,msg,conn):
@@ -1094,10 +1435,10 @@ class Node:
         answer = Message()
         answer.prepareResponse(msg)
         answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_UNABLE_TO_DELIVER))
-        self.addOurHostAndRealm(answer)
+        self.__addOurHostAndRealm(answer)
         Utils.setMandatory_RFC3588(answer)
         
-        self.sendMessage(answer,conn.key)
+        self.__sendMessage_unlocked(answer,conn)
         return True
 
     def __sendDWR(self,conn):
@@ -1108,13 +1449,13 @@ class Node:
         dwr.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_COMMON
         dwr.hdr.hop_by_hop_identifier = conn.nextHopByHopIdentifier()
         dwr.hdr.end_to_end_identifier = self.node_state.nextEndToEndIdentifier()
-        self.addOurHostAndRealm(dwr)
-        dwr.append(AVP_Unsigned32(ProtocolConstants.DI_ORIGIN_STATE_ID, self.node_state.state_id))
-        Utils.setMandatory_RFC3588(dwr)
+        #Origin-Host, Origin-Realm, Origin-State-Id
+        for a in self.avp_cache.watchdogRequest():
+            dwr.append(a)
         
         self.__sendMessage_unlocked(dwr,conn)
         
-        conn.timers.markDWR_out()
+        conn.timers.markDWR_out(conn.reactor.now)
     
     def __sendDPR(self,conn,why):
         self.logger.log(logging.DEBUG,"Sending DPR to "+conn.host_id);
@@ -1124,7 +1465,7 @@ class Node:
         dpr.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_COMMON
         dpr.hdr.hop_by_hop_identifier = conn.nextHopByHopIdentifier()
         dpr.hdr.end_to_end_identifier = self.node_state.nextEndToEndIdentifier()
-        self.addOurHostAndRealm(dpr)
+        self.__addOurHostAndRealm(dpr)
         dpr.append(AVP_Unsigned32(ProtocolConstants.DI_DISCONNECT_CAUSE, why))
         Utils.setMandatory_RFC3588(dpr)
         
@@ -1165,6 +1506,216 @@ def _unittest():
     settings = NodeSettings("isjsys.int.i1.dk","i1.dk",1,cap,3868,"pythondiameter",1)
     n = Node(MD(),CL(),settings)
     
+    #the AVPs added by addOurHostAndRealm() are the message's own
+    m = Message()
+    n.addOurHostAndRealm(m)
+    AVP_UTF8String.narrow(m.find(ProtocolConstants.DI_ORIGIN_HOST)).setValue("other.i1.dk")
+    m.find(ProtocolConstants.DI_ORIGIN_REALM).payload = "other.dk"
+    m = Message()
+    n.addOurHostAndRealm(m)
+    assert AVP_UTF8String.narrow(m.find(ProtocolConstants.DI_ORIGIN_HOST)).queryValue()=="isjsys.int.i1.dk"
+    assert m.find(ProtocolConstants.DI_ORIGIN_REALM).payload=="i1.dk"
+    
     n.start()
     time.sleep(1)
     n.stop()
+    
+    #inbound connections are spread over the reactors
+    class Listener:
+        def handle_connection(self,connkey,peer,updown):
+            pass
+        def handle_message(self,msg,connkey,peer):
+            return False
+    settings.setReactors(2)
+    n = Node(Listener(),Listener(),settings)
+    n.start()
+    clients = []
+    for i in range(2):
+        c = Node(Listener(),Listener(),NodeSettings("client%d.i1.dk"%i,"i1.dk",1,cap,0,"pythondiameter",1))
+        c.start()
+        c.initiateConnection(Peer("127.0.0.1",3868))
+        c.waitForConnection(5)
+        clients.append(c)
+    n.waitForConnection(5)
+    assert [len(reactor.connections) for reactor in n.reactors]==[1,1]
+    for c in clients:
+        c.stop()
+    n.stop()
+    
+    #every reactor checks the timers of the connections handed to it by
+    #reactor 0 or the accept thread, so peers that never send a CER are
+    #disconnected
+    class ShortWatchdog(Connection):
+        def __init__(self):
+            super(ShortWatchdog,self).__init__()
+            self.timers.cfg_watchdog_timer = 1
+    connection_class = Connection
+    globals()["Connection"] = ShortWatchdog
+    try:
+        for accept_thread in (False,True):
+            settings.setAcceptThread(accept_thread)
+            n = Node(Listener(),Listener(),settings)
+            n.start()
+            clients = []
+            for i in range(2):
+                clients.append(socket.create_connection(("127.0.0.1",3868)))
+                time.sleep(0.2)
+            assert [len(reactor.connections) for reactor in n.reactors]==[1,1]
+            end = time.time()+5
+            while len(n.registry)>0 and time.time()<end:
+                time.sleep(0.05)
+            assert len(n.registry)==0
+            for client in clients:
+                client.settimeout(1)
+                assert client.recv(1)==""
+                client.close()
+            n.stop()
+    finally:
+        globals()["Connection"] = connection_class
+        settings.setAcceptThread(False)
+    
+    #threads sending on the same connection do not corrupt each other's
+    #messages
+    class Counter(Listener):
+        def __init__(self):
+            self.count = 0
+        def handle_message(self,msg,connkey,peer):
+            assert len(msg.find(ProtocolConstants.DI_PROXY_INFO).payload)==5000
+            self.count += 1
+            return True
+    counter = Counter()
+    n = Node(counter,counter,settings)
+    n.start()
+    c = Node(Listener(),Listener(),NodeSettings("client.i1.dk","i1.dk",1,cap,0,"pythondiameter",1))
+    c.start()
+    c.initiateConnection(Peer("127.0.0.1",3868))
+    c.waitForConnection(5)
+    connkey = c.findConnection(Peer("isjsys.int.i1.dk",3868))
+    def send():
+        for i in range(100):
+            msg = Message()
+            msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_NASREQ
+            msg.hdr.hop_by_hop_identifier = c.nextHopByHopIdentifier(connkey)
+            msg.append(AVP_OctetString(ProtocolConstants.DI_PROXY_INFO,"x"*5000))
+            c.sendMessage(msg,connkey)
+    senders = [threading.Thread(target=send) for i in range(4)]
+    for t in senders:
+        t.start()
+    for t in senders:
+        t.join()
+    end = time.time()+5
+    while counter.count<400 and time.time()<end:
+        time.sleep(0.05)
+    assert counter.count==400
+    c.stop()
+    n.stop()
+    
+    #an accept thread hands the inbound connections to the reactors
+    settings.setAcceptThread(True)
+    n = Node(Listener(),Listener(),settings)
+    n.start()
+    c = Node(Listener(),Listener(),NodeSettings("client.i1.dk","i1.dk",1,cap,0,"pythondiameter",1))
+    c.start()
+    c.initiateConnection(Peer("127.0.0.1",3868))
+    c.waitForConnection(5)
+    n.waitForConnection(5)
+    assert len(n.registry)==1
+    c.stop()
+    n.stop()
+    assert n.accept_thread is None
+    
+    #running out of file descriptors pauses accepting instead of killing
+    #the accepting thread
+    import resource
+    for accept_thread in (True,False):
+        settings.setAcceptThread(accept_thread)
+        n = Node(Listener(),Listener(),settings)
+        n.start()
+        clients = [socket.socket() for i in range(3)]
+        soft,hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        fd = os.dup(0)
+        os.close(fd)
+        resource.setrlimit(resource.RLIMIT_NOFILE,(fd,hard))
+        try:
+            for client in clients:
+                client.connect(("127.0.0.1",3868))
+            time.sleep(0.3)
+            assert len(n.registry)==0
+            if accept_thread:
+                assert n.accept_thread.isAlive()
+            else:
+                assert n.reactors[0].thread.isAlive()
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE,(soft,hard))
+        end = time.time()+5
+        while len(n.registry)<3 and time.time()<end:
+            time.sleep(0.05)
+        assert len(n.registry)==3
+        for client in clients:
+            client.close()
+        n.stop()
+    
+    #the node answers a DWR on a congested connection without raising in
+    #the reactor thread, and the congestion listener may send
+    class Congestion(Listener):
+        def __init__(self):
+            self.node = None
+            self.msg = None
+            self.reports = []
+        def handle_congestion(self,connkey,peer,congested):
+            self.reports.append(congested)
+            if not congested:
+                self.node.sendMessage(self.msg,connkey)
+    class Blocked(Listener):
+        def __init__(self):
+            self.release = threading.Event()
+        def handle_message(self,msg,connkey,peer):
+            self.release.wait()
+            return True
+    settings.setOutputWatermarks(4096,1024)
+    congestion = Congestion()
+    n = Node(Listener(),congestion,settings)
+    congestion.node = n
+    n.start()
+    blocked = Blocked()
+    c = Node(blocked,Listener(),NodeSettings("client.i1.dk","i1.dk",1,cap,0,"pythondiameter",1))
+    c.start()
+    c.initiateConnection(Peer("127.0.0.1",3868))
+    c.waitForConnection(5)
+    n.waitForConnection(5)
+    connkey = n.registry.values()[0].key
+    congestion.msg = Message()
+    congestion.msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_NASREQ
+    try:
+        for i in range(100000):
+            msg = Message()
+            msg.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_NASREQ
+            msg.hdr.setRequest(True)
+            msg.hdr.hop_by_hop_identifier = n.nextHopByHopIdentifier(connkey)
+            msg.append(AVP_Unsigned32(ProtocolConstants.DI_AUTH_APPLICATION_ID,ProtocolConstants.DIAMETER_APPLICATION_NASREQ))
+            msg.append(AVP_OctetString(ProtocolConstants.DI_PROXY_INFO,"x"*5000))
+            n.sendMessage(msg,connkey)
+        assert False
+    except ConnectionCongestedError:
+        pass
+    assert congestion.reports[0] and congestion.reports[-1]
+    c_connkey = c.findConnection(Peer("isjsys.int.i1.dk",3868))
+    dwr = Message()
+    dwr.hdr.setRequest(True)
+    dwr.hdr.command_code = ProtocolConstants.DIAMETER_COMMAND_DEVICE_WATCHDOG
+    dwr.hdr.application_id = ProtocolConstants.DIAMETER_APPLICATION_COMMON
+    dwr.hdr.hop_by_hop_identifier = c.nextHopByHopIdentifier(c_connkey)
+    dwr.hdr.end_to_end_identifier = c.nextEndToEndIdentifier()
+    c.addOurHostAndRealm(dwr)
+    c.sendMessage(dwr,c_connkey)
+    time.sleep(0.5)
+    assert n.reactors[0].thread.isAlive()
+    assert n.isConnectionKeyValid(connkey) and n.isCongested(connkey)
+    #removing the watermarks ends the congestion
+    settings.setOutputWatermarks(None,None)
+    n.sendMessage(msg,connkey)
+    assert not n.isCongested(connkey)
+    assert not congestion.reports[-1]
+    blocked.release.set()
+    c.stop()
+    n.stop()
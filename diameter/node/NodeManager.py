@@ -25,12 +25,40 @@ class NodeManager:
         self.settings = settings
         self.req_map = {}
         self.req_map_lock = threading.Lock()
+        self.executor = None
         self.logger = logging.getLogger("dk.i1.diameter.node")
     
+    def setExecutor(self,executor):
+        """Handles incoming messages in a pool of threads.
+        By default handleRequest() and handleAnswer() are called by the
+        networking threads, so a slow handler delays all the peers of its
+        reactor. With an executor (eg. Executor) they are called by the
+        threads of the executor instead. The messages are partitioned by
+        their Session-Id (or by connection for messages without one), so
+        the messages of a session are handled in the order they arrived.
+        A request arriving when its queue is full is answered with
+        DIAMETER_TOO_BUSY. Answers are always queued.
+        Must be called before start().
+          executor  The executor. None handles the messages in the
+                    networking threads.
+        """
+        self.executor = executor
+    
+    def getStatistics(self):
+        """Returns the statistics of the executor (see
+        Executor.getStatistics()), or an empty dictionary if there is no
+        executor.
+        """
+        if self.executor:
+            return self.executor.getStatistics()
+        return {}
+    
     def start(self,src=None):
         """
         Starts the embedded Node.
         """
+        if self.executor:
+            self.executor.start()
         self.node.start(src)
     
     def stop(self,grace_time=0):
@@ -39,10 +67,12 @@ class NodeManager:
         for outstanding requests.
         """
         self.node.stop(grace_time)
+        if self.executor:
+            self.executor.stop()
         self.req_map_lock.acquire()
         for connkey,reqs in self.req_map.iteritems():
             for req in reqs.itervalues():
-                handleAnswer(None,connkey,req)
+                self.handleAnswer(None,connkey,req)
         self.req_map_lock.release()
     
     def waitForConnection(self,timeout=None):
@@ -59,13 +89,12 @@ class NodeManager:
         This method is called when a request arrives. It is meant to be
         overridden by a subclass. This implementation rejects all requests.
         
-        Please note that the handleRequest() method is called by the
-        networking thread and messages from other peers cannot be received
+        Please note that unless an executor has been set with
+        setExecutor(), the handleRequest() method is called by the
+        networking thread and messages from other peers (of the same
+        reactor, see NodeSettings.setReactors()) cannot be received
         until the method returns. If the handleRequest() method needs to do
-        any lengthy processing then it should implement a message queue,
-        put the message into the queue, and return. The requests can then
-        be processed by a worker thread pool without stalling the
-        networking layer.
+        any lengthy processing then an executor should be used.
           request  The incoming request.
           connkey  The connection from where the request came.
           peer     The peer that sent the request. This is not the
@@ -74,26 +103,24 @@ class NodeManager:
         """
         #incoming requests are not expected by this node
         answer = Message()
-        self.logger.log(logging.DEBUG,"Handling incoming request, command_code=%d, end2end=%d, hopbyhop=%d"%(request.hdr.command_code,peer.host,request.hdr.end_to_end_identifier,request.hdr.hop_by_hop_identifier))
+        self.logger.log(logging.DEBUG,"Handling incoming request, command_code=%d, peer=%s, end2end=%d, hopbyhop=%d"%(request.hdr.command_code,peer.host,request.hdr.end_to_end_identifier,request.hdr.hop_by_hop_identifier))
         answer.prepareResponse(request)
-        answer.add(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_UNABLE_TO_DELIVER))
+        answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_UNABLE_TO_DELIVER))
         self.node.addOurHostAndRealm(answer)
         Utils.copyProxyInfo(request,answer)
         Utils.setMandatory_RFC3588(answer)
-        answer(answer,connkey)
+        self.answer(answer,connkey)
     
     def handleAnswer(self,answer,answer_connkey,state):
         """Handle an answer.
         This method is called when an answer arrives. It is meant to
         be overridden in a subclass.
         
-        Please note that the handleAnswer() method is called by the
+        Please note that unless an executor has been set with
+        setExecutor(), the handleAnswer() method is called by the
         networking thread and messages from other peers cannot be received
         until the method returns. If the handleAnswer() method needs to do
-        any lengthy processing then it should implement a message queue,
-        put the message into the queue, and return. The answers can then be
-        processed by a worker thread pool without stalling the networking
-        layer.
+        any lengthy processing then an executor should be used.
           answer          The answer message. Null if the connection broke.
           answer_connkey  The connection from where the answer came.
           state           The state object passed to sendRequest_*() or
@@ -105,7 +132,8 @@ class NodeManager:
     def answer(self,answer,connkey):
         """Answer a request.
         The answer is sent to the connection. If the connection has been
-        lost in the meantime it is ignored.
+        lost in the meantime it is ignored. If the connection is congested
+        the answer is dropped, like it is by a peer that is overloaded.
           answer   The answer message.
           connkey  The connection to send the answer to.
         Raises:
@@ -117,6 +145,8 @@ class NodeManager:
             self.node.sendMessage(answer,connkey)
         except StaleConnectionError, ex:
             pass
+        except ConnectionCongestedError, ex:
+            self.logger.log(logging.WARNING,"Dropping answer, hop_by_hop_identifier=%d, because the connection is congested"%answer.hdr.hop_by_hop_identifier)
     
     def forwardRequest(self,request,connkey,state):
         """
@@ -136,6 +166,8 @@ class NodeManager:
             If the request does not have the P bit set in the header.
           StaleConnectionError
             If the ConnectionKey refers to a lost connection.
+          ConnectionCongestedError
+            If the connection is congested.
         """
         if not request.hdr.isProxiable():
             raise NotProxiableError()
@@ -147,7 +179,7 @@ class NodeManager:
                 break
         if not our_route_record_found:
             #add a route-record
-            request.add(AVP_UTF8String(ProtocolConstants.DI_ROUTE_RECORD,settings.host_id))
+            request.append(AVP_UTF8String(ProtocolConstants.DI_ROUTE_RECORD,self.settings.host_id))
         #send it
         self.sendRequest_1(request,connkey,state)
     
@@ -174,7 +206,7 @@ class NodeManager:
         if answer.hdr.isRequest():
             raise NotAnAnswerError()
         #add a route-record
-        answer.add(AVP_UTF8String(ProtocolConstants.DI_ROUTE_RECORD,settings.host_id))
+        answer.append(AVP_UTF8String(ProtocolConstants.DI_ROUTE_RECORD,self.settings.host_id))
         #send it
         self.answer(answer,connkey)
     
@@ -191,6 +223,8 @@ class NodeManager:
             If the request does not have the R bit set in the header.
           StaleConnectionError
             If the ConnectionKey refers to a lost connection.
+          ConnectionCongestedError
+            If the connection is congested.
         """
         if not request.hdr.isRequest():
             raise NotARequestError()
@@ -208,9 +242,12 @@ class NodeManager:
         try:
             self.node.sendMessage(request,connkey)
             self.logger.log(logging.DEBUG,"Request sent, command_code=%d hop_by_hop_identifier==%d"%(request.hdr.command_code,request.hdr.hop_by_hop_identifier));
-        except StaleConnectionError:
+        except (StaleConnectionError,ConnectionCongestedError):
             self.req_map_lock.acquire()
-            del self.req_map[request.hdr.hop_by_hop_identifier]
+            try:
+                del self.req_map[connkey][request.hdr.hop_by_hop_identifier]
+            except KeyError:
+                pass
             self.req_map_lock.release()
             raise
     
@@ -218,10 +255,10 @@ class NodeManager:
         """
         Sends a request.
         The request is sent to one of the peers and an optional state
-        object is remembered. Please note that handleAnswer() for this
-        request may get called before this method returns. This can happen
-        if the peer is very fast and the OS thread scheduler decides to
-        schedule the networking thread.
+        object is remembered. Congested peers are skipped. Please note that
+        handleAnswer() for this request may get called before this method
+        returns. This can happen if the peer is very fast and the OS thread
+        scheduler decides to schedule the networking thread.
           request  The request to send.
           peers    The candidate peers
           state    A state object to be remembered. This will be passed to
@@ -230,12 +267,14 @@ class NodeManager:
           NotARequestError
             If the request does not have the R bit set in the header.
           NotRoutableError
-            If the message could not be sent to any of the peers.
+            If the message could not be sent to any of the peers, including
+            when all the capable peers are congested.
         """
         self.logger.log(logging.DEBUG,"Sending request (command_code=%d) to %d peers"%(request.hdr.command_code,len(peers)))
         request.hdr.end_to_end_identifier = self.node.nextEndToEndIdentifier()
         any_peers = False
         any_capable_peers = False
+        any_congested_peers = False
         for p in peers:
             any_peers = True
             self.logger.log(logging.DEBUG,"Considering sending request to %s"%p.host)
@@ -246,15 +285,23 @@ class NodeManager:
             if not self.node.isAllowedApplication(request,p2):
                 self.logger.log(logging.DEBUG,"peer %s cannot handle request"%p.host)
                 continue
-            any_capable_peers=True
+            if self.node.isCongested(connkey):
+                self.logger.log(logging.DEBUG,"peer %s is congested"%p.host)
+                any_congested_peers = True
+                continue
             try:
                 self.sendRequest_1(request,connkey,state)
                 return
             except StaleConnectionError, ex:
-                pass #ok
+                any_capable_peers=True
+            except ConnectionCongestedError, ex:
+                any_congested_peers = True
+                continue
             self.logger.log(logging.DEBUG,"Setting retransmit bit")
             request.hdr.setRetransmit(True)
-        if any_capable_peers:
+        if any_congested_peers:
+            raise NotRoutableError("All capable peers are congested")
+        elif any_capable_peers:
             raise NotRoutableError("All capable peer connections went stale")
         elif any_peers:
             raise NotRoutableError("No capable peers")
@@ -266,13 +313,17 @@ class NodeManager:
         """
         Handle an incoming message.
         This implementation calls handleRequest(), or matches an answer to
-        an outstanding request and calls handleAnswer().
+        an outstanding request and calls handleAnswer(). If there is an
+        executor they are called by it.
         Subclasses should not override this method.
         """
         
         if msg.hdr.isRequest():
             self.logger.log(logging.DEBUG,"Handling request")
-            self.handleRequest(msg,connkey,peer)
+            if not self.executor:
+                self._callHandleRequest(msg,connkey,peer)
+            elif not self.executor.submit(self.__partitionKey(msg,connkey),self._callHandleRequest,(msg,connkey,peer)):
+                self.__rejectBusyRequest(msg,connkey)
         else:
             self.logger.log(logging.DEBUG,"Handling answer, hop_by_hop_identifier=%d"%msg.hdr.hop_by_hop_identifier)
             #locate state
@@ -285,12 +336,50 @@ class NodeManager:
             except KeyError:
                 pass
             self.req_map_lock.release()
-            if state:
-                self.handleAnswer(msg,connkey,state)
-            else:
+            if not state:
                 self.logger.log(logging.DEBUG,"Answer did not match any outstanding request")
+            elif self.executor:
+                self.executor.submit(self.__partitionKey(msg,connkey),self.handleAnswer,(msg,connkey,state),False)
+            else:
+                self.handleAnswer(msg,connkey,state)
         return True
     
+    def _callHandleRequest(self,request,connkey,peer):
+        #Calls handleRequest(). AsyncNodeManager sends the answer it returns
+        self.handleRequest(request,connkey,peer)
+    
+    def __partitionKey(self,msg,connkey):
+        avp = msg.find(ProtocolConstants.DI_SESSION_ID)
+        if avp:
+            return avp.payload
+        return connkey
+    
+    def __rejectBusyRequest(self,request,connkey):
+        self.logger.log(logging.DEBUG,"Executor queue is full, answering DIAMETER_TOO_BUSY, end2end=%d"%request.hdr.end_to_end_identifier)
+        answer = Message()
+        answer.prepareResponse(request)
+        answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_TOO_BUSY))
+        self.node.addOurHostAndRealm(answer)
+        Utils.copyProxyInfo(request,answer)
+        Utils.setMandatory_RFC3588(answer)
+        self.answer(answer,connkey)
+    
+    #connectionlistener upcall
+    def handle_congestion(self,connkey,peer,congested):
+        """
+        Handle a connection becoming congested or no longer congested.
+        See NodeSettings.setOutputWatermarks(). This implementation does
+        nothing. Subclasses can override it to stop and resume producing
+        requests for the peer. It is called by the thread that sent or
+        queued the output, which may be a reactor thread or a thread of the
+        application, after the lock of the connection has been released,
+        so it may send messages. When a reactor thread calls it the lock of
+        the reactor is held, so it must not block or call other Node or
+        NodeManager methods. The state may have changed again by the time
+        it is called; see Node.isCongested().
+        """
+        pass
+    
     #connectionlistener upcall
     def handle_connection(self,connkey, peer, updown):
         """
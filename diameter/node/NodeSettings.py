@@ -5,6 +5,10 @@ from diameter.node.Error import InvalidSettingError
 class NodeSettings:
     """Configuration for a Node"""
     
+    #how connections are assigned to reactors. See setReactors()
+    balance_round_robin = 0
+    balance_least_connections = 1
+    
     def __init__(self,host_id, realm, vendor_id, capabilities, port, product_name, firmware_revision):
         if not host_id or host_id=="":
             raise InvalidSettingError("No host_id")
@@ -35,6 +39,141 @@ class NodeSettings:
         self.product_name = product_name
         
         self.firmware_revision = firmware_revision
+        
+        self.cork_window = None
+        self.output_high_watermark = None
+        self.output_low_watermark = None
+        self.congestion_timeout = 0
+        self.reactors = 1
+        self.reactor_balance = NodeSettings.balance_least_connections
+        self.reuse_port = False
+        self.worker_index = 0
+        self.worker_count = 1
+        self.listen_backlog = 128
+        self.accept_thread = False
+    
+    def setCorkWindow(self,cork_window):
+        """Enables or disables coalescing of output ("corking").
+        When coalescing is enabled the messages sent to a connection are not
+        sent right away by the sending thread. The messages sent by the node
+        thread (answers sent while handling requests, watchdogs etc.) are
+        sent together at the end of each iteration of its select loop, and
+        the messages sent by other threads are sent by the node thread when
+        the window has passed, together with the messages sent in the
+        meantime. This reduces the number of send() calls at the cost of
+        latency. The window is also the latency bound: a message sent from
+        another thread is sent at most cork_window microseconds (plus the
+        time of the current loop iteration) after it was queued, and as
+        soon as possible if 64KB or more is queued.
+        By default coalescing is disabled.
+          cork_window  The window in microseconds (0..1000000), or None to
+                       disable coalescing.
+        """
+        if cork_window is not None and (cork_window<0 or cork_window>1000000):
+            raise InvalidSettingError("cork_window must be 0..1000000 microseconds")
+        self.cork_window = cork_window
+    
+    def setOutputWatermarks(self,high,low):
+        """Limits the output queued for a connection.
+        A connection with high bytes or more queued is congested:
+        Node.sendMessage() waits for it (see setCongestionTimeout()) or
+        raises ConnectionCongestedError, and NodeManager.sendRequest_any()
+        skips it. The connection stops being congested when its queued
+        output has been sent down to low bytes. Messages the node sends
+        itself (CER/CEA/DWR/DWA/DPR/DPA) are never held back.
+        By default output is not limited. Removing the limit while the
+        node runs ends the congestion of the congested connections.
+          high  The high watermark in bytes, or None for no limit.
+          low   The low watermark in bytes. Must be less than high.
+        """
+        if high is None:
+            low = None
+        elif high<=0 or low is None or low<0 or low>=high:
+            raise InvalidSettingError("output watermarks must be 0 <= low < high")
+        self.output_high_watermark = high
+        self.output_low_watermark = low
+    
+    def setCongestionTimeout(self,congestion_timeout):
+        """Sets how long Node.sendMessage() waits for a congested connection
+        before raising ConnectionCongestedError. The node thread never waits.
+        The default is 0 (no waiting).
+          congestion_timeout  The timeout in seconds.
+        """
+        if congestion_timeout<0:
+            raise InvalidSettingError("congestion_timeout must be non-negative")
+        self.congestion_timeout = congestion_timeout
+    
+    def setReactors(self,reactors,balance=balance_least_connections):
+        """Sets the number of I/O loops (reactors) of the node.
+        Each reactor has its own thread and handles its own share of the
+        connections, so a busy peer only delays the peers sharing its
+        reactor. Connections accepted or initiated by the node are assigned
+        to the reactors by the balancing policy:
+          balance_least_connections  the reactor with fewest connections
+          balance_round_robin        the reactors in turn
+        Message handlers are called by the reactor threads, so with more
+        than one reactor they are called concurrently.
+        The default is 1 reactor.
+          reactors  The number of reactors (1..256)
+          balance   The balancing policy
+        """
+        if reactors<1 or reactors>256:
+            raise InvalidSettingError("reactors must be 1..256")
+        if balance!=NodeSettings.balance_round_robin and \
+           balance!=NodeSettings.balance_least_connections:
+            raise InvalidSettingError("Unknown reactor balancing policy")
+        self.reactors = reactors
+        self.reactor_balance = balance
+    
+    def setReusePort(self,reuse_port):
+        """Enables SO_REUSEPORT on the listen socket.
+        Several processes can then listen on the same port, and the kernel
+        spreads the inbound connections over them. See Launcher.
+        By default it is disabled.
+          reuse_port  True to enable SO_REUSEPORT
+        """
+        self.reuse_port = reuse_port
+    
+    def setWorker(self,worker_index,worker_count):
+        """Makes the node one of several worker processes sharing the host
+        identity. The end-to-end identifiers and Session-Ids generated by
+        the node are taken from a range of its own, so they do not collide
+        with those of the other workers. See Launcher.
+        By default the node is worker 0 of 1.
+          worker_index  The index of this worker (0..worker_count-1)
+          worker_count  The number of workers (1..4096)
+        """
+        if worker_count<1 or worker_count>4096:
+            raise InvalidSettingError("worker_count must be 1..4096")
+        if worker_index<0 or worker_index>=worker_count:
+            raise InvalidSettingError("worker_index must be 0..worker_count-1")
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+    
+    def setListenBacklog(self,listen_backlog):
+        """Sets the backlog of the listen socket.
+        It is the number of inbound connections the kernel queues until the
+        node accepts them. When it is full, connection attempts are dropped
+        and the peers only retry after seconds, so it must be large enough
+        for all the peers reconnecting at once, eg. after a network outage.
+        The kernel may limit it (net.core.somaxconn on Linux).
+        By default it is 128.
+          listen_backlog  The backlog (1..65535)
+        """
+        if listen_backlog<1 or listen_backlog>65535:
+            raise InvalidSettingError("listen_backlog must be 1..65535")
+        self.listen_backlog = listen_backlog
+    
+    def setAcceptThread(self,accept_thread):
+        """Makes the node accept inbound connections in a thread of its own.
+        By default they are accepted by the first reactor, which then does
+        not serve its connections while many peers connect at once. The
+        accept thread only accepts the connections and hands them to the
+        reactors.
+        By default it is disabled.
+          accept_thread  True to use an accept thread
+        """
+        self.accept_thread = accept_thread
 
 from Capability import Capability
 
@@ -81,3 +220,53 @@ def _unittest():
         ns = NodeSettings("somehost.example.net","example.net",-1,cap,3868,"PythonDiameter",1)
     except InvalidSettingError:
         assert False
+    assert ns.cork_window is None
+    ns.setCorkWindow(200)
+    assert ns.cork_window==200
+    try:
+        ns.setCorkWindow(-1)
+        assert False
+    except InvalidSettingError:
+        pass
+    ns.setCorkWindow(None)
+    assert ns.cork_window is None
+    ns.setOutputWatermarks(1000,100)
+    assert ns.output_high_watermark==1000 and ns.output_low_watermark==100
+    try:
+        ns.setOutputWatermarks(100,100)
+        assert False
+    except InvalidSettingError:
+        pass
+    ns.setOutputWatermarks(None,None)
+    assert ns.output_high_watermark is None
+    try:
+        ns.setCongestionTimeout(-1)
+        assert False
+    except InvalidSettingError:
+        pass
+    assert ns.reactors==1
+    ns.setReactors(4,NodeSettings.balance_round_robin)
+    assert ns.reactors==4 and ns.reactor_balance==NodeSettings.balance_round_robin
+    try:
+        ns.setReactors(0)
+        assert False
+    except InvalidSettingError:
+        pass
+    ns.setWorker(2,4)
+    assert ns.worker_index==2 and ns.worker_count==4
+    assert ns.listen_backlog==128
+    ns.setListenBacklog(1024)
+    assert ns.listen_backlog==1024
+    try:
+        ns.setListenBacklog(0)
+        assert False
+    except InvalidSettingError:
+        pass
+    assert not ns.accept_thread
+    ns.setAcceptThread(True)
+    assert ns.accept_thread
+    try:
+        ns.setWorker(4,4)
+        assert False
+    except InvalidSettingError:
+        pass
@@ -3,19 +3,31 @@ import thread
 import random
 
 class NodeState:
+    """The identifiers a node generates.
+    When a node runs in several processes sharing the host identity (see
+    NodeSettings.setWorker()), the end-to-end identifiers and the low
+    part of the Session-Ids are partitioned into one range per worker, so
+    the workers never generate the same identifiers.
+    """
     
-    def __init__(self):
+    def __init__(self,worker_index=0,worker_count=1):
         now = long(time.time())
         self.state_id = now
-        self.end_to_end_identifier = int((now<<20) | random.randint(0,0x000FFFFF))&0xFFFFFFFF
+        #[range_start,range_start+range_size) is the range of the worker
+        self.range_size = int(0x100000000/worker_count)
+        self.range_start = worker_index*self.range_size
+        e2e = int((now<<20) | random.randint(0,0x000FFFFF))&0xFFFFFFFF
+        self.end_to_end_identifier = self.range_start + e2e%self.range_size
         self.session_id_high = now
-        self.session_id_low = 0
+        self.session_id_low = self.range_start
         self.lock = thread.allocate_lock()
     
     def nextEndToEndIdentifier(self):
         self.lock.acquire()
         v = self.end_to_end_identifier
         self.end_to_end_identifier += 1
+        if self.end_to_end_identifier == self.range_start+self.range_size:
+            self.end_to_end_identifier = self.range_start
         self.lock.release()
         return v
     
@@ -23,11 +35,12 @@ class NodeState:
         self.lock.acquire()
         v = self.session_id_low
         self.session_id_low += 1
-        if self.session_id_low == 0:
+        if self.session_id_low == self.range_start+self.range_size:
+            self.session_id_low = self.range_start
             self.session_id_high += 1
         self.lock.release()
         return str(self.session_id_high) + ";" + str(v)
-        
+
 
 def _unittest():
     ns = NodeState()
@@ -39,3 +52,19 @@ def _unittest():
     sp2 = ns.nextSessionId_second_part()
     assert sp1 != sp2
     
+    #workers get disjoint ranges
+    workers = [NodeState(i,3) for i in range(3)]
+    for i in range(3):
+        ns = workers[i]
+        e2e = ns.nextEndToEndIdentifier()
+        assert i*ns.range_size<=e2e<(i+1)*ns.range_size
+        assert int(ns.nextSessionId_second_part().split(";")[1])==i*ns.range_size
+    assert workers[2].range_start+workers[2].range_size<=0x100000000
+    ns = workers[1]
+    ns.end_to_end_identifier = ns.range_start+ns.range_size-1
+    ns.nextEndToEndIdentifier()
+    assert ns.nextEndToEndIdentifier()==ns.range_start
+    ns.session_id_low = ns.range_start+ns.range_size-1
+    high = ns.session_id_high
+    ns.nextSessionId_second_part()
+    assert ns.nextSessionId_second_part()==str(high+1)+";"+str(ns.range_start)
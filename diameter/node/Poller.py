@@ -0,0 +1,244 @@
+import select
+
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+class Poller(object):
+    """Waits for sockets to become readable or writable.
+    Sockets are registered once with the events of interest and an
+    arbitrary data object, and the registration is only modified when the
+    interest changes. poll() returns the data objects of the ready sockets,
+    so no lookup is needed. This is a subset of the Python 3 selectors
+    module, which Python 2 does not have.
+    
+    Use createPoller() to get the best implementation for the platform:
+    epoll, then poll, then select.
+    """
+    
+    #True if registrations can be changed while another thread is in
+    #poll() and take effect right away. Otherwise the polling thread must
+    #be woken up for the change to take effect
+    thread_safe = False
+    
+    __slots__ = ("_map",)
+    
+    def __init__(self):
+        #fd -> [fileobj,events,data]
+        self._map = {}
+    
+    def register(self,fileobj,events,data=None):
+        """Registers a socket
+          fileobj  The socket (anything with a fileno() method)
+          events   EVENT_READ, EVENT_WRITE or both
+          data     The object returned by poll() for the socket
+        """
+        fd = fileobj.fileno()
+        if fd in self._map:
+            raise KeyError("%d is already registered"%fd)
+        self._map[fd] = [fileobj,events,data]
+        self._register(fd,events)
+    
+    def modify(self,fileobj,events):
+        """Changes the events of interest of a registered socket.
+        Returns True if they changed
+        """
+        fd = fileobj.fileno()
+        entry = self._map[fd]
+        if entry[1]==events:
+            return False
+        entry[1] = events
+        self._modify(fd,events)
+        return True
+    
+    def unregister(self,fileobj):
+        """Unregisters a socket. It must be done before the socket is closed"""
+        fd = fileobj.fileno()
+        del self._map[fd]
+        self._unregister(fd)
+    
+    def __len__(self):
+        return len(self._map)
+    
+    def poll(self,timeout=None):
+        """Waits for registered sockets to become ready.
+          timeout  Maximum number of seconds to wait. None means forever
+        Returns a list of (data,events) for the ready sockets
+        """
+        ready = []
+        registered = self._map
+        for fd,events in self._poll(timeout):
+            entry = registered.get(fd)
+            if entry is None:
+                continue #unregistered while polling
+            events &= entry[1]
+            if events:
+                ready.append((entry[2],events))
+        return ready
+    
+    def close(self):
+        """Releases the resources of the poller"""
+        self._map = {}
+
+
+class EpollPoller(Poller):
+    thread_safe = True
+    __slots__ = ("_epoll",)
+    
+    #errors and hangups are reported as readable and writable, so the
+    #next recv() or send() reports them
+    _in = select.EPOLLIN|select.EPOLLERR|select.EPOLLHUP if hasattr(select,"epoll") else 0
+    _out = select.EPOLLOUT|select.EPOLLERR|select.EPOLLHUP if hasattr(select,"epoll") else 0
+    
+    def __init__(self):
+        Poller.__init__(self)
+        self._epoll = select.epoll()
+    
+    def __mask(events):
+        mask = 0
+        if events&EVENT_READ:
+            mask |= select.EPOLLIN
+        if events&EVENT_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+    __mask = staticmethod(__mask)
+    
+    def _register(self,fd,events):
+        self._epoll.register(fd,EpollPoller.__mask(events))
+    def _modify(self,fd,events):
+        self._epoll.modify(fd,EpollPoller.__mask(events))
+    def _unregister(self,fd):
+        self._epoll.unregister(fd)
+    
+    def _poll(self,timeout):
+        if timeout is None:
+            timeout = -1
+        ready = []
+        for fd,mask in self._epoll.poll(timeout,max(len(self._map),1)):
+            events = 0
+            if mask&EpollPoller._in:
+                events |= EVENT_READ
+            if mask&EpollPoller._out:
+                events |= EVENT_WRITE
+            ready.append((fd,events))
+        return ready
+    
+    def close(self):
+        Poller.close(self)
+        self._epoll.close()
+
+
+class PollPoller(Poller):
+    __slots__ = ("_poll_obj",)
+    
+    _in = select.POLLIN|select.POLLPRI|select.POLLERR|select.POLLHUP|select.POLLNVAL if hasattr(select,"poll") else 0
+    _out = select.POLLOUT|select.POLLERR|select.POLLHUP|select.POLLNVAL if hasattr(select,"poll") else 0
+    
+    def __init__(self):
+        Poller.__init__(self)
+        self._poll_obj = select.poll()
+    
+    def __mask(events):
+        mask = 0
+        if events&EVENT_READ:
+            mask |= select.POLLIN
+        if events&EVENT_WRITE:
+            mask |= select.POLLOUT
+        return mask
+    __mask = staticmethod(__mask)
+    
+    def _register(self,fd,events):
+        self._poll_obj.register(fd,PollPoller.__mask(events))
+    def _modify(self,fd,events):
+        self._poll_obj.modify(fd,PollPoller.__mask(events))
+    def _unregister(self,fd):
+        self._poll_obj.unregister(fd)
+    
+    def _poll(self,timeout):
+        if timeout is not None:
+            timeout = int(timeout*1000+0.999)
+        ready = []
+        for fd,mask in self._poll_obj.poll(timeout):
+            events = 0
+            if mask&PollPoller._in:
+                events |= EVENT_READ
+            if mask&PollPoller._out:
+                events |= EVENT_WRITE
+            ready.append((fd,events))
+        return ready
+
+
+class SelectPoller(Poller):
+    __slots__ = ("_readers","_writers")
+    
+    def __init__(self):
+        Poller.__init__(self)
+        self._readers = set()
+        self._writers = set()
+    
+    def _register(self,fd,events):
+        if events&EVENT_READ:
+            self._readers.add(fd)
+        if events&EVENT_WRITE:
+            self._writers.add(fd)
+    def _modify(self,fd,events):
+        self._unregister(fd)
+        self._register(fd,events)
+    def _unregister(self,fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+    
+    def _poll(self,timeout):
+        r,w,x = select.select(list(self._readers),list(self._writers),[],timeout)
+        ready = {}
+        for fd in r:
+            ready[fd] = EVENT_READ
+        for fd in w:
+            ready[fd] = ready.get(fd,0)|EVENT_WRITE
+        return ready.items()
+
+
+def createPoller():
+    """Returns a new poller of the best kind available"""
+    if hasattr(select,"epoll"):
+        return EpollPoller()
+    if hasattr(select,"poll"):
+        return PollPoller()
+    return SelectPoller()
+
+
+def _unittest():
+    import socket
+    kinds = [SelectPoller]
+    if hasattr(select,"poll"):
+        kinds.append(PollPoller)
+    if hasattr(select,"epoll"):
+        kinds.append(EpollPoller)
+    for kind in kinds:
+        p = kind()
+        a,b = socket.socketpair()
+        p.register(a,EVENT_READ,"a")
+        p.register(b,EVENT_READ,"b")
+        assert len(p)==2
+        assert p.poll(0)==[]
+        b.send("x")
+        assert p.poll(1)==[("a",EVENT_READ)]
+        a.recv(1)
+        assert p.modify(b,EVENT_READ|EVENT_WRITE)
+        assert not p.modify(b,EVENT_READ|EVENT_WRITE)
+        assert p.poll(1)==[("b",EVENT_WRITE)]
+        p.modify(b,EVENT_READ)
+        assert p.poll(0)==[]
+        try:
+            p.register(a,EVENT_READ)
+            assert False
+        except KeyError:
+            pass
+        p.unregister(b)
+        b.close()
+        #the peer closing is reported as readable
+        assert p.poll(1)==[("a",EVENT_READ)]
+        p.unregister(a)
+        a.close()
+        assert len(p)==0
+        p.close()
+    assert isinstance(createPoller(),Poller)
@@ -0,0 +1,232 @@
+import threading
+import heapq
+import collections
+from diameter.node.Poller import createPoller,EVENT_READ
+from diameter.node.Waker import createWaker
+from diameter.node.Connection import Connection
+from diameter.node.Clock import monotonic
+
+class Reactor(object):
+    """An I/O loop of a Node.
+    A node runs one or more reactors (see NodeSettings.setReactors()), each
+    in its own thread. A connection is assigned to a reactor when it is
+    accepted or initiated and belongs to it until it is closed: the reactor
+    reads from it, dispatches its messages, sends its output and runs its
+    timers. The state of the connections of a reactor is protected by the
+    lock of the reactor, so reactors do not contend with each other, and a
+    busy peer only delays the peers of its own reactor.
+    
+    Other threads do not take the lock of the reactor to send. They queue
+    output under the lock of the connection and send it right away if
+    nothing else is queued. Connections that need the reactor after that
+    (the socket buffer is full, the output is corked) are handed to it
+    through queues that the reactor drains in each loop iteration.
+    
+    The reactor is only woken when it may be blocked in poll() and has not
+    been woken already. It drains its queues after poll() returns, so
+    wake-ups are not needed while it is busy.
+    
+    The timers of the connections are kept in a heap ordered by when they
+    must be checked next, so only the connections with expired timers are
+    visited. Activity on a connection only postpones its timers, so the
+    heap is not updated for it. When a connection comes up for checking
+    too early, it is rescheduled then. A connection is rescheduled right
+    away only when its timers may expire earlier than scheduled.
+    """
+    
+    __slots__ = ("index","lock","poller","waker","polling","notified",
+                 "wakeups","wakeups_avoided","thread","connections",
+                 "handoff","cork_lock","corked","cork_deadline",
+                 "messages_sent","send_calls","now","timers","stale_timers")
+    
+    def __init__(self,index):
+        self.index = index
+        self.lock = threading.Lock()
+        #the sockets of the connections stay registered while they are
+        #open. The data of a connection socket is the Connection
+        self.poller = createPoller()
+        self.waker = createWaker()
+        self.poller.register(self.waker,EVENT_READ,self.waker)
+        #polling is set by the thread of the reactor from the start of a
+        #loop iteration until poll() returns. notified is set when the
+        #waker has been made readable and cleared when it is drained
+        self.polling = False
+        self.notified = False
+        #the counters are updated without a lock, so they are approximate
+        self.wakeups = 0
+        self.wakeups_avoided = 0
+        self.thread = None
+        #connkey -> Connection for the connections of this reactor
+        self.connections = {}
+        #connections whose output could not be sent by the sending thread.
+        #Appending to and popping from a deque is atomic, so senders hand
+        #connections over without any lock
+        self.handoff = collections.deque()
+        #connections with corked output (see NodeSettings.setCorkWindow()),
+        #and when it must be sent. cork_lock is only held briefly and no
+        #other lock is taken while holding it
+        self.cork_lock = threading.Lock()
+        self.corked = []
+        self.cork_deadline = None
+        #output statistics of the closed connections of the reactor
+        self.messages_sent = 0
+        self.send_calls = 0
+        #Clock.monotonic(), updated by the thread of the reactor in each
+        #loop iteration
+        self.now = monotonic()
+        #heap of (when,id(conn),conn). Entries whose time is not the
+        #scheduled time of the connection are stale
+        self.timers = []
+        self.stale_timers = 0
+    
+    def inThread(self):
+        "Returns True if the calling thread is the thread of the reactor"
+        return threading.currentThread() is self.thread
+    
+    def wake(self):
+        """Makes the thread of the reactor return from poll(), if it may be
+        in it. Must be called after queueing the work for the reactor.
+        """
+        if not self.polling or self.notified:
+            self.wakeups_avoided += 1
+            return
+        self.notified = True
+        self.wakeups += 1
+        self.waker.wake()
+    
+    def drainWakeups(self):
+        "Called by the thread of the reactor when the waker is readable"
+        self.waker.drain()
+        self.notified = False
+    
+    def pollerChanged(self):
+        """Must be called after changing the registrations of the poller.
+        Wakes the reactor if the change does not take effect otherwise.
+        """
+        if not self.poller.thread_safe and not self.inThread():
+            self.wake()
+    
+    def scheduleTimers(self,conn):
+        """Schedules checking the timers of a connection.
+        Must be called with the lock held, when the connection is added,
+        and when its timers may expire earlier than they are scheduled.
+        When called by another thread, the reactor is woken if the timers
+        are due before those it may be sleeping until.
+        """
+        timers = conn.timers
+        when = timers.calcNextTimeout(conn.state==Connection.state_ready)
+        if timers.scheduled is not None:
+            if timers.scheduled<=when:
+                return
+            self.stale_timers += 1
+        next_timer = self.nextTimer()
+        timers.scheduled = when
+        heapq.heappush(self.timers,(when,id(conn),conn))
+        self.__compactTimers()
+        if (next_timer is None or when<next_timer) and not self.inThread():
+            self.wake()
+    
+    def unscheduleTimers(self,conn):
+        """Stops checking the timers of a connection. Must be called with
+        the lock held when the connection is removed.
+        """
+        if conn.timers.scheduled is not None:
+            conn.timers.scheduled = None
+            self.stale_timers += 1
+            self.__compactTimers()
+    
+    def expiredTimers(self):
+        """Returns the connections with timers due at self.now. They are
+        unscheduled, so scheduleTimers() must be called for those that stay
+        open. Must be called with the lock held.
+        """
+        expired = []
+        timers = self.timers
+        while timers and timers[0][0]<=self.now:
+            when,ignore,conn = heapq.heappop(timers)
+            if conn.timers.scheduled!=when:
+                self.stale_timers -= 1
+                continue
+            conn.timers.scheduled = None
+            expired.append(conn)
+        return expired
+    
+    def nextTimer(self):
+        """Returns when the next timers are due, or None"""
+        if self.timers:
+            return self.timers[0][0]
+        return None
+    
+    def __compactTimers(self):
+        #Stale entries are removed when they are popped, but closed
+        #connections can be scheduled far ahead, so the heap is rebuilt
+        #when more than half of it is stale
+        if self.stale_timers>64 and self.stale_timers*2>len(self.timers):
+            self.timers = [entry for entry in self.timers if entry[2].timers.scheduled==entry[0]]
+            heapq.heapify(self.timers)
+            self.stale_timers = 0
+    
+    def close(self):
+        "Releases the poller and the waker"
+        self.poller.close()
+        self.waker.close()
+
+
+def _unittest():
+    r = Reactor(0)
+    assert not r.inThread()
+    #only a polling reactor is woken, and only once
+    r.wake()
+    assert r.poller.poll(0)==[]
+    r.polling = True
+    r.wake()
+    r.wake()
+    assert r.poller.poll(1)==[(r.waker,EVENT_READ)]
+    r.drainWakeups()
+    assert r.poller.poll(0)==[]
+    assert r.wakeups==1 and r.wakeups_avoided==2
+    #other threads wake the reactor only for timers due before the
+    #earliest scheduled ones
+    conn = Connection()
+    r.scheduleTimers(conn)
+    assert r.poller.poll(1)==[(r.waker,EVENT_READ)]
+    r.drainWakeups()
+    later = Connection()
+    later.timers.last_activity += 10
+    r.scheduleTimers(later)
+    assert r.poller.poll(0)==[]
+    conn.timers.last_activity -= 10
+    r.scheduleTimers(conn)
+    assert r.poller.poll(1)==[(r.waker,EVENT_READ)]
+    r.drainWakeups()
+    assert r.wakeups==3
+    r.unscheduleTimers(conn)
+    r.unscheduleTimers(later)
+    r.now += 1000
+    assert r.expiredTimers()==[] and r.stale_timers==0
+    r.thread = threading.currentThread()
+    assert r.inThread()
+    
+    conns = []
+    for i in range(100):
+        conn = Connection()
+        conn.timers.last_activity = r.now+i
+        r.scheduleTimers(conn)
+        conns.append(conn)
+    assert r.nextTimer()==r.now+conns[0].timers.cfg_watchdog_timer
+    r.now += conns[0].timers.cfg_watchdog_timer+9.5
+    assert r.expiredTimers()==conns[0:10]
+    assert r.expiredTimers()==[]
+    #rescheduling earlier leaves a stale entry behind
+    conns[50].timers.last_activity -= 45
+    r.scheduleTimers(conns[50])
+    assert r.stale_timers==1
+    assert r.expiredTimers()==[conns[50]]
+    for conn in conns[10:]:
+        r.unscheduleTimers(conn)
+    #the heap was compacted on the way
+    assert len(r.timers)<90 and r.stale_timers==len(r.timers)
+    r.now += 1000
+    assert r.expiredTimers()==[]
+    assert r.timers==[] and r.stale_timers==0
+    r.close()
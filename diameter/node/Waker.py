@@ -0,0 +1,145 @@
+import os
+import socket
+import errno
+import sys
+
+class Waker(object):
+    """A file descriptor that other threads make readable to wake up a
+    thread blocked in poll() on it.
+    Wake-ups that happen before the polling thread drains the descriptor
+    are merged, and drain() consumes all of them at once. The caller
+    decides if a wake-up is needed at all (see Reactor.wake()).
+    
+    Use createWaker() to get the best implementation for the platform:
+    eventfd, then a socket pair.
+    """
+    
+    __slots__ = ()
+    
+    def fileno(self):
+        "Returns the descriptor to poll for readability"
+        raise NotImplementedError
+    
+    def wake(self):
+        "Makes the descriptor readable"
+        raise NotImplementedError
+    
+    def drain(self):
+        "Consumes all pending wake-ups"
+        raise NotImplementedError
+    
+    def close(self):
+        raise NotImplementedError
+
+
+class EventfdWaker(Waker):
+    """A Waker using a Linux eventfd, which is a 64-bit counter instead of
+    a buffer: wake-ups add to it and one 8-byte read resets it.
+    Python 2 has no os.eventfd() so it is created through ctypes.
+    """
+    
+    __slots__ = ("fd",)
+    
+    _one = "\001\000\000\000\000\000\000\000"
+    
+    def __init__(self):
+        fd = _eventfd(0,_EFD_CLOEXEC|_EFD_NONBLOCK)
+        if fd<0:
+            raise OSError(_ctypes.get_errno(),"eventfd() failed")
+        self.fd = fd
+    
+    def fileno(self):
+        return self.fd
+    
+    def wake(self):
+        try:
+            os.write(self.fd,EventfdWaker._one)
+        except OSError, e:
+            #EAGAIN: the counter is full, so it is readable anyway
+            if e.errno!=errno.EAGAIN:
+                raise
+    
+    def drain(self):
+        try:
+            os.read(self.fd,8)
+        except OSError, e:
+            if e.errno!=errno.EAGAIN:
+                raise
+    
+    def close(self):
+        os.close(self.fd)
+
+
+class SocketpairWaker(Waker):
+    "A Waker using a socket pair, for platforms without eventfd"
+    
+    __slots__ = ("r","w")
+    
+    def __init__(self):
+        self.r,self.w = socket.socketpair()
+        self.r.setblocking(False)
+        self.w.setblocking(False)
+    
+    def fileno(self):
+        return self.r.fileno()
+    
+    def wake(self):
+        try:
+            self.w.send("w")
+        except socket.error, (err,errstr):
+            #the buffer is full, so it is readable anyway
+            if err!=errno.EAGAIN and err!=errno.EWOULDBLOCK:
+                raise
+    
+    def drain(self):
+        try:
+            while len(self.r.recv(4096))==4096:
+                pass
+        except socket.error, (err,errstr):
+            if err!=errno.EAGAIN and err!=errno.EWOULDBLOCK:
+                raise
+    
+    def close(self):
+        self.r.close()
+        self.w.close()
+
+
+_eventfd = None
+if sys.platform.startswith("linux"):
+    try:
+        import ctypes as _ctypes
+        import ctypes.util
+        _EFD_NONBLOCK = os.O_NONBLOCK
+        _EFD_CLOEXEC = 02000000
+        _eventfd = _ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True).eventfd
+        _eventfd.argtypes = [_ctypes.c_uint,_ctypes.c_int]
+    except (ImportError,OSError,AttributeError):
+        _eventfd = None
+
+
+def createWaker():
+    """Returns a new waker of the best kind available"""
+    if _eventfd is not None:
+        try:
+            return EventfdWaker()
+        except OSError:
+            pass
+    return SocketpairWaker()
+
+
+def _unittest():
+    import select
+    kinds = [SocketpairWaker]
+    if _eventfd is not None:
+        kinds.append(EventfdWaker)
+    for kind in kinds:
+        w = kind()
+        assert select.select([w],[],[],0)[0]==[]
+        for i in range(10000):
+            w.wake()
+        assert select.select([w],[],[],0)[0]==[w]
+        w.drain()
+        assert select.select([w],[],[],0)[0]==[]
+        w.drain()
+        w.close()
+    assert isinstance(createWaker(),Waker)
@@ -9,7 +9,9 @@ How to create a node:.
   2: The next step is creating a NodeSettings instance. A NodeSettings
      instance specifies the settings for your node including the
      capabilities, host-ID, etc.
-  3: Then you are ready to create a Node, and NodeManager or SimpleSyncClient.
+  3: Then you are ready to create a Node, and NodeManager, SimpleSyncClient
+     or AsyncNodeManager.
+  4: Optionally run the node manager in several processes with Launcher.
 """
 
 from Capability import Capability
@@ -18,7 +20,11 @@ from NodeSettings import NodeSettings
 from Node import Node
 from NodeManager import NodeManager
 from SimpleSyncClient import SimpleSyncClient
-from Error import error, InvalidSettingError, StartError,InvalidAVPValueError,StaleConnectionError,NotARequestError,NotRoutableError,NotProxiableError
+from Future import Future
+from Executor import Executor
+from AsyncNodeManager import AsyncNodeManager
+from Launcher import Launcher
+from Error import error, InvalidSettingError, StartError,InvalidAVPValueError,StaleConnectionError,NotARequestError,NotRoutableError,NotProxiableError,ConnectionCongestedError
 #from Error import *
 
 __author__="Ivan Skytte Jrgensen"
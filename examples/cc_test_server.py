@@ -15,27 +15,15 @@ class cc_test_server(NodeManager):
     def handleRequest(self,request,connkey,peer):
         answer = Message()
         answer.prepareResponse(request)
-        a = request.find(ProtocolConstants.DI_SESSION_ID)
-        if a:
-            answer.append(a)
+        #AVPs copied from the request are not decoded, just copied
+        answer.copyAVP(request,ProtocolConstants.DI_SESSION_ID)
         answer.append(AVP_Unsigned32(ProtocolConstants.DI_RESULT_CODE, ProtocolConstants.DIAMETER_RESULT_SUCCESS))
         self.node.addOurHostAndRealm(answer)
-        a = request.find(ProtocolConstants.DI_AUTH_APPLICATION_ID)
-        if a:
-            answer.append(a)
-        a = request.find(ProtocolConstants.DI_CC_REQUEST_TYPE)
-        if a:
-            answer.append(a)
-        a = request.find(ProtocolConstants.DI_CC_REQUEST_NUMBER)
-        if a:
-            answer.append(a)
-        
-        a = request.find(ProtocolConstants.DI_REQUESTED_SERVICE_UNIT)
-        if a:
-            import copy
-            a = copy.deepcopy(a)
-            a.code = ProtocolConstants.DI_GRANTED_SERVICE_UNIT
-            answer.append(a)
+        answer.copyAVP(request,ProtocolConstants.DI_AUTH_APPLICATION_ID)
+        answer.copyAVP(request,ProtocolConstants.DI_CC_REQUEST_TYPE)
+        answer.copyAVP(request,ProtocolConstants.DI_CC_REQUEST_NUMBER)
+        answer.copyAVP(request,ProtocolConstants.DI_REQUESTED_SERVICE_UNIT,
+                       new_code=ProtocolConstants.DI_GRANTED_SERVICE_UNIT)
         
         Utils.copyProxyInfo(request,answer)
         Utils.setMandatory_RFC3588(answer)